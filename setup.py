@@ -44,6 +44,9 @@ setup(
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
     ],
@@ -59,7 +62,7 @@ setup(
         'dev': ['tox'],
         'mqtt': ['paho-mqtt']
     },
-    python_requires='>=3',
+    python_requires='>=3.5',
 
     project_urls={
         'Bug Reports': 'https://github.com/doudz/zigate/issues',
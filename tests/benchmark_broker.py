@@ -0,0 +1,91 @@
+'''
+ZiGate Broker benchmark
+-------------------------
+Drive the raw TCP broker with many local clients against a fake transport
+
+python3 -m tests.benchmark_broker [clients_count] [frames_count]
+'''
+
+import sys
+import socket
+import selectors
+from time import time
+from zigate import ZiGate
+from zigate.broker import Broker
+from .helpers import FakeConnection, wait_for
+
+
+def connect(broker, count):
+    clients = []
+    for i in range(count):
+        client = socket.create_connection(('127.0.0.1', broker.port))
+        client.setblocking(False)
+        clients.append(client)
+    wait_for(lambda: len(broker.users) == count, 30)
+    return clients
+
+
+def receive_all(clients, size):
+    '''
+    read from all clients in a single thread until each one got size bytes
+    '''
+    selector = selectors.DefaultSelector()
+    received = {}
+    for client in clients:
+        selector.register(client, selectors.EVENT_READ)
+        received[client] = 0
+    remaining = len(clients)
+    while remaining:
+        for key, mask in selector.select(timeout=5):
+            client = key.fileobj
+            received[client] += len(client.recv(65536))
+            if received[client] >= size:
+                selector.unregister(client)
+                remaining -= 1
+    selector.close()
+
+
+def benchmark(count, frames):
+    zigate = ZiGate(auto_start=False)
+    zigate.connection = FakeConnection(zigate, answer=False)
+    broker = Broker(zigate, 0, '127.0.0.1', buffer_size=4 * 1024 * 1024)
+    broker.start()
+    frame = b'\x01\x81\x02\x00\x0d\x00\x01\xab\xcd\x01\x00\x02\x16\x00\x00\x00\x10\x00\x02\x11\x01\x03'
+
+    t1 = time()
+    clients = connect(broker, count)
+    connect_time = time() - t1
+
+    t1 = time()
+    for i in range(frames):
+        broker.forward_msg(frame)
+    receive_all(clients, len(frame) * frames)
+    fanout_time = time() - t1
+
+    t1 = time()
+    for client in clients:
+        client.sendall(b'\x01\x02\x10\x10\x02\x10\x02\x10\x10\x03')
+    wait_for(lambda: len(zigate.connection.sent) == count, 30)
+    command_time = time() - t1
+
+    t1 = time()
+    for client in clients:
+        client.close()
+    wait_for(lambda: len(broker.users) == 0, 30)
+    disconnect_time = time() - t1
+
+    broker.exit()
+    broker.join(5)
+    return connect_time, fanout_time, command_time, disconnect_time
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    connect_time, fanout_time, command_time, disconnect_time = benchmark(count, frames)
+    print('{} clients, {} frames'.format(count, frames))
+    print('connect    : {:.4f}s'.format(connect_time))
+    rate = count * frames / fanout_time
+    print('fan-out    : {:.4f}s ({:.0f} frames/s delivered)'.format(fanout_time, rate))
+    print('commands   : {:.4f}s'.format(command_time))
+    print('disconnect : {:.4f}s'.format(disconnect_time))
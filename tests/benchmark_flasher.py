@@ -0,0 +1,52 @@
+'''
+ZiGate Flasher benchmark
+-------------------------
+Write and verify a firmware through the bootloader simulator
+
+python3 -m tests.benchmark_flasher [latency_ms] [window] [firmware_size]
+'''
+
+import sys
+import os
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from time import time
+import serial
+from zigate import flasher
+from zigate.simulator import BootloaderSimulator
+
+
+def benchmark(latency, window, size):
+    simulator = BootloaderSimulator(latency=latency, simulate_baudrate=True)
+    simulator.start()
+    ser = serial.Serial(simulator.port, 38400, timeout=5)
+    fd, path = tempfile.mkstemp()
+    firmware = os.urandom(size)
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(flasher.ZIGATE_BINARY_VERSION + firmware)
+    try:
+        with redirect_stdout(StringIO()):
+            flasher.negotiate_baudrate(ser)
+            t1 = time()
+            flasher.write_file_to_flash(ser, path, window)
+            write_time = time() - t1
+            t1 = time()
+            bad = flasher.verify_flash(ser, firmware)
+            verify_time = time() - t1
+    finally:
+        ser.close()
+        simulator.close()
+        os.remove(path)
+    return write_time, verify_time, bad
+
+
+if __name__ == '__main__':
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.001
+    window = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 160 * 1024
+    write_time, verify_time, bad = benchmark(latency, window, size)
+    print('{} bytes, latency {:.1f}ms, window {}'.format(size, latency * 1000, window))
+    print('write  : {:.2f}s ({:.0f} bytes/s)'.format(write_time, size / write_time))
+    result = 'ok' if not bad else 'failed'
+    print('verify : {:.2f}s ({:.0f} bytes/s) {}'.format(verify_time, size / verify_time, result))
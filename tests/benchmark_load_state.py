@@ -0,0 +1,71 @@
+'''
+ZiGate load_state benchmark
+-------------------------
+Compare startup time of eager and lazy persistent file loading
+
+python3 -m tests.benchmark_load_state [devices_count]
+'''
+
+import os
+import sys
+import json
+import tempfile
+from time import time
+from zigate import ZiGate
+
+
+def generate_state(path, count=400):
+    devices = []
+    for i in range(count):
+        addr = '{:04x}'.format(i + 1)
+        clusters = [{'cluster': 0x0000,
+                     'attributes': [{'attribute': 0x0004, 'data': 'LUMI'},
+                                    {'attribute': 0x0005, 'data': 'lumi.weather'},
+                                    {'attribute': 0xff01,
+                                     'data': '0121c70b0421a8010521090006240100000000642932096521851c66'},
+                                    ]},
+                    {'cluster': 0x0402,
+                     'attributes': [{'attribute': 0x0000, 'data': 2227}]},
+                    {'cluster': 0x0403,
+                     'attributes': [{'attribute': 0x0000, 'data': 977},
+                                    {'attribute': 0x0010, 'data': 9777}]},
+                    {'cluster': 0x0405,
+                     'attributes': [{'attribute': 0x0000, 'data': 3503}]},
+                    ]
+        devices.append({'addr': addr,
+                        'info': {'addr': addr,
+                                 'ieee': '{:016x}'.format(0x158d0000000000 + i),
+                                 'power_type': 0,
+                                 'rssi': 255},
+                        'endpoints': [{'endpoint': 1,
+                                       'profile': 260,
+                                       'device': 24321,
+                                       'in_clusters': [0, 3, 0xffff, 0x0402, 0x0403, 0x0405],
+                                       'out_clusters': [0, 4, 0xffff],
+                                       'clusters': clusters}]
+                        })
+    with open(path, 'w') as fp:
+        json.dump({'devices': devices, 'groups': {}, 'scenes': {}}, fp)
+
+
+def benchmark(path, lazy, repeat=5):
+    best = None
+    for i in range(repeat):
+        z = ZiGate(auto_start=False)
+        t1 = time()
+        z.load_state(path, lazy=lazy)
+        duration = time() - t1
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    path = os.path.join(tempfile.mkdtemp(), 'zigate.json')
+    generate_state(path, count)
+    eager = benchmark(path, False)
+    lazy = benchmark(path, True)
+    print('{} devices'.format(count))
+    print('eager load_state : {:.4f}s'.format(eager))
+    print('lazy load_state  : {:.4f}s ({:.1f}x faster)'.format(lazy, eager / lazy))
+    os.remove(path)
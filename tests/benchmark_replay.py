@@ -0,0 +1,42 @@
+'''
+ZiGate replay benchmark
+-------------------------
+Replay a capture (see ZiGate.start_capture) as fast as possible
+and measure decode, interpret and dispatch throughput
+
+python3 -m tests.benchmark_replay capture_file [realtime]
+'''
+
+import sys
+import os
+import tempfile
+from time import time, sleep
+from zigate import ZiGateReplay, dispatcher, ZIGATE_RESPONSE_RECEIVED
+from zigate.transport import read_capture, CAPTURE_IN
+
+
+def benchmark(capture, realtime=False):
+    expected = sum([data.count(b'\x03') for t, direction, data in read_capture(capture)
+                    if direction == CAPTURE_IN])
+    responses = [0]
+
+    def received(**kwargs):
+        responses[0] += 1
+    dispatcher.connect(received, ZIGATE_RESPONSE_RECEIVED, weak=False)
+    path = os.path.join(tempfile.mkdtemp(), 'zigate.json')
+    t1 = time()
+    z = ZiGateReplay(capture, realtime, path=path)
+    z.connection.done.wait()
+    while responses[0] < expected and (not z.connection.received.empty() or time() - t1 < 1):
+        sleep(0.001)
+    duration = time() - t1
+    z.close()
+    return expected, responses[0], duration
+
+
+if __name__ == '__main__':
+    capture = sys.argv[1]
+    realtime = len(sys.argv) > 2 and sys.argv[2] == 'realtime'
+    expected, count, duration = benchmark(capture, realtime)
+    rate = count / duration
+    print('{}/{} packets replayed in {:.2f}s ({:.0f} packets/s)'.format(count, expected, duration, rate))
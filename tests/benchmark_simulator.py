@@ -0,0 +1,78 @@
+'''
+ZiGate end-to-end benchmark
+-------------------------
+Start ZiGate (or ZiGateWiFi) on a simulated firmware and measure
+report-to-signal latency and sustained reports per second
+
+python3 -m tests.benchmark_simulator [devices] [rate] [count] [serial|wifi]
+rate 0 means as fast as possible
+'''
+
+import sys
+import os
+import tempfile
+from collections import deque
+from time import time, sleep
+from zigate import (ZiGate, ZiGateWiFi, dispatcher,
+                    ZIGATE_ATTRIBUTE_ADDED, ZIGATE_ATTRIBUTE_UPDATED)
+from zigate.simulator import ZiGateSimulator
+
+
+class TimedSimulator(ZiGateSimulator):
+    '''
+    keep emission time of each report
+    '''
+    def __init__(self, *args, **kwargs):
+        ZiGateSimulator.__init__(self, *args, **kwargs)
+        self.times = deque()
+
+    def report(self, addr, value):
+        self.times.append(time())
+        return ZiGateSimulator.report(self, addr, value)
+
+
+def benchmark(devices, rate, count, mode):
+    simulator = TimedSimulator(devices, tcp_port=0 if mode == 'wifi' else None)
+    simulator.start()
+    path = os.path.join(tempfile.mkdtemp(), 'zigate.json')
+    t1 = time()
+    if mode == 'wifi':
+        z = ZiGateWiFi('127.0.0.1', simulator.tcp_port, path=path, auto_save=False)
+    else:
+        z = ZiGate(simulator.port, path=path, auto_save=False)
+    start_time = time() - t1
+
+    latencies = []
+
+    def received(**kwargs):
+        latencies.append(time() - simulator.times.popleft())
+    dispatcher.connect(received, ZIGATE_ATTRIBUTE_ADDED, weak=False)
+    dispatcher.connect(received, ZIGATE_ATTRIBUTE_UPDATED, weak=False)
+
+    t1 = time()
+    simulator.start_reports(rate, count).join()
+    while len(latencies) < count and time() - t1 < 60 + count / 100:
+        sleep(0.01)
+    duration = time() - t1
+
+    z.close()
+    simulator.close()
+    latencies.sort()
+    return start_time, duration, latencies
+
+
+if __name__ == '__main__':
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    mode = sys.argv[4] if len(sys.argv) > 4 else 'serial'
+    start_time, duration, latencies = benchmark(devices, rate, count, mode)
+    print('{} devices, {} reports, rate {} ({})'.format(devices, count, rate or 'max', mode))
+    print('start     : {:.2f}s'.format(start_time))
+    rate = len(latencies) / duration
+    print('received  : {} reports in {:.2f}s ({:.0f} reports/s)'.format(len(latencies), duration, rate))
+    if latencies:
+        print('latency   : median {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms'.format(
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+            latencies[-1] * 1000))
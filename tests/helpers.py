@@ -0,0 +1,98 @@
+'''
+ZiGate Tests helpers
+-------------------------
+'''
+
+import queue
+import struct
+from time import time, sleep
+from zigate import ZiGate
+from zigate.simulator import zigate_frame
+
+
+def wait_for(func, timeout=2):
+    '''
+    return True as soon as func() is true, False after timeout
+    '''
+    start = time()
+    while time() - start < timeout:
+        if func():
+            return True
+        sleep(0.01)
+    return False
+
+
+class FakeConnection(object):
+    '''
+    fake transport keeping sent frames
+    if answer, commands are answered:
+    status (0x8000) is given by status(data) (default success),
+    responses with sequence are given in responses by command type
+    and responses without sequence in plain_responses
+    if threaded, answers are decoded by zigate event loop
+    '''
+    def __init__(self, zigate, responses=None, plain_responses=None, status=None, threaded=False, answer=True):
+        self.zigate = zigate
+        self.answer = answer
+        self.responses = responses or {}
+        self.plain_responses = plain_responses or {}
+        self.status = status or (lambda data: 0)
+        self.threaded = threaded
+        self.sent = []
+        self.sequence = 0
+        self.received = queue.Queue()
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+    def send(self, data):
+        self.sent.append(data)
+        if not self.answer:
+            return
+        msg_type, data = self.decode(data)
+        self.sequence += 1
+        self.receive(0x8000, struct.pack('!BBH', self.status(data), self.sequence, msg_type))
+        if msg_type in self.responses:
+            self.receive(msg_type + 0x8000, struct.pack('!B', self.sequence) + self.responses[msg_type])
+        if msg_type in self.plain_responses:
+            self.receive(msg_type + 0x8000, self.plain_responses[msg_type])
+
+    def decode(self, frame):
+        '''
+        return type and data of a sent frame
+        '''
+        decoded = self.zigate.zigate_decode(frame[1:-1])
+        msg_type, length = struct.unpack('!HH', decoded[:4])
+        return msg_type, bytes(decoded[5:5 + length])
+
+    def sent_commands(self):
+        return [self.decode(frame) for frame in self.sent]
+
+    def sent_types(self):
+        return [msg_type for msg_type, data in self.sent_commands()]
+
+    def receive(self, msg_type, value, rssi=255):
+        packet = zigate_frame(msg_type, value, rssi)
+        if self.threaded:
+            self.received.put(packet)
+        else:
+            self.zigate.decode_data(packet)
+
+
+class FakeZiGate(ZiGate):
+    '''
+    zigate without transport, keeps sent and decoded packets
+    commands are not answered
+    '''
+    def __init__(self):
+        ZiGate.__init__(self, auto_start=False)
+        self.connection = FakeConnection(self, answer=False)
+        self.sent = self.connection.sent
+        self.decoded = []
+
+    def decode_data(self, packet):
+        self.decoded.append(packet)
+        ZiGate.decode_data(self, packet)
@@ -0,0 +1,203 @@
+'''
+ZiGate Broker Tests
+-------------------------
+'''
+
+import unittest
+import socket
+import json
+import threading
+import time
+from collections import deque
+from pydispatch import dispatcher
+from zigate import broker
+from zigate.const import ZIGATE_PACKET_RECEIVED
+from zigate.simulator import zigate_frame as frame
+from .helpers import FakeZiGate, wait_for
+
+
+class TestBroker(unittest.TestCase):
+    def setUp(self):
+        self.zigate = FakeZiGate()
+        self.clients = []
+        self.broker = None
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        if self.broker:
+            self.broker.exit()
+            self.broker.join(2)
+        self.zigate.close()
+
+    def start_broker(self, **kwargs):
+        self.broker = broker.Broker(self.zigate, 0, '127.0.0.1', **kwargs)
+        self.broker.start()
+
+    def connect(self, count=1):
+        n = len(self.broker.users)
+        for i in range(count):
+            client = socket.create_connection(('127.0.0.1', self.broker.port))
+            client.settimeout(2)
+            self.clients.append(client)
+        self.assertTrue(wait_for(lambda: len(self.broker.users) == n + count))
+        return self.clients[-count:]
+
+    def recv(self, client, size):
+        data = b''
+        while len(data) < size:
+            data += client.recv(size - len(data))
+        return data
+
+    def test_drop(self):
+        self.start_broker(buffer_size=10)
+        client, = self.connect()
+        self.broker.forward_msg(b'\x01' + b'1' * 20 + b'\x03')
+        self.broker.forward_msg(b'\x011234\x03')
+        self.assertEqual(self.recv(client, 6), b'\x011234\x03')
+        self.assertTrue(wait_for(lambda: self.broker.metrics()['users'][0]['sent'] == 6))
+        self.assertEqual(self.broker.metrics()['dropped'], 1)
+
+    def test_forward(self):
+        self.start_broker()
+        client1, client2 = self.connect(2)
+        self.broker.zigate.decode_data(b'\x011234\x03')
+        self.assertEqual(self.recv(client1, 6), b'\x011234\x03')
+        self.assertEqual(self.recv(client2, 6), b'\x011234\x03')
+        client1.sendall(b'\x015678\x03')
+        self.assertTrue(wait_for(lambda: self.zigate.sent == [b'\x015678\x03']))
+        client1.close()
+        self.assertTrue(wait_for(lambda: len(self.broker.users) == 1))
+        self.assertEqual(self.broker.metrics()['disconnected'], 1)
+
+    def test_disconnect_slow_client(self):
+        self.start_broker(buffer_size=4, policy=broker.BROKER_POLICY_DISCONNECT)
+        client, = self.connect()
+        self.broker.forward_msg(b'\x011234\x03')
+        self.assertEqual(client.recv(10), b'')
+        self.assertTrue(wait_for(lambda: len(self.broker.users) == 0))
+
+    def test_multiplex(self):
+        self.start_broker()
+        client1, client2 = self.connect(2)
+        command1 = frame(0x0010)
+        command2 = frame(0x0009)
+        client1.sendall(command1[:3])
+        time.sleep(0.05)
+        client2.sendall(command2)
+        self.assertTrue(wait_for(lambda: len(self.zigate.sent) == 1))
+        client1.sendall(command1[3:])
+        self.assertTrue(wait_for(lambda: self.zigate.sent == [command2, command1]))
+        self.assertEqual(broker.frame_type(command1), 0x0010)
+        # status only sent to the client which sent the command
+        status1 = frame(0x8000, b'\x00\x01\x00\x10')
+        status2 = frame(0x8000, b'\x00\x02\x00\x09')
+        self.broker.forward_msg(status1)
+        self.broker.forward_msg(status2)
+        response = frame(0x8010, b'\x00\x03\x03\x1d')
+        self.broker.forward_msg(response)
+        self.assertEqual(self.recv(client1, len(status1 + response)), status1 + response)
+        self.assertEqual(self.recv(client2, len(status2 + response)), status2 + response)
+        self.assertEqual(self.broker.users[0].last_sequence, 1)
+
+    def test_status_of_disconnected_client(self):
+        self.start_broker()
+        client1, client2 = self.connect(2)
+        command = frame(0x0010)
+        client1.sendall(command)
+        self.assertTrue(wait_for(lambda: len(self.zigate.sent) == 1))
+        client1.close()
+        self.assertTrue(wait_for(lambda: len(self.broker.users) == 1))
+        client2.sendall(command)
+        self.assertTrue(wait_for(lambda: len(self.zigate.sent) == 2))
+        # first status still belongs to the disconnected client
+        status1 = frame(0x8000, b'\x00\x01\x00\x10')
+        status2 = frame(0x8000, b'\x00\x02\x00\x10')
+        self.broker.forward_msg(status1)
+        self.broker.forward_msg(status2)
+        self.assertEqual(self.recv(client2, len(status2)), status2)
+
+    def test_filter(self):
+        self.start_broker()
+        client1, client2, client3, client4 = self.connect(4)
+        client1.sendall(b'{"msg_types": ["8102"], "addr": ["abcd"], "clusters": [6]}\n')
+        answer = json.loads(client1.makefile('rb').readline().decode())
+        self.assertEqual(answer, {'filter': {'msg_types': [0x8102], 'addr': ['abcd'], 'clusters': [6]}})
+        # messages without address are filtered out unless their type is subscribed
+        client3.sendall(b'{"addr": ["abcd"]}\n')
+        client4.sendall(b'{"msg_types": ["8001", "8102"], "addr": ["abcd"]}\n')
+        for client in (client3, client4):
+            client.makefile('rb').readline()
+        report1 = frame(0x8102, b'\x01\xab\xcd\x01\x00\x06\x00\x00\x00\x10\x00\x01\x01')
+        report2 = frame(0x8102, b'\x01\x12\x34\x01\x00\x06\x00\x00\x00\x10\x00\x01\x01')
+        report3 = frame(0x8102, b'\x01\xab\xcd\x01\x00\x08\x00\x00\x00\x20\x00\x01\x01')
+        log = frame(0x8001, b'\x06test')
+        status = frame(0x8000, b'\x00\x01\x00\x10')
+        for f in (log, status, report2, report3, report1):
+            self.broker.forward_msg(f)
+        self.assertEqual(self.recv(client1, len(report1)), report1)
+        expected = log + status + report2 + report3 + report1
+        self.assertEqual(self.recv(client2, len(expected)), expected)
+        self.assertEqual(self.recv(client3, len(report3 + report1)), report3 + report1)
+        self.assertEqual(self.recv(client4, len(log + report3 + report1)), log + report3 + report1)
+        self.assertEqual(self.broker.metrics()['users'][0]['queued'], 0)
+
+    def test_tap(self):
+        self.start_broker(tap=True)
+        client, = self.connect()
+        log = frame(0x8001, b'\x06test')
+        # same as zigate event loop
+        dispatcher.send(ZIGATE_PACKET_RECEIVED, self.zigate, packet=log)
+        self.zigate.decode_data(log)
+        self.assertEqual(self.recv(client, len(log)), log)
+        self.assertEqual(self.zigate.decoded, [log])
+
+    def test_received_bounded(self):
+        self.broker = broker.Broker(self.zigate, 0, '127.0.0.1', tap=True)
+        self.broker._received = deque(maxlen=10)
+        # broker thread not started yet, frames wait in the bounded queue
+        log = frame(0x8001, b'\x06test')
+        for i in range(25):
+            dispatcher.send(ZIGATE_PACKET_RECEIVED, self.zigate, packet=log)
+        self.assertEqual(len(self.broker._received), 10)
+        self.assertEqual(self.broker.metrics()['overflow'], 15)
+        self.broker.start()
+        self.assertTrue(wait_for(lambda: not self.broker._received))
+
+    def test_incoming_bounded(self):
+        self.start_broker()
+        client, = self.connect()
+        client.sendall(b'\x015678\x03')
+        self.assertTrue(wait_for(lambda: self.zigate.sent == [b'\x015678\x03']))
+        # frame never ends, client is disconnected
+        client.sendall(b'\x01' + b'1' * broker.BROKER_MAX_INCOMING)
+        self.assertTrue(wait_for(lambda: len(self.broker.users) == 0))
+        self.assertEqual(self.broker.metrics()['incoming_overflow'], 1)
+        self.assertEqual(self.zigate.sent, [b'\x015678\x03'])
+
+    def test_tap_status(self):
+        self.start_broker(tap=True)
+        client, = self.connect()
+        client.sendall(frame(0x0010))
+        self.assertTrue(wait_for(lambda: len(self.zigate.sent) == 1))
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.zigate.send_data(0x0010)))
+        thread.start()
+        self.assertTrue(wait_for(lambda: len(self.zigate.sent) == 2))
+        # client command status is only sent to the client, local one is decoded
+        status1 = frame(0x8000, b'\x00\x01\x00\x10')
+        status2 = frame(0x8000, b'\x05\x02\x00\x10')
+        for status in (status1, status2):
+            dispatcher.send(ZIGATE_PACKET_RECEIVED, self.zigate, packet=status)
+            self.zigate.decode_data(status)
+        thread.join()
+        self.assertEqual(result, [5])
+        # client status is not decoded by zigate
+        self.assertEqual(self.zigate._last_response[0x8000]['sequence'], 2)
+        self.assertEqual(self.recv(client, len(status1)), status1)
+        client.settimeout(0.2)
+        self.assertRaises(socket.timeout, client.recv, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,8 +5,16 @@ ZiGate core Tests
 
 import unittest
 import os
+import struct
+import json
+import shutil
 import tempfile
-from zigate import ZiGate
+import threading
+from collections import deque
+import time
+from zigate import core, ZiGate, dispatcher, ZIGATE_DEVICE_UPDATED
+from zigate.core import Device, DeviceEncoder, TYPE_COORDINATOR
+from .helpers import FakeConnection
 
 
 class TestCore(unittest.TestCase):
@@ -14,6 +22,10 @@ class TestCore(unittest.TestCase):
         self.zigate = ZiGate(auto_start=False)
         self.test_dir = tempfile.mkdtemp()
 
+    def tearDown(self):
+        self.zigate.close()
+        shutil.rmtree(self.test_dir)
+
     def test_persistent(self):
         path = os.path.join(self.test_dir, 'test_zigate.json')
         backup_path = path + '.0'
@@ -40,6 +52,267 @@ class TestCore(unittest.TestCase):
         os.remove(path)
         os.remove(backup_path)
 
+    def test_lazy_load(self):
+        path = os.path.join(self.test_dir, 'test_zigate.json')
+        device = Device({'addr': '1234', 'ieee': '0123456789abcdef'}, self.zigate)
+        device.set_attribute(1, 0x0000, {'attribute': 0x0005, 'data': 'test'})
+        self.zigate._devices['1234'] = device
+        self.zigate.save_state(path)
+
+        zigate = ZiGate(auto_start=False)
+        self.addCleanup(zigate.close)
+        result = zigate.load_state(path, lazy=True)
+        self.assertTrue(result)
+        self.assertFalse(zigate._devices.is_loaded('1234'))
+        zigate.save_state(path)  # no need to materialise for saving
+        self.assertFalse(zigate._devices.is_loaded('1234'))
+        with open(path) as fp:
+            data = json.load(fp)
+        self.assertEqual(list(data.keys()), sorted(data.keys()))
+        self.assertEqual(data['devices'][0]['info']['addr'], '1234')
+
+        device = zigate.get_device_from_ieee('0123456789abcdef')
+        self.assertTrue(zigate._devices.is_loaded('1234'))
+        self.assertEqual(device.addr, '1234')
+        self.assertEqual(device.get_property_value('type'), 'test')
+        self.assertIs(zigate.get_device_from_addr('1234'), device)
+
+    def test_lazy_load_concurrent(self):
+        path = os.path.join(self.test_dir, 'test_zigate.json')
+        for i in range(50):
+            addr = '{:04x}'.format(i)
+            device = Device({'addr': addr, 'ieee': '{:016x}'.format(i)}, self.zigate)
+            device.set_attribute(1, 0x0000, {'attribute': 0x0005, 'data': 'test'})
+            self.zigate._devices[addr] = device
+        self.zigate.save_state(path)
+        zigate = ZiGate(auto_start=False)
+        self.addCleanup(zigate.close)
+        zigate.load_state(path, lazy=True)
+        # devices are complete, no need to materialise them
+        zigate.need_refresh()
+        self.assertFalse(any([zigate._devices.is_loaded(addr) for addr in zigate._devices]))
+
+        barrier = threading.Barrier(8)
+        found = []
+
+        def get_devices():
+            barrier.wait()
+            found.append([zigate.get_device_from_addr('{:04x}'.format(i)) for i in range(50)])
+        threads = [threading.Thread(target=get_devices) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for devices in found:
+            for device, expected in zip(devices, found[0]):
+                self.assertIs(device, expected)
+
+    def test_lazy_device_updated(self):
+        path = os.path.join(self.test_dir, 'test_zigate.json')
+        self.zigate._devices['1234'] = Device({'addr': '1234', 'ieee': '0123456789abcdef'}, self.zigate)
+        self.zigate.save_state(path)
+        zigate = ZiGate(auto_start=False)
+        self.addCleanup(zigate.close)
+        zigate.load_state(path, lazy=True)
+        response = struct.pack('!BHQBB', 1, 0x1234, 0x0123456789abcdef, 1, 200)
+        connection = FakeConnection(zigate)
+        connection.receive(0x8015, response)
+        self.assertFalse(zigate._devices.is_loaded('1234'))  # nobody listening
+
+        updated = []
+
+        def device_updated(device, **kwargs):
+            updated.append(device)
+        dispatcher.connect(device_updated, ZIGATE_DEVICE_UPDATED, zigate)
+        try:
+            # unchanged or only rssi changed, still lazy
+            connection.receive(0x8015, response)
+            connection.receive(0x8015, struct.pack('!BHQBB', 1, 0x1234, 0x0123456789abcdef, 1, 180))
+            self.assertFalse(zigate._devices.is_loaded('1234'))
+            self.assertEqual(updated, [])
+            # power source changed
+            connection.receive(0x8015, struct.pack('!BHQBB', 1, 0x1234, 0x0123456789abcdef, 0, 180))
+        finally:
+            dispatcher.disconnect(device_updated, ZIGATE_DEVICE_UPDATED, zigate)
+        self.assertEqual(len(updated), 1)
+        self.assertEqual(updated[0].addr, '1234')
+        self.assertEqual(updated[0].info['rssi'], 180)
+
+    def test_fast_start(self):
+        extend_pan = 0x1234567890abcdef
+        network_state = struct.pack('!HQHQB', 0, 0x00158d0000000001, 0x1234, extend_pan, 11)
+        plain_responses = {0x0010: struct.pack('!HH', 1, 0x031d),
+                           0x0009: network_state,
+                           0x0015: b''}
+        # network already configured, channel and type setup skipped
+        self.zigate._network = {'extend_pan': extend_pan,
+                                'channels': self.zigate._channels_list(),
+                                'type': TYPE_COORDINATOR}
+        self.zigate.connection = FakeConnection(self.zigate, plain_responses=plain_responses)
+        self.zigate._fast_start()
+        self.assertEqual(self.zigate.connection.sent_types(), [0x0010, 0x0009, 0x0016, 0x0015])
+        self.assertEqual(self.zigate.get_version_text(), '3.1d')
+
+        # persisted network differs, configure it
+        for network in ({}, {'extend_pan': 1, 'channels': self.zigate._channels_list(), 'type': TYPE_COORDINATOR}):
+            self.zigate._network = network
+            self.zigate.connection = FakeConnection(self.zigate, plain_responses=plain_responses)
+            self.zigate._fast_start()
+            self.assertEqual(self.zigate.connection.sent_types(),
+                             [0x0010, 0x0009, 0x0021, 0x0023, 0x0024, 0x0009, 0x0016, 0x0015])
+            self.assertEqual(self.zigate._network, {'extend_pan': extend_pan,
+                                                    'channel': 11,
+                                                    'channels': self.zigate._channels_list(),
+                                                    'type': TYPE_COORDINATOR})
+
+    def test_template(self):
+        device = Device({'addr': '1234', 'ieee': '0123456789abcdef'}, self.zigate)
+        endpoint = device.get_endpoint(1)
+        endpoint.update({'profile': 260, 'device': 0x0100, 'in_clusters': [0, 6], 'out_clusters': []})
+        device.set_attribute(1, 0x0000, {'attribute': 0x0004, 'data': 'IKEA'})
+        device.set_attribute(1, 0x0000, {'attribute': 0x0005, 'data': 'bulb'})
+        device.set_attribute(1, 0x0006, {'attribute': 0x0000, 'data': True})
+        self.zigate._devices['1234'] = device
+        self.zigate._update_template('1234')
+        template = self.zigate._templates['IKEA/bulb']
+        self.assertEqual(template['endpoints'][0]['in_clusters'], [0, 6])
+        self.assertIn((6, 0), template['endpoints'][0]['attributes'])
+
+        device = Device({'addr': 'abcd', 'ieee': '0123456789abcdee'}, self.zigate)
+        device.set_attribute(1, 0x0000, {'attribute': 0x0004, 'data': 'IKEA'})
+        device.set_attribute(1, 0x0000, {'attribute': 0x0005, 'data': 'bulb'})
+        self.zigate._devices['abcd'] = device
+        self.assertTrue(self.zigate._apply_template('abcd'))
+        self.assertEqual(device.endpoints[1]['device'], 0x0100)
+        self.assertEqual(device.endpoints[1]['in_clusters'], [0, 6])
+
+        # binds of the first device don't restrict binds of the others
+        self.zigate.connection = FakeConnection(self.zigate, {0x0030: b'\x00',
+                                                              0x0120: b'\xab\xcd\x01\x00\x06\x00'})
+        self.zigate._ieee = '0123456789abcdee'
+        self.zigate._setup_endpoint(device, 1, template=True)
+        self.assertIn(0x0030, self.zigate.connection.sent_types())
+        self.assertEqual(device.endpoints[1]['bound'], [6])
+
+    def test_template_update_delay(self):
+        core.TEMPLATE_UPDATE_DELAY = 0.05
+        updated = []
+        self.zigate._update_template = updated.append
+        try:
+            for i in range(10):
+                self.zigate._schedule_template_update('1234')
+            self.zigate._schedule_template_update('abcd')
+            time.sleep(0.2)
+        finally:
+            core.TEMPLATE_UPDATE_DELAY = 10
+        self.assertEqual(sorted(updated), ['1234', 'abcd'])
+
+    def test_reporting_request(self):
+        data = self.zigate._reporting_data('1234', 1, 0x0300, [(0x0000, 0x20, 1, 300, 1),
+                                                               (0x0007, 0x21)])
+        self.assertEqual(data, bytes.fromhex('02123401010300'
+                                             '00000000'
+                                             '02'
+                                             '002000000001012c000001'
+                                             '0021000700000000000000'))
+
+    def test_bind_report(self):
+        # bind response status success, reporting response
+        self.zigate.connection = FakeConnection(self.zigate, {0x0030: b'\x00',
+                                                              0x0120: b'\x12\x34\x01\x03\x00\x00'})
+        self.zigate._ieee = '0123456789abcdee'
+        device = Device({'addr': '1234', 'ieee': '0123456789abcdef'}, self.zigate)
+        endpoint = device.get_endpoint(1)
+        endpoint.update({'profile': 260, 'device': 0x0210, 'in_clusters': [0, 6, 8, 0x0300], 'out_clusters': []})
+        self.zigate._devices['1234'] = device
+        device._bind_report(1)
+        self.assertEqual(endpoint['bound'], [6, 8, 0x0300])
+        # 3 bind + 3 configure reporting
+        self.assertEqual(len(self.zigate.connection.sent), 6)
+        self.assertEqual(endpoint['reporting'][6], [[0, 0x10, 0, 300, 0]])
+        # already configured, nothing sent
+        device._bind_report(1)
+        self.assertEqual(len(self.zigate.connection.sent), 6)
+        # configuration is persisted
+        device2 = Device.from_json(device.to_json(), self.zigate)
+        self.assertEqual(device2.get_endpoint(1)['bound'], [6, 8, 0x0300])
+        self.assertEqual(device2.get_endpoint(1)['reporting'], endpoint['reporting'])
+        self.zigate.bind_report('1234', force=True)
+        self.assertEqual(len(self.zigate.connection.sent), 12)
+        # device joins again after a reset, configuration is forgotten
+        self.zigate.connection.receive(0x004D, struct.pack('!HQB', 0x1234, 0x0123456789abcdef, 0x8e))
+        self.assertEqual(endpoint['bound'], [])
+        self.assertEqual(endpoint['reporting'], {})
+        # joins again with another addr, unfinished interview follows the device
+        self.zigate.connection.receive(0x004D, struct.pack('!HQB', 0x5678, 0x0123456789abcdef, 0x8e))
+        self.assertIs(self.zigate.get_device_from_addr('5678'), device)
+        self.assertFalse(self.zigate._interviews.is_pending('1234'))
+        self.assertTrue(self.zigate._interviews.is_pending('5678'))
+        self.zigate._interviews.stop()
+
+    def test_status_routing(self):
+        # status of each request is its data, answers are decoded by event loop
+        self.zigate.connection = FakeConnection(self.zigate, status=lambda data: data[0], threaded=True)
+        results = {}
+
+        def batch():
+            results['batch'] = self.zigate._send_batch(0x0099, [b'\x01', b'\x02', b'\x03'] * 10)
+
+        def single():
+            results['single'] = [self.zigate.send_data(0x0099, b'\x04') for i in range(10)]
+
+        def pipelined():
+            calls = [(self.zigate.send_data, (0x0099, b'\x05')), (self.zigate.send_data, (0x0099, b'\x06'))]
+            results['pipelined'] = self.zigate.run_pipelined(calls * 10)
+        threads = [threading.Thread(target=func) for func in (batch, single, pipelined)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results['batch'], [1, 2, 3] * 10)
+        self.assertEqual(results['single'], [4] * 10)
+        self.assertEqual(results['pipelined'], [5, 6] * 10)
+        self.assertEqual(self.zigate._pending_status[0x0099], deque())
+
+    def test_pipelined_add_group(self):
+        # device 1234 accepts group, abcd rejects it
+        self.zigate.connection = FakeConnection(self.zigate, threaded=True,
+                                                status=lambda data: 0 if data[1:3] == b'\x12\x34' else 0x8b)
+        groups = []
+
+        def add_group(addr):
+            self.zigate.add_group(addr, 1, '0001')
+            groups.append(dict(self.zigate.groups))
+        results = self.zigate.run_pipelined([(add_group, ('1234',)), (add_group, ('abcd',)),
+                                             (self.zigate.get_network_state, ())])
+        # not recorded before its status
+        self.assertEqual(groups, [{}, {}])
+        self.assertEqual(results[:2], [0, 0x8b])
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual(self.zigate.groups, {'0001': {('1234', 1)}})
+        self.assertEqual(self.zigate.connection.sent_types(), [0x0060, 0x0060])
+
+    def test_json_cache(self):
+        device = Device({'addr': '1234', 'ieee': '0123456789abcdef'}, self.zigate)
+        device.set_attribute(1, 0x0402, {'attribute': 0x0000, 'data': 2227})
+        data = device.to_json_bytes()
+        self.assertIs(device.to_json_bytes(), data)
+        self.assertEqual(json.loads(data.decode()), json.loads(json.dumps(device, cls=DeviceEncoder)))
+        device.set_attribute(1, 0x0402, {'attribute': 0x0000, 'data': 2300})
+        self.assertIsNot(device.to_json_bytes(), data)
+        self.assertIn(b'2300', device.to_json_bytes())
+        # persistence use the same cache
+        self.zigate._devices['1234'] = device
+        path = os.path.join(self.test_dir, 'test_zigate.json')
+        self.zigate.save_state(path)
+        with open(path) as fp:
+            state = json.load(fp)
+        self.assertEqual(state['devices'][0]['addr'], '1234')
+        self.assertIn('groups', state)
+        self.zigate._devices.clear()
+        self.zigate.load_state(path)
+        self.assertEqual(self.zigate.get_device_from_addr('1234').get_attribute(1, 0x0402, 0x0000)['data'], 2300)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,157 @@
+'''
+ZiGate Flasher Tests
+-------------------------
+'''
+
+import unittest
+import os
+import struct
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from zigate import flasher
+from zigate.simulator import BootloaderSimulator
+import serial
+
+
+@unittest.skipIf(not hasattr(os, 'openpty'), 'pty not available')
+class TestFlasher(unittest.TestCase):
+    def setUp(self):
+        self.simulator = BootloaderSimulator()
+        self.simulator.start()
+        self.ser = serial.Serial(self.simulator.port, 38400, timeout=2)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.firmware = os.urandom(1000) + b'\xff' * 256 + os.urandom(200)
+        with open(self.path, 'wb') as fp:
+            fp.write(flasher.ZIGATE_BINARY_VERSION + self.firmware)
+
+    def tearDown(self):
+        self.ser.close()
+        self.simulator.close()
+        os.remove(self.path)
+
+    def write(self, **kwargs):
+        with redirect_stdout(StringIO()) as output:
+            try:
+                flasher.write_file_to_flash(self.ser, self.path, **kwargs)
+            except SystemExit:
+                pass
+        return output.getvalue()
+
+    def diff(self, reference=None):
+        with redirect_stdout(StringIO()) as output:
+            flasher.write_diff_to_flash(self.ser, self.path, reference, window=4)
+        return output.getvalue()
+
+    def test_write(self):
+        self.write(window=4)
+        self.assertEqual(bytes(self.simulator.flash[:len(self.firmware)]), self.firmware)
+        # empty blocks skipped
+        self.assertNotIn(1024, self.simulator.writes)
+        self.assertEqual(len(self.simulator.writes), 11)
+        self.assertEqual(self.ser.in_waiting, 0)
+
+    def test_resume(self):
+        self.simulator.fail_at = 512
+        output = self.write(window=4)
+        self.assertIn('--offset 0x00000200', output)
+        # responses (4 bytes) of write requests sent after the failed one
+        self.assertEqual(len(self.ser.read(3 * 4)), 3 * 4)
+        self.simulator.fail_at = None
+        self.simulator.writes = []
+        self.write(window=4, offset=512)
+        self.assertEqual(self.simulator.writes[0], 512)
+        self.assertEqual(bytes(self.simulator.flash[:len(self.firmware)]), self.firmware)
+
+    def test_diff(self):
+        self.write()
+        firmware = bytearray(self.firmware + os.urandom(flasher.ZIGATE_SECTOR_SIZE * 2))
+        with open(self.path, 'wb') as fp:
+            fp.write(flasher.ZIGATE_BINARY_VERSION + firmware)
+        self.write()
+        reference = self.path + '.dump'
+        with open(reference, 'wb') as fp:
+            fp.write(flasher.ZIGATE_BINARY_VERSION + firmware)
+        firmware[flasher.ZIGATE_SECTOR_SIZE + 10] ^= 0xff
+        with open(self.path, 'wb') as fp:
+            fp.write(flasher.ZIGATE_BINARY_VERSION + firmware)
+        for ref in (reference, None):
+            self.simulator.writes = []
+            self.assertIn('verify ok', self.diff(ref))
+            if ref:
+                # only second sector rewritten
+                self.assertEqual(len(self.simulator.writes), flasher.ZIGATE_SECTOR_SIZE // flasher.ZIGATE_BLOCK_SIZE)
+                self.assertEqual(self.simulator.writes[0], flasher.ZIGATE_SECTOR_SIZE)
+            else:  # nothing changed since
+                self.assertEqual(self.simulator.writes, [])
+            self.assertEqual(bytes(self.simulator.flash[:len(firmware)]), bytes(firmware))
+        os.remove(reference)
+        # corrupted write detected
+        self.simulator.flash[100] ^= 0xff
+        with redirect_stdout(StringIO()):
+            self.assertEqual(flasher.verify_flash(self.ser, bytes(firmware)), [0])
+
+    def test_diff_shorter(self):
+        firmware = bytearray(os.urandom(flasher.ZIGATE_SECTOR_SIZE * 2 + 100))
+        firmware[0x20:0x24] = struct.pack('>L', len(firmware))
+        reference = self.path + '.dump'
+        with open(reference, 'wb') as fp:
+            fp.write(flasher.ZIGATE_BINARY_VERSION + firmware)
+        shorter = firmware[:1000]
+        shorter[0x20:0x24] = struct.pack('>L', len(shorter))
+        with open(self.path, 'wb') as fp:
+            fp.write(flasher.ZIGATE_BINARY_VERSION + shorter)
+        for ref in (reference, None):
+            self.simulator.flash[:len(firmware)] = firmware
+            output = self.diff(ref)
+            self.assertIn('3/3 sectors changed', output)
+            self.assertIn('verify ok', output)
+            # old firmware tail is erased
+            self.assertEqual(bytes(self.simulator.flash[:len(firmware)]),
+                             shorter + b'\xff' * (len(firmware) - len(shorter)))
+        os.remove(reference)
+
+    def test_diff_without_sector_erase(self):
+        self.simulator.sector_erase = False
+        output = self.diff()
+        self.assertIn('writing whole flash', output)
+        self.assertIn('verify ok', output)
+        self.assertEqual(bytes(self.simulator.flash[:len(self.firmware)]), self.firmware)
+
+    def test_flash(self):
+        with redirect_stdout(StringIO()) as output:
+            self.assertEqual(flasher.negotiate_baudrate(self.ser), 1000000)
+            flasher.check_chip_id(self.ser)
+            flash_type = flasher.get_flash_type(self.ser)
+            self.assertEqual(flasher.get_mac(self.ser), '00:15:8d:00:01:02:03:04')
+            flasher.select_flash(self.ser, flash_type)
+            firmware = bytearray(os.urandom(5000))
+            firmware[0x20:0x24] = struct.pack('>L', len(firmware))
+            with open(self.path, 'wb') as fp:
+                fp.write(flasher.ZIGATE_BINARY_VERSION + firmware)
+            flasher.write_file_to_flash(self.ser, self.path, window=8)
+            self.assertEqual(flasher.verify_flash(self.ser, bytes(firmware)), [])
+            flasher.write_flash_to_file(self.ser, self.path)
+        self.assertEqual(self.simulator.baudrate, 1000000)
+        self.assertEqual(bytes(self.simulator.flash[:len(firmware)]), bytes(firmware))
+        self.assertEqual(flasher.read_image(self.path), bytes(firmware))
+        self.assertIn('40 blocks written', output.getvalue())
+
+    def test_baudrate_fallback(self):
+        self.simulator.max_baudrate = 500000
+        self.ser.timeout = 0.5
+        with redirect_stdout(StringIO()) as output:
+            self.assertEqual(flasher.negotiate_baudrate(self.ser), 500000)
+            flasher.check_chip_id(self.ser)
+        self.assertIn('No answer at baudrate 1000000', output.getvalue())
+        self.assertEqual(self.simulator.baudrate, 500000)
+        # only default baudrate works
+        self.simulator.max_baudrate = 50000
+        with redirect_stdout(StringIO()):
+            self.assertEqual(flasher.negotiate_baudrate(self.ser), 38400)
+            flasher.check_chip_id(self.ser)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+'''
+ZiGate interview Tests
+-------------------------
+'''
+
+import unittest
+import threading
+from zigate import interview
+from .helpers import wait_for
+
+
+class InterviewZiGate(object):
+    '''
+    records interview requests instead of sending commands
+    '''
+    def __init__(self):
+        self.requests = []
+        self.templates = {}
+        self.devices = {}
+
+    def node_descriptor_request(self, addr):
+        self.requests.append((interview.STEP_NODE_DESCRIPTOR, addr))
+
+    def _model_request(self, addr):
+        self.requests.append((interview.STEP_MODEL, addr))
+
+    def _apply_template(self, addr):
+        return self.templates.get(addr)
+
+    def _update_template(self, addr):
+        pass
+
+    def active_endpoint_request(self, addr):
+        self.requests.append((interview.STEP_ACTIVE_ENDPOINT, addr))
+
+    def simple_descriptor_request(self, addr, endpoint):
+        self.requests.append((interview.STEP_SIMPLE_DESCRIPTOR, addr, endpoint))
+
+    def get_device_from_addr(self, addr):
+        return self.devices.get(addr)
+
+    def _setup_endpoint(self, device, endpoint, template=False):
+        self.requests.append((interview.STEP_SETUP, device.addr, endpoint, threading.current_thread().name))
+
+
+class TestInterview(unittest.TestCase):
+    def setUp(self):
+        self.zigate = InterviewZiGate()
+        self.manager = interview.InterviewManager(self.zigate, concurrency=1)
+
+    def tearDown(self):
+        self.manager.stop()
+
+    def test_steps(self):
+        self.manager.start('1234')
+        self.manager.start('abcd')
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 1))
+        self.assertEqual(self.zigate.requests, [('node_descriptor', '1234')])
+        self.assertTrue(self.manager.node_descriptor_received('1234'))
+        self.assertFalse(self.manager.node_descriptor_received('abcd'))
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 2))
+        self.assertEqual(self.zigate.requests[-1], ('model', '1234'))
+        self.assertTrue(self.manager.model_received('1234'))  # no template
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 3))
+        self.assertEqual(self.zigate.requests[-1], ('active_endpoint', '1234'))
+        self.assertTrue(self.manager.active_endpoints_received('1234', [1, 2]))
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 5))
+        self.assertEqual(self.zigate.requests[-2:], [('simple_descriptor', '1234', 1),
+                                                     ('simple_descriptor', '1234', 2)])
+        self.manager.simple_descriptor_received('1234', 1)
+        self.assertEqual(self.manager.get('1234').step, interview.STEP_SIMPLE_DESCRIPTOR)
+        # persisted progress
+        self.assertIn({'addr': '1234', 'step': 'simple_descriptor', 'endpoints': [2], 'retry': 0,
+                       'template': False},
+                      self.manager.to_json())
+        self.manager.simple_descriptor_received('1234', 2)
+        # interview done, next one could start
+        self.assertTrue(wait_for(lambda: not self.manager.is_pending('1234')))
+        self.assertTrue(wait_for(lambda: self.zigate.requests[-1] == ('node_descriptor', 'abcd')))
+
+    def test_template(self):
+        self.zigate.templates['1234'] = {'endpoints': []}
+        self.manager.start('1234', interview.STEP_MODEL)
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 1))
+        self.assertTrue(self.manager.model_received('1234'))
+        # endpoints discovery skipped
+        self.assertTrue(wait_for(lambda: not self.manager.is_pending('1234')))
+        self.assertEqual(self.zigate.requests, [('model', '1234')])
+
+        # unknown model, timeout fallback to full discovery
+        self.manager.timeout = 0.05
+        self.manager.start('abcd', interview.STEP_MODEL)
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 3))
+        self.assertEqual(self.zigate.requests[-1], ('active_endpoint', 'abcd'))
+
+    def test_retry_and_resume(self):
+        self.manager.timeout = 0.05
+        self.manager.retry = 2
+        self.manager.start('1234', interview.STEP_ACTIVE_ENDPOINT)
+        self.assertTrue(wait_for(lambda: self.manager.get('1234').paused))
+        self.assertEqual(self.zigate.requests, [('active_endpoint', '1234')] * 3)
+
+        manager = interview.InterviewManager(self.zigate)
+        manager.load(self.manager.to_json())
+        self.assertTrue(manager.is_pending('1234'))
+        manager.start('1234')
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 4))
+        self.assertEqual(self.zigate.requests[-1], ('active_endpoint', '1234'))
+        manager.stop()
+
+    def test_rename(self):
+        self.assertIsNone(self.manager.rename('1234', 'abcd'))
+        self.manager.start('1234', interview.STEP_ACTIVE_ENDPOINT)
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 1))
+        # joined again with another addr, step is sent again to the new addr
+        self.assertTrue(self.manager.rename('1234', 'abcd'))
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 2))
+        self.assertEqual(self.zigate.requests[-1], ('active_endpoint', 'abcd'))
+        self.assertFalse(self.manager.is_pending('1234'))
+        self.assertEqual([d['addr'] for d in self.manager.to_json()], ['abcd'])
+        self.assertFalse(self.manager.active_endpoints_received('1234', [1]))
+        self.assertTrue(self.manager.active_endpoints_received('abcd', [1]))
+
+    def test_outside_interview(self):
+        device = type('Device', (), {'addr': '1234', 'endpoints': {1: {}}})
+        self.zigate.devices['1234'] = device
+        self.manager.describe_endpoints('1234', [1])
+        self.manager.setup_endpoint('1234', 1)
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 2))
+        self.assertEqual(self.zigate.requests, [('simple_descriptor', '1234', 1),
+                                                ('setup', '1234', 1, 'ZiGate-Interview')])
+        thread = self.manager._thread
+        self.manager.stop()
+        self.assertFalse(thread.is_alive())
+        # restarted on next action
+        self.manager.setup_endpoint('1234', 1)
+        self.assertTrue(wait_for(lambda: len(self.zigate.requests) == 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+'''
+ZiGate MQTT Broker Tests
+-------------------------
+'''
+
+import unittest
+import json
+import time
+import threading
+from zigate import ZiGate
+from zigate.core import Device
+from .helpers import FakeConnection, wait_for
+try:
+    from zigate.mqtt_broker import MQTT_Broker
+except ImportError:  # paho-mqtt not installed
+    MQTT_Broker = None
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.published = []
+        self.subscribed = []
+
+    def subscribe(self, topic):
+        self.subscribed.append(topic)
+
+    def publish(self, topic, payload=None, retain=False):
+        self.published.append((topic, json.loads(payload) if payload else None, retain))
+
+
+class FakeMessage(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = json.dumps(payload).encode()
+
+
+@unittest.skipIf(MQTT_Broker is None, 'paho-mqtt not installed')
+class TestMQTTBroker(unittest.TestCase):
+    def setUp(self):
+        self.zigate = ZiGate(auto_start=False)
+        self.device = Device({'addr': '1234', 'ieee': '0123456789abcdef'}, self.zigate)
+        self.device.set_attribute(1, 0x0402, {'attribute': 0x0000, 'data': 2227})
+        self.zigate._devices['1234'] = self.device
+
+    def create_broker(self, **kwargs):
+        broker = MQTT_Broker(self.zigate, **kwargs)
+        broker.client = FakeClient()
+        return broker
+
+    def test_delta(self):
+        broker = self.create_broker(delta=True)
+        broker.device_changed(self.device)
+        topic, payload, retain = broker.client.published[-1]
+        self.assertEqual(topic, 'zigate/device_changed/1234')
+        self.assertFalse(retain)
+        self.assertEqual(payload['info']['ieee'], '0123456789abcdef')
+        self.assertEqual(len(payload['attributes']), 1)
+        # nothing changed
+        broker.device_changed(self.device)
+        self.assertEqual(len(broker.client.published), 1)
+        self.device.set_attribute(1, 0x0402, {'attribute': 0x0000, 'data': 2300})
+        broker.device_changed(self.device)
+        topic, payload, retain = broker.client.published[-1]
+        self.assertEqual(payload['attributes'][0]['data'], 2300)
+        self.assertNotIn('ieee', payload.get('info', {}))
+        broker.publish_snapshots()
+        broker._snapshot_timer.cancel()
+        topic, payload, retain = broker.client.published[-1]
+        self.assertEqual(topic, 'zigate/device_snapshot/1234')
+        self.assertTrue(retain)
+        self.assertEqual(payload['addr'], '1234')
+        # snapshot only for changed devices
+        broker.publish_snapshots()
+        broker._snapshot_timer.cancel()
+        self.assertEqual(len(broker.client.published), 3)
+
+    def test_snapshot_on_connect(self):
+        broker = self.create_broker(delta=True)
+        # every device is published on (re)connection even if unchanged
+        for i in range(2):
+            broker.on_connect(broker.client, None, {}, 0)
+            topic, payload, retain = broker.client.published[-1]
+            self.assertEqual(topic, 'zigate/device_snapshot/1234')
+            self.assertTrue(retain)
+            self.assertEqual(payload['addr'], '1234')
+        self.assertEqual(len(broker.client.published), 2)
+        self.assertIsNone(broker._snapshot_timer)
+
+    def test_coalesce(self):
+        broker = self.create_broker(coalesce=0.05)
+        for data in (2227, 2228, 2229):
+            attribute = self.device.get_attribute(1, 0x0402, 0x0000, True)
+            attribute['data'] = data
+            broker.attribute_changed(attribute, self.device)
+        broker.attribute_changed(self.device.get_attribute(1, 0x0402, 0x0000, True), self.device)
+        self.device.set_attribute(1, 0x0403, {'attribute': 0x0000, 'data': 977})
+        broker.attribute_changed(self.device.get_attribute(1, 0x0403, 0x0000, True), self.device)
+        time.sleep(0.2)
+        self.assertEqual(len(broker.client.published), 3)
+        topic, payload, retain = broker.client.published[0]
+        self.assertEqual(topic, 'zigate/attributes_changed/1234')
+        self.assertFalse(retain)
+        self.assertEqual([(a['cluster'], a['data']) for a in payload], [(0x0402, 2227), (0x0403, 977)])
+        # retained topics keep the last value of each attribute
+        self.assertEqual([(topic, payload['data'], retain) for topic, payload, retain in broker.client.published[1:]],
+                         [('zigate/attribute_changed/1234/01/0402/0000', 2227, True),
+                          ('zigate/attribute_changed/1234/01/0403/0000', 977, True)])
+
+    def test_coalesce_devices(self):
+        broker = self.create_broker(coalesce=0.05)
+        threads = threading.active_count()
+        for i in range(50):
+            attribute = self.device.get_attribute(1, 0x0402, 0x0000, True)
+            attribute['addr'] = '{:04x}'.format(i)
+            broker.attribute_changed(attribute)
+        # one flusher thread for all devices
+        self.assertEqual(threading.active_count(), threads + 1)
+        broker.device_removed('0000')
+        self.assertTrue(wait_for(lambda: len(broker.client.published) == 99))
+        topics = [topic for topic, payload, retain in broker.client.published]
+        self.assertEqual(topics[0], 'zigate/device_removed')
+        self.assertEqual(topics[1::2], ['zigate/attributes_changed/{:04x}'.format(i) for i in range(1, 50)])
+        self.assertEqual(topics[2::2], ['zigate/attribute_changed/{:04x}/01/0402/0000'.format(i)
+                                        for i in range(1, 50)])
+
+    def test_rate_limit(self):
+        light = Device({'addr': 'abcd', 'ieee': '0123456789abcdee'}, self.zigate)
+        light.get_endpoint(1)['device'] = 0x0100
+        light.set_attribute(1, 0x0006, {'attribute': 0x0000, 'data': True})
+        self.zigate._devices['abcd'] = light
+        broker = self.create_broker(rate_limit=20)
+        for i in range(3):
+            broker.attribute_changed(self.device.get_attribute(1, 0x0402, 0x0000, True))
+        broker.attribute_changed(light.get_attribute(1, 0x0006, 0x0000, True))
+        time.sleep(0.1)
+        self.assertLess(len(broker.client.published), 4)
+        time.sleep(0.2)
+        topics = [topic for topic, payload, retain in broker.client.published]
+        self.assertEqual(len(topics), 4)
+        # actuator is published before queued messages
+        self.assertIn('zigate/attribute_changed/abcd/01/0006/0000', topics[:2])
+
+    def test_command_workers(self):
+        broker = self.create_broker()
+        calls = []
+
+        def command(addr, n, delay=0):
+            time.sleep(delay)
+            calls.append((addr, n))
+            return n
+        self.zigate.test_command = command
+        # find two addr executed by different workers
+        slow_addr = '1234'
+        fast_addr = [addr for addr in ('{:04x}'.format(i) for i in range(100))
+                     if hash(addr) % len(broker._commands) != hash(slow_addr) % len(broker._commands)][0]
+        broker.on_message(None, None, FakeMessage('zigate/command', {'function': 'test_command',
+                                                                     'args': [slow_addr, 1, 0.2], 'id': 'a'}))
+        for n in range(2, 5):
+            broker.on_message(None, None, FakeMessage('zigate/command', {'function': 'test_command',
+                                                                         'args': [slow_addr, n], 'id': n}))
+        broker.on_message(None, None, FakeMessage('zigate/command', {'function': 'test_command',
+                                                                     'args': [fast_addr, 1], 'id': 'b'}))
+        self.assertTrue(wait_for(lambda: len(broker.client.published) == 5))
+        # slow command doesn't block other devices, order is kept by device
+        self.assertEqual(calls[0], (fast_addr, 1))
+        self.assertEqual([n for addr, n in calls if addr == slow_addr], [1, 2, 3, 4])
+        topic, payload, retain = broker.client.published[0]
+        self.assertEqual(topic, 'zigate/command/result')
+        self.assertEqual(payload, {'id': 'b', 'function': 'test_command', 'result': 1})
+        broker.on_message(None, None, FakeMessage('zigate/command', {'function': 'unknown', 'id': 'c'}))
+        self.assertTrue(wait_for(lambda: len(broker.client.published) == 6))
+        self.assertEqual(broker.client.published[-1][1]['id'], 'c')
+        self.assertIn('error', broker.client.published[-1][1])
+        for payload in ({'id': 'd'}, {'function': None, 'id': 'e'}, {'function': ['x'], 'id': 'f'}):
+            broker.on_message(None, None, FakeMessage('zigate/command', payload))
+        self.assertTrue(wait_for(lambda: len(broker.client.published) == 9))
+        self.assertEqual(sorted(p['id'] for t, p, r in broker.client.published[-3:]), ['d', 'e', 'f'])
+        for topic, payload, retain in broker.client.published[-3:]:
+            self.assertEqual(payload['error'], 'Missing function')
+
+    def test_batch(self):
+        broker = self.create_broker()
+        self.zigate.connection = FakeConnection(self.zigate)
+        commands = [{'function': 'action_onoff', 'args': ['{:04x}'.format(addr), 1, 1]} for addr in range(1, 31)]
+        commands.append({'function': 'unknown'})
+        broker.on_message(None, None, FakeMessage('zigate/command/batch', {'commands': commands, 'id': 'x'}))
+        self.assertTrue(wait_for(lambda: len(broker.client.published) == 1))
+        self.assertEqual(len(self.zigate.connection.sent), 30)
+        topic, payload, retain = broker.client.published[0]
+        self.assertEqual(topic, 'zigate/command/result')
+        self.assertEqual(payload['id'], 'x')
+        self.assertEqual(payload['function'], 'batch')
+        self.assertEqual([r['result'] for r in payload['result'][:30]], [0] * 30)
+        self.assertIn('error', payload['result'][30])
+
+    def test_malformed_batch(self):
+        broker = self.create_broker()
+        self.zigate.connection = FakeConnection(self.zigate)
+        broker.on_message(None, None, FakeMessage('zigate/command/batch', {'commands': 'x', 'id': 'a'}))
+        commands = [1,
+                    {'function': 'action_onoff', 'args': 'abcd'},
+                    {'function': 'action_onoff', 'args': ['abcd', 1, 1]}]
+        broker.on_message(None, None, FakeMessage('zigate/command/batch', {'commands': commands, 'id': 'b'}))
+        command = {'function': 'action_onoff', 'args': 1, 'id': 'c'}
+        broker.on_message(None, None, FakeMessage('zigate/command', command))
+        broker.on_message(None, None, FakeMessage('zigate/command', 42))  # ignored, no id to answer
+        self.assertTrue(wait_for(lambda: len(broker.client.published) == 3))
+        results = {payload['id']: payload for topic, payload, retain in broker.client.published}
+        self.assertEqual(results['a']['error'], 'Invalid batch commands')
+        self.assertEqual([r.get('error') for r in results['b']['result']], ['Invalid command', 'Invalid args', None])
+        self.assertEqual(results['b']['result'][2]['result'], 0)
+        self.assertEqual(results['c']['error'], 'Invalid args')
+        self.assertEqual(len(self.zigate.connection.sent), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
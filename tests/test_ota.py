@@ -0,0 +1,169 @@
+'''
+ZiGate OTA Tests
+-------------------------
+'''
+
+import unittest
+import os
+import struct
+import mmap
+import shutil
+import tempfile
+from pydispatch import dispatcher
+from zigate import ota
+from zigate.const import ZIGATE_OTA_PROGRESS
+from .helpers import FakeZiGate
+
+
+def create_image(path, manufacturer_code=0x117c, image_type=0x2101, image_version=0x10, payload=b'\x12' * 200):
+    size = ota.HEADER_SIZE + len(payload)
+    header = struct.pack(ota.HEADER_FORMAT, 0x0BEEF11E, 0x0100, 56, 0, manufacturer_code, image_type,
+                         image_version, 2, *([0x41] * 32), size, 0, 0, 0, 0)
+    with open(path, 'wb') as fp:
+        fp.write(header + payload)
+
+
+def block_request(addr, offset=0, image_version=0x10, max_data_size=64):
+    return {'sequence': 1, 'endpoint': 1, 'cluster': 0x0019, 'address_mode': 2, 'addr': addr,
+            'node_address': 0, 'file_offset': offset, 'image_version': image_version,
+            'image_type': 0x2101, 'manufacturer_code': 0x117c, 'block_request_delay': 0,
+            'max_data_size': max_data_size, 'field_control': 0}
+
+
+def end_request(addr, status=0):
+    return {'sequence': 1, 'endpoint': 1, 'cluster': 0x0019, 'address_mode': 2, 'addr': addr,
+            'file_version': 0x10, 'image_type': 0x2101, 'manufacture_code': 0x117c, 'status': status}
+
+
+class TestOTA(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.zigate = FakeZiGate()
+        self.server = ota.OTAServer(self.zigate, concurrency=2)
+
+    def tearDown(self):
+        self.server.close()
+        self.zigate.close()
+        shutil.rmtree(self.test_dir)
+
+    def test_image(self):
+        path = os.path.join(self.test_dir, 'image.ota')
+        create_image(path)
+        image = ota.OTAImage.from_file(path)
+        self.assertEqual(image.key, (0x117c, 0x2101, 0x10))
+        self.assertEqual(image.size, 269)
+        with open(path, 'ab') as fp:
+            fp.write(b'\x00')
+        self.assertRaises(ValueError, ota.OTAImage.from_file, path)
+
+    def test_directory(self):
+        create_image(os.path.join(self.test_dir, 'v1.ota'), image_version=0x10)
+        create_image(os.path.join(self.test_dir, 'v2.ota'), image_version=0x20, payload=b'\x34' * 100)
+        create_image(os.path.join(self.test_dir, 'other.ota'), image_type=0x2102)
+        with open(os.path.join(self.test_dir, 'readme.txt'), 'w') as fp:
+            fp.write('not an image')
+        images = self.server.load_directory(self.test_dir)
+        self.assertEqual(len(images), 3)
+        self.assertIsNone(self.server.current)
+        image = self.server.find_image(0x117c, 0x2101)
+        self.assertEqual(image.header['image_version'], 0x20)
+        self.assertIsInstance(image.data, mmap.mmap)
+        self.assertEqual(self.server.find_image(0x117c, 0x2101, 0x10).size, 269)
+        # block request served from the image requested by the device
+        self.server.block_request(block_request('1234', 100, image_version=0x20))
+        cmd, data = self.zigate.connection.sent_commands()[-1]
+        self.assertEqual(data[-65:], b'\x40' + b'\x34' * 64)
+
+    def test_sessions(self):
+        path = os.path.join(self.test_dir, 'image.ota')
+        create_image(path)
+        self.assertTrue(self.server.add_image(ota.OTAImage.from_file(path)))
+        self.assertIsNotNone(self.server.block_request(block_request('1234')))
+        self.assertIsNotNone(self.server.block_request(block_request('abcd', 100)))
+        # concurrency reached
+        self.assertIsNone(self.server.block_request(block_request('5678')))
+        cmd, data = self.zigate.connection.sent_commands()[-1]
+        self.assertEqual(data[6], ota.OTA_STATUS_WAIT)
+        self.assertEqual(len(self.server.sessions), 2)
+        # image shared by sessions
+        images = set([id(session.image) for session in self.server.sessions.values()])
+        self.assertEqual(len(images), 1)
+        # block response
+        cmd, data = self.zigate.connection.sent_commands()[1]
+        self.assertEqual(cmd, 0x0502)
+        self.assertEqual(data[6], ota.OTA_STATUS_SUCCESS)
+        self.assertEqual(struct.unpack('!L', data[7:11])[0], 100)
+        self.assertEqual(data[-65:], b'\x40' + b'\x12' * 64)
+        # loading image is refused while it's uploaded
+        self.assertFalse(self.server.add_image(ota.OTAImage.from_file(path)))
+        self.server.end_request(end_request('1234'))
+        self.assertIsNotNone(self.server.block_request(block_request('5678')))
+        self.assertEqual(sorted([s['addr'] for s in self.server.get_status()]), ['5678', 'abcd'])
+
+    def test_progress(self):
+        path = os.path.join(self.test_dir, 'image.ota')
+        create_image(path)
+        self.server.add_image(ota.OTAImage.from_file(path))
+        events = []
+
+        def progress(session, status):
+            events.append(status['transfered'])
+        dispatcher.connect(progress, ZIGATE_OTA_PROGRESS)
+        try:
+            for offset in range(0, 269, 64):
+                self.server.block_request(block_request('1234', offset))
+        finally:
+            dispatcher.disconnect(progress, ZIGATE_OTA_PROGRESS)
+        # first block and last block only
+        self.assertEqual(events, [0, 256])
+        cmd, data = self.zigate.connection.sent_commands()[-1]
+        self.assertEqual(data[-14:], b'\x0d' + b'\x12' * 13)
+
+    def test_no_pacing(self):
+        path = os.path.join(self.test_dir, 'image.ota')
+        create_image(path)
+        self.server.add_image(ota.OTAImage.from_file(path))
+        # not paced by default
+        for offset in range(0, 256, 64):
+            session = self.server.block_request(block_request('1234', offset))
+            cmd, data = self.zigate.connection.sent_commands()[-1]
+            self.assertEqual(data[6], ota.OTA_STATUS_SUCCESS)
+        self.assertEqual(session.waits, 0)
+
+    def test_set_max_block_rate(self):
+        path = os.path.join(self.test_dir, 'image.ota')
+        create_image(path)
+        self.server.add_image(ota.OTAImage.from_file(path))
+        self.server._tokens_time -= 1  # one second of tokens
+        self.server.max_block_rate = 5
+        self.assertEqual(self.server.block_rate, 5)
+        for offset in range(0, 256, 64):
+            self.server.block_request(block_request('1234', offset))
+            cmd, data = self.zigate.connection.sent_commands()[-1]
+            self.assertEqual(data[6], ota.OTA_STATUS_SUCCESS)
+
+    def test_pacing(self):
+        path = os.path.join(self.test_dir, 'image.ota')
+        create_image(path)
+        self.server.add_image(ota.OTAImage.from_file(path))
+        self.server.max_block_rate = self.server.block_rate = self.server._tokens = 3
+        self.server.block_request(block_request('1234', 0))
+        self.server.block_request(block_request('1234', 128))  # gap
+        self.server.block_request(block_request('1234', 64))  # retry
+        self.assertLess(self.server.block_rate, 3)
+        # rate reached
+        session = self.server.block_request(block_request('1234', 128))
+        cmd, data = self.zigate.connection.sent_commands()[-1]
+        self.assertEqual(data[6], ota.OTA_STATUS_WAIT)
+        metrics = self.server.get_metrics()['sessions'][0]
+        self.assertEqual(metrics['blocks'], 3)
+        self.assertEqual(metrics['bytes'], 192)
+        self.assertEqual(metrics['retries'], 1)
+        self.assertEqual(metrics['gaps'], 1)
+        self.assertEqual(metrics['waits'], 1)
+        self.assertEqual(metrics['max_data_size'], 64)
+        self.assertEqual(session.transfered, 64)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+'''
+ZiGate Simulator Tests
+-------------------------
+'''
+
+import unittest
+import os
+import select
+import shutil
+import tempfile
+from unittest import mock
+from zigate import ZiGate, ZiGateWiFi
+from zigate.simulator import ZiGateSimulator, PtySimulator, zigate_frame
+from .helpers import wait_for
+
+
+@unittest.skipIf(not hasattr(os, 'openpty'), 'pty not available')
+class TestSimulator(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, 'zigate.json')
+        self.simulator = None
+        self.zigate = None
+
+    def tearDown(self):
+        if self.zigate:
+            self.zigate.close()
+        if self.simulator:
+            self.simulator.close()
+        shutil.rmtree(self.test_dir)
+
+    def check_zigate(self):
+        self.assertEqual(self.zigate.get_version_text(), '3.1d')
+        self.assertEqual(self.simulator.commands.get(0x0015), 1)
+        self.assertTrue(wait_for(lambda: len(self.zigate.devices) == 3, 5))
+        self.simulator.start_reports(1000, 30).join()
+        device = self.zigate.get_device_from_addr('1002')
+        self.assertTrue(wait_for(lambda: device.get_property_value('temperature') == 0.29, 5))
+
+    def test_serial(self):
+        self.simulator = ZiGateSimulator(devices=3)
+        self.simulator.start()
+        self.zigate = ZiGate(self.simulator.port, path=self.path, auto_save=False)
+        self.check_zigate()
+
+    def test_wifi(self):
+        self.simulator = ZiGateSimulator(devices=3, tcp_port=0)
+        self.simulator.start()
+        self.zigate = ZiGateWiFi('127.0.0.1', self.simulator.tcp_port, path=self.path, auto_save=False)
+        self.check_zigate()
+
+    def test_partial_write(self):
+        self.simulator = PtySimulator('ZiGate-Test-Simulator')
+        packet = zigate_frame(0x8001, b'\x06' + b'x' * 100)
+        write = os.write
+        with mock.patch('os.write', lambda fd, data: write(fd, data[:10])):
+            self.simulator.write(packet)
+        data = b''
+        while select.select([self.simulator._slave], [], [], 0.5)[0]:
+            data += os.read(self.simulator._slave, 4096)
+        self.assertEqual(data, packet)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,13 @@ ZiGate Transport Tests
 '''
 
 import unittest
-from zigate import transport
+import os
+import shutil
+import struct
+import tempfile
+import time
+from zigate import transport, ZiGateReplay
+from zigate.simulator import zigate_frame as frame
 
 
 class TestTransport(unittest.TestCase):
@@ -70,6 +76,36 @@ class TestTransport(unittest.TestCase):
         self.assertEqual(b'\x01123\x03', connection.received.get())
         self.assertEqual(b'\x01456\x03', connection.received.get())
 
+    def test_capture_replay(self):
+        test_dir = tempfile.mkdtemp()
+        path = os.path.join(test_dir, 'capture.zgc')
+        connection = transport.BaseTransport()
+        connection.start_capture(path)
+        devices = frame(0x8015, struct.pack('!BHQBB', 0, 0xabcd, 0x00158d0000000001, 1, 255))
+        report = frame(0x8102, struct.pack('!BHBHHBBHh', 1, 0xabcd, 1, 0x0402, 0x0000, 0, 0x29, 2, 2150))
+        connection.read_data(devices)
+        connection.capture.write(transport.CAPTURE_OUT, b'\x01\x00\x10\x03')
+        connection.read_data(report[:5])
+        connection.read_data(report[5:])
+        connection.stop_capture()
+        records = list(transport.read_capture(path))
+        self.assertEqual([(d, data) for t, d, data in records],
+                         [(transport.CAPTURE_IN, devices), (transport.CAPTURE_OUT, b'\x01\x00\x10\x03'),
+                          (transport.CAPTURE_IN, report[:5]), (transport.CAPTURE_IN, report[5:])])
+        self.assertTrue(records[0][0] <= records[1][0] <= records[2][0] <= records[3][0])
+
+        z = ZiGateReplay(path, realtime=False, path=os.path.join(test_dir, 'zigate.json'))
+        self.assertTrue(z.connection.done.wait(2))
+        for i in range(200):
+            device = z.get_device_from_addr('abcd')
+            if device and device.get_property_value('temperature'):
+                break
+            time.sleep(0.01)
+        self.assertIsNotNone(device)
+        self.assertEqual(device.get_property_value('temperature'), 21.5)
+        z.close()
+        shutil.rmtree(test_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,63 +6,442 @@
 #
 
 import threading
-import socket
+import asyncio
+import functools
+import json
+import logging
+import struct
 import sys
+from collections import deque
+from pydispatch import dispatcher
+from .const import ZIGATE_PACKET_RECEIVED
+
+LOGGER = logging.getLogger('zigate')
+
+BROKER_BUFFER_SIZE = 256 * 1024  # max bytes queued for a client
+BROKER_POLICY_DROP = 'drop'  # drop new frames while the client is behind
+BROKER_POLICY_DISCONNECT = 'disconnect'  # disconnect a client which is behind
+BROKER_MAX_RECEIVED = 1024  # max frames waiting to be forwarded by the broker thread
+BROKER_MAX_INCOMING = 64 * 1024  # max bytes of incomplete frame kept for a client
+HEADER_SIZE = 12  # decoded bytes needed to evaluate filters
+
+# offsets of source address and cluster in message value, None if missing
+HEADER_FIELDS = {0x004D: (0, None),
+                 0x8042: (2, None),
+                 0x8043: (2, None),
+                 0x8045: (2, None),
+                 0x8046: (2, None),
+                 0x8060: (None, 2),
+                 0x8061: (None, 2),
+                 0x8062: (4, 2),
+                 0x8063: (None, 2),
+                 0x8100: (1, 4),
+                 0x8101: (None, 2),
+                 0x8102: (1, 4),
+                 0x8110: (1, 4),
+                 0x8120: (1, 4),
+                 0x8401: (5, 2),
+                 0x8501: (5, 2),
+                 0x8503: (5, 2),
+                 }
+
+
+def decode_frame(frame, size=None):
+    '''
+    unescape raw frame content (msg_type, length, checksum, value)
+    stop after size bytes if specified
+    '''
+    decoded = bytearray()
+    flip = False
+    for b in frame[1:-1]:
+        if flip:
+            flip = False
+            decoded.append(b ^ 0x10)
+        elif b == 0x02:
+            flip = True
+            continue
+        else:
+            decoded.append(b)
+        if size and len(decoded) >= size:
+            break
+    return decoded
+
+
+def frame_type(frame):
+    '''
+    return msg_type of raw frame or None
+    '''
+    header = decode_frame(frame, 2)
+    if len(header) < 2:
+        return None
+    return struct.unpack('!H', header)[0]
+
+
+class BrokerFilter(object):
+    '''
+    client subscription, evaluated on frame header only
+    empty list means no filter
+    '''
+    def __init__(self, msg_types=None, addr=None, clusters=None):
+        self.msg_types = set([self._int(t) for t in msg_types or []])
+        self.addr = set([self._int(a) for a in addr or []])
+        self.clusters = set([self._int(c) for c in clusters or []])
+
+    def _int(self, value):
+        if isinstance(value, str):
+            return int(value, 16)
+        return int(value)
+
+    def match(self, header):
+        '''
+        header is the decoded beginning of the frame (see HEADER_SIZE)
+        '''
+        if len(header) < 2:
+            return False
+        msg_type = struct.unpack('!H', header[:2])[0]
+        if self.msg_types and msg_type not in self.msg_types:
+            return False
+        addr_offset, cluster_offset = HEADER_FIELDS.get(msg_type, (None, None))
+        if self.addr and not self._field_match(header, msg_type, addr_offset, self.addr):
+            return False
+        if self.clusters and not self._field_match(header, msg_type, cluster_offset, self.clusters):
+            return False
+        return True
+
+    def _field_match(self, header, msg_type, offset, values):
+        '''
+        messages without this field only match if their type is explicitly subscribed
+        '''
+        if offset is None:
+            return msg_type in self.msg_types
+        field = header[5 + offset:7 + offset]
+        return len(field) == 2 and struct.unpack('!H', field)[0] in values
+
+    def to_json(self):
+        return {'msg_types': sorted(self.msg_types),
+                'addr': ['{:04x}'.format(a) for a in sorted(self.addr)],
+                'clusters': sorted(self.clusters)}
+
+
+class BrokerClient(object):
+    '''
+    connected client, outbound data is buffered by the asyncio transport
+    up to buffer_size bytes, incomplete inbound data up to max_incoming bytes
+    '''
+    def __init__(self, reader, writer, buffer_size=BROKER_BUFFER_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info('peername') or ('', 0)
+        self.buffer_size = buffer_size
+        self._incoming = b''
+        self.max_incoming = BROKER_MAX_INCOMING
+        self.sent = 0
+        self.dropped = 0
+        self.overflow = 0  # incomplete data dropped because it exceeded max_incoming
+        self.commands = 0
+        self.last_sequence = None
+        self.closed = False
+        self.filter = None
+        self.status_callback = None  # receives statuses of client commands
+
+    def __str__(self):
+        return '{}:{}'.format(*self.addr[:2])
+
+    @property
+    def queued(self):
+        if self.closed:
+            return 0
+        return self.writer.transport.get_write_buffer_size()
+
+    def push(self, data):
+        '''
+        queue data for the client
+        return False if buffer is full
+        '''
+        if self.closed:
+            return False
+        if self.queued + len(data) > self.buffer_size:
+            self.dropped += 1
+            return False
+        self.sent += len(data)
+        self.writer.write(data)
+        return True
+
+    def read_frames(self, data):
+        '''
+        reassemble frames sent by the client
+        return complete frames and handshake lines (starting with '{')
+        '''
+        frames = []
+        self._incoming += data
+        while True:
+            self._incoming = self._incoming.lstrip(b' \r\n')
+            if self._incoming[:1] == b'{':
+                endpos = self._incoming.find(b'\n')
+                if endpos == -1:
+                    break
+                frames.append(self._incoming[:endpos])
+                self._incoming = self._incoming[endpos + 1:]
+                continue
+            endpos = self._incoming.find(b'\x03')
+            if endpos == -1:
+                break
+            startpos = self._incoming.rfind(b'\x01', 0, endpos)
+            if startpos != -1:
+                frames.append(self._incoming[startpos:endpos + 1])
+            else:
+                LOGGER.error('Malformed frame received from {}, ignore it'.format(self))
+            self._incoming = self._incoming[endpos + 1:]
+        if len(self._incoming) > self.max_incoming:
+            LOGGER.error('Too much incomplete data received from {}, drop it'.format(self))
+            self._incoming = b''
+            self.overflow += 1
+        return frames
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+    def metrics(self):
+        return {'addr': str(self),
+                'queued': self.queued,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'overflow': self.overflow,
+                'commands': self.commands,
+                'last_sequence': self.last_sequence,
+                'filter': self.filter.to_json() if self.filter else None}
 
 
 class Broker(threading.Thread):
-    def __init__(self, zigate, port=9999, host='0.0.0.0'):
-        threading.Thread.__init__(self)
+    '''
+    Raw TCP relay of the ZiGate serial line
+    all clients are served by a single asyncio loop running in this thread,
+    each client has a bounded outbound buffer so a slow client never blocks
+    the others, disconnected clients are removed
+
+    clients commands are reassembled and sent frame by frame so several
+    clients could share the serial line, the status (0x8000) of a command
+    is only sent back to the client which sent it (statuses come back
+    in commands order, zigate queues client commands with its own ones)
+
+    a client could subscribe to some messages only by sending a json line
+    before (or between) its frames, the broker answers with the filter:
+    {"msg_types": ["8102"], "addr": ["abcd"], "clusters": [6]}
+    with an addr or clusters filter, messages without such field
+    are only sent if their type is in msg_types
+
+    in tap mode, zigate keeps decoding packets, they are only copied
+    to the broker thread which forwards them to the clients
+    '''
+    def __init__(self, zigate, port=9999, host='0.0.0.0',
+                 buffer_size=BROKER_BUFFER_SIZE, policy=BROKER_POLICY_DROP, tap=False):
+        threading.Thread.__init__(self, name='ZiGate-Broker')
+        self.setDaemon(True)
         self.zigate = zigate
-        self.zigate.decode_data = self.forward_msg
-        self.port = port
+        self.tap = tap
         self.host = host
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.buffer_size = buffer_size
+        self.policy = policy
         self.users = []
+        self.disconnected = 0
+        self.overflow = 0  # frames dropped because the broker thread was behind
+        self.incoming_overflow = 0  # clients disconnected for sending too much incomplete data
+        self._received = deque(maxlen=BROKER_MAX_RECEIVED)  # (client or None, frame) to forward
+        self._received_lock = threading.Lock()
+        self._wakeup = False
+        self._tasks = set()
+        self.loop = asyncio.new_event_loop()
 
         try:
-            self.server.bind((self.host, self.port))
-        except socket.error:
-            print('Bind failed %s' % (socket.error))
+            self.server = self.loop.run_until_complete(asyncio.start_server(self._client_connected,
+                                                                            host, port))
+        except OSError as e:
+            LOGGER.error('Bind failed {}'.format(e))
+            self.loop.close()
             sys.exit()
+        self.port = self.server.sockets[0].getsockname()[1]
 
-        self.server.listen()
+        if tap:
+            dispatcher.connect(self._tap, ZIGATE_PACKET_RECEIVED)
+        else:
+            self.zigate.decode_data = self.forward_msg
 
     def exit(self):
-        self.zigate.close()
-        self.server.close()
+        if self.tap:
+            dispatcher.disconnect(self._tap, ZIGATE_PACKET_RECEIVED)
+        else:
+            self.zigate.close()
+        if self.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        elif not self.loop.is_closed():
+            self.loop.run_until_complete(self._shutdown())
+            self.loop.close()
+
+    def metrics(self):
+        '''
+        return broker metrics, queued bytes, dropped frames by client
+        '''
+        users = list(self.users)
+        return {'clients': len(users),
+                'queued': sum([client.queued for client in users]),
+                'dropped': sum([client.dropped for client in users]),
+                'disconnected': self.disconnected,
+                'overflow': self.overflow,
+                'incoming_overflow': self.incoming_overflow,
+                'users': [client.metrics() for client in users]}
 
     def forward_msg(self, raw_message):
-        raw_message = raw_message
-        to_remove = []
-        for conn, addr in self.users:
-            try:
-                conn.sendall(raw_message)
-            except Exception:
-                to_remove.append((conn, addr))
-        for d in to_remove:
-            self.users.remove(d)
-
-    def run_thread(self, conn, addr):
-        print('Client connected with ' + addr[0] + ':' + str(addr[1]))
-        while True:
-            data = conn.recv(1024)
-            self.zigate.send_to_transport(data)
-        conn.close()
+        '''
+        queue raw message for the broker loop, never blocks
+        '''
+        self._handoff(None, raw_message)
+
+    def _handoff(self, client, raw_message):
+        '''
+        queue frame (for client or all clients) in the bounded received queue,
+        the oldest frame is dropped if the broker thread is behind,
+        the broker loop is only woken up if the queue was empty
+        '''
+        with self._received_lock:
+            if len(self._received) == self._received.maxlen:
+                self.overflow += 1
+            self._received.append((client, raw_message))
+            if self._wakeup:
+                return
+            self._wakeup = True
+        try:
+            self.loop.call_soon_threadsafe(self._drain)
+        except RuntimeError:  # loop closed
+            pass
+
+    def _drain(self):
+        with self._received_lock:
+            received = list(self._received)
+            self._received.clear()
+            self._wakeup = False
+        for client, raw_message in received:
+            if client:
+                self._send_status(client, raw_message)
+            else:
+                self._forward(raw_message)
+
+    def _tap(self, packet):
+        '''
+        called from zigate event loop, forwarding is done by the broker thread
+        statuses are not forwarded, zigate gives those of clients commands
+        to their status_callback
+        '''
+        if frame_type(packet) != 0x8000:
+            self.forward_msg(packet)
+
+    def _client_status(self, client, raw_message):
+        '''
+        status of a client command, could be called from any thread
+        '''
+        if threading.current_thread() is self:
+            self._send_status(client, raw_message)
+        else:
+            self._handoff(client, raw_message)
+
+    def _send_status(self, client, raw_message):
+        header = decode_frame(raw_message, HEADER_SIZE)
+        if len(header) >= 7:
+            client.last_sequence = header[6]
+        self._push(client, raw_message)
+
+    def _forward(self, raw_message):
+        header = decode_frame(raw_message, HEADER_SIZE)
+        if header[:2] == b'\x80\x00' and len(header) >= 9:
+            status, sequence, packet_type = struct.unpack('!BBH', header[5:9])
+            command = self.zigate._status_received(packet_type, status, sequence)
+            if command and command.owner:
+                command.owner(raw_message)
+                return
+        for client in list(self.users):
+            if client.filter is None or client.filter.match(header):
+                self._push(client, raw_message)
+
+    def _push(self, client, raw_message):
+        if not client.push(raw_message) and self.policy == BROKER_POLICY_DISCONNECT:
+            LOGGER.warning('Client {} is too slow, disconnect it'.format(client))
+            self._close(client)
+
+    def _client_connected(self, reader, writer):
+        task = self.loop.create_task(self._handle_client(reader, writer))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle_client(self, reader, writer):
+        client = BrokerClient(reader, writer, self.buffer_size)
+        client.status_callback = functools.partial(self._client_status, client)
+        LOGGER.info('Client connected with {}'.format(client))
+        self.users.append(client)
+        try:
+            while not client.closed:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                self._client_data(client, data)
+        except (OSError, asyncio.CancelledError):
+            pass
+        except Exception:
+            LOGGER.exception('Broker error')
+        finally:
+            self._close(client)
+
+    def _client_data(self, client, data):
+        overflow = client.overflow
+        for frame in client.read_frames(data):
+            if frame[:1] == b'{':
+                self._handshake(client, frame)
+                continue
+            if not self.zigate.send_raw(frame, client.status_callback):
+                LOGGER.error('Malformed frame received from {}, ignore it'.format(client))
+                continue
+            client.commands += 1
+        if client.overflow != overflow:
+            LOGGER.warning('Client {} is not sending frames, disconnect it'.format(client))
+            self.incoming_overflow += 1
+            self._close(client)
+
+    def _handshake(self, client, line):
+        try:
+            data = json.loads(line.decode())
+            client.filter = BrokerFilter(data.get('msg_types'), data.get('addr'), data.get('clusters'))
+            answer = {'filter': client.filter.to_json()}
+            LOGGER.debug('Client {} filter {}'.format(client, answer['filter']))
+        except Exception as e:
+            answer = {'error': 'Invalid filter: {}'.format(e)}
+        client.push(json.dumps(answer).encode() + b'\n')
+
+    def _close(self, client):
+        if client in self.users:
+            LOGGER.info('Client {} disconnected'.format(client))
+            self.users.remove(client)
+            self.disconnected += 1
+            self.zigate.release_owner(client.status_callback)
+        client.close()
+
+    async def _shutdown(self):
+        self.server.close()
+        for client in list(self.users):
+            self._close(client)
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=1)
+        await self.server.wait_closed()
 
     def run(self):
-        print('Waiting for connections on port %s' % (self.port))
-        # We need to run a loop and create a new thread for each connection
-        while True:
-            conn, addr = self.server.accept()
-            self.users.append((conn, addr))
-            threading.Thread(target=self.run_thread, args=(conn, addr)).start()
+        LOGGER.info('Waiting for connections on port {}'.format(self.port))
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.run_until_complete(self._shutdown())
+        self.loop.close()
 
 
 if __name__ == '__main__':
     from zigate.core import ZiGate
-    import logging
     logging.basicConfig()
     logging.root.setLevel(logging.DEBUG)
     z = ZiGate(auto_start=False)
@@ -18,6 +18,7 @@ ZIGATE_DEVICE_NEED_REFRESH = 'ZIGATE_DEVICE_NEED_REFRESH'
 ZIGATE_FAILED_TO_CONNECT = 'ZIGATE_FAILED_TO_CONNECT'
 ZIGATE_CONNECTED = 'ZIGATE_CONNECTED'
 ZIGATE_READY = 'ZIGATE_READY'
+ZIGATE_OTA_PROGRESS = 'ZIGATE_OTA_PROGRESS'
 
 BATTERY = 0
 AC_POWER = 1
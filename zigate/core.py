@@ -14,7 +14,7 @@ import json
 import os
 from shutil import copyfile
 from pydispatch import dispatcher
-from .transport import (ThreadSerialConnection, ThreadSocketConnection)
+from .transport import (ThreadSerialConnection, ThreadSocketConnection, ReplayTransport)
 from .responses import (RESPONSES, Response)
 from .const import (ACTIONS_COLOR, ACTIONS_LEVEL, ACTIONS_LOCK, ACTIONS_HUE,
                     ACTIONS_ONOFF, ACTIONS_TEMPERATURE,
@@ -26,10 +26,13 @@ from .const import (ACTIONS_COLOR, ACTIONS_LEVEL, ACTIONS_LOCK, ACTIONS_HUE,
                     ZIGATE_RESPONSE_RECEIVED, DATA_TYPE)
 
 from .clusters import (CLUSTERS, Cluster, get_cluster)
+from .interview import (InterviewManager, STEP_ACTIVE_ENDPOINT)
+from .ota import (OTAServer, OTAImage)
 import functools
 import struct
 import threading
 import random
+from collections import deque
 from enum import Enum
 import colorsys
 import datetime
@@ -40,8 +43,24 @@ LOGGER = logging.getLogger('zigate')
 
 AUTO_SAVE = 5 * 60  # 5 minutes
 BIND_REPORT_LIGHT = True  # automatically bind and report state for light
+LAZY_LOAD = False  # materialise devices from persistent file only on first access
+FAST_START = False  # pipeline autoStart commands and refresh devices in background
 SLEEP_INTERVAL = 0.1
+STATUS_TIMEOUT = 3  # seconds to wait for a command status
+TEMPLATE_UPDATE_DELAY = 10  # seconds to gather new attributes before updating templates
 ACTIONS = {}
+# clusters to bind and attributes to report for actuators
+# (attribute_id, attribute_type, min_interval, max_interval, reportable_change)
+BIND_REPORT = {0x0006: [(0x0000, 0x10, 0, 300, 0)],  # onoff
+               0x0008: [(0x0000, 0x20, 1, 300, 1)],  # current level
+               0x0300: [(0x0000, 0x20, 1, 300, 1),  # current hue
+                        (0x0001, 0x20, 1, 300, 1),  # current saturation
+                        (0x0003, 0x21, 1, 300, 1),  # current x
+                        (0x0004, 0x21, 1, 300, 1),  # current y
+                        (0x0007, 0x21, 1, 300, 1),  # colour temperature
+                        (0x0008, 0x30, 1, 300, 0),  # colour mode
+                        ],
+               }
 
 # Device id
 ACTUATORS = [0x0010, 0x0051,
@@ -66,6 +85,44 @@ def register_actions(action):
     return decorator
 
 
+def discard_packet(packet):
+    '''
+    owner of commands whose sender is gone
+    '''
+    pass
+
+
+class PendingCommand(object):
+    '''
+    command waiting for its status (0x8000)
+    and optionally for the response with the same sequence
+    owner receives the raw status of commands sent by send_raw
+    '''
+    def __init__(self, cmd, sequence_response=None, owner=None):
+        self.cmd = cmd
+        self.sequence_response = sequence_response
+        self.owner = owner
+        self.time = time()
+        self.status = None
+        self.sequence = None
+        self.response = None
+        self.on_success = []  # (func, args) called by run_pipelined on success status
+        self.status_event = threading.Event()
+        self.response_event = threading.Event()
+
+    def expired(self):
+        return time() - self.time > STATUS_TIMEOUT
+
+    def set_status(self, status, sequence):
+        self.status = status
+        self.sequence = sequence
+        self.status_event.set()
+
+    def set_response(self, response):
+        self.response = response
+        self.response_event.set()
+
+
 class AddrMode(Enum):
     bound = 0
     group = 1
@@ -114,27 +171,45 @@ def dispatch_signal(signal=dispatcher.Any, sender=dispatcher.Anonymous,
         LOGGER.error(traceback.format_exc())
 
 
+def has_receivers(sender, signal):
+    '''
+    return True if a receiver is connected to signal
+    '''
+    return any(dispatcher.liveReceivers(dispatcher.getAllReceivers(sender, signal)))
+
+
 class ZiGate(object):
 
     def __init__(self, port='auto', path='~/.zigate.json',
                  auto_start=True,
                  auto_save=True,
                  channel=None):
-        self._devices = {}
+        self._devices = LazyDeviceDict(self)
         self._groups = {}
         self._scenes = {}
         self._path = path
         self._version = None
         self._port = port
         self._last_response = {}  # response to last command type
-        self._last_status = {}  # status to last command type
+        self._pending_status = {}  # commands waiting for status by type, in sending order
+        self._pending_response = {}  # commands waiting for response by (type, sequence)
+        self._status_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._local = threading.local()  # commands sent by run_pipelined in current thread
         self._save_lock = threading.Lock()
         self._autosavetimer = None
         self._closing = False
         self.connection = None
+        self._capture_path = None  # capture file of raw data
 
         self._addr = None
         self._ieee = None
+        self._network = {}  # persisted network configuration
+        self._interviews = InterviewManager(self)
+        self._templates = {}  # interview templates by model
+        self._template_updates = set()  # addr of devices with new attributes
+        self._template_timer = None
+        self._template_lock = threading.Lock()
         self._started = False
         self._no_response_count = 0
 
@@ -145,7 +220,7 @@ class ZiGate(object):
 
         dispatcher.connect(self.interpret_response, ZIGATE_RESPONSE_RECEIVED)
 
-        self._ota_reset_local_variables()
+        self._ota = OTAServer(self)
 
         if auto_start:
             self.autoStart(channel)
@@ -168,6 +243,10 @@ class ZiGate(object):
         self._closing = True
         if self._autosavetimer:
             self._autosavetimer.cancel()
+        if self._template_timer:
+            self._template_timer.cancel()
+        self._interviews.stop()
+        self._ota.close()
         try:
             if self.connection:
                 self.connection.close()
@@ -192,13 +271,25 @@ class ZiGate(object):
             self._save_lock.release()
             return
         try:
-            data = {'devices': list(self._devices.values()),
-                    'groups': self._groups,
-                    'scenes': self._scenes
+            data = {'groups': self._groups,
+                    'scenes': self._scenes,
+                    'network': self._network,
+                    'interviews': self._interviews.to_json(),
+                    'templates': self._templates
                     }
+            items = []
+            for key in sorted(list(data.keys()) + ['devices']):
+                if key == 'devices':  # devices use their cached json
+                    value = [device.to_json_bytes().decode() if isinstance(device, Device) else json.dumps(device)
+                             for device in self._devices.records()]
+                    value = '[\n        ' + ',\n        '.join(value) + '\n    ]' if value else '[]'
+                else:
+                    value = json.dumps(data[key], cls=DeviceEncoder,
+                                       sort_keys=True, indent=4, separators=(',', ': '))
+                    value = value.replace('\n', '\n    ')  # newlines are escaped inside json strings
+                items.append('    {}: {}'.format(json.dumps(key), value))
             with open(self._path, 'w') as fp:
-                json.dump(data, fp, cls=DeviceEncoder,
-                          sort_keys=True, indent=4, separators=(',', ': '))
+                fp.write('{\n' + ',\n'.join(items) + '\n}')
         except Exception:
             LOGGER.error('Failed to save persistent file {}'.format(self._path))
             LOGGER.error(traceback.format_exc())
@@ -206,8 +297,15 @@ class ZiGate(object):
             copyfile(backup_path, self._path)
         self._save_lock.release()
 
-    def load_state(self, path=None):
+    def load_state(self, path=None, lazy=None):
+        '''
+        load persistent file
+        if lazy, devices are kept as raw json and only
+        materialised on first access (default to LAZY_LOAD)
+        '''
         LOGGER.debug('Try loading persistent file')
+        if lazy is None:
+            lazy = LAZY_LOAD
         path = path or self._path
         self._path = os.path.expanduser(path)
         backup_path = self._path + '.0'
@@ -222,8 +320,14 @@ class ZiGate(object):
                     groups[k] = set([tuple(r) for r in v])
                 self._groups = groups
                 self._scenes = data.get('scenes', {})
+                self._network = data.get('network', {})
+                self._interviews.load(data.get('interviews', []))
+                self._templates = data.get('templates', {})
                 devices = data.get('devices', [])
                 for data in devices:
+                    if lazy:
+                        self._devices.add_raw(data)
+                        continue
                     device = Device.from_json(data, self)
                     self._devices[device.addr] = device
                     device._create_actions()
@@ -247,7 +351,7 @@ class ZiGate(object):
     def __del__(self):
         self.close()
 
-    def autoStart(self, channel=None):
+    def autoStart(self, channel=None, fast=None):
         '''
         Auto Start sequence:
             - Load persistent file
@@ -256,11 +360,22 @@ class ZiGate(object):
             - Set Type Coordinator
             - Start Network
             - Refresh devices list
+
+        if fast (default to FAST_START), independent commands are pipelined,
+        channel and type setup are skipped if persisted network state matches
+        and devices are refreshed in background
         '''
         if self._started:
             return
+        if fast is None:
+            fast = FAST_START
         self.load_state()
         self.setup_connection()
+        if self._capture_path:
+            self.connection.start_capture(self._capture_path)
+        if fast:
+            self._fast_start(channel)
+            return
         version = self.get_version()
         self.set_channel(channel)
         self.set_type(TYPE_COORDINATOR)
@@ -279,17 +394,149 @@ class ZiGate(object):
         self.get_devices_list(True)
         self.need_refresh()
 
-    def need_refresh(self):
+    def _fast_start(self, channel=None):
+        '''
+        Fast start sequence, see autoStart
+        '''
+        commands = [(0x0010, '', 0x8010), (0x0009, '', 0x8009)]
+        version, network_state = self._send_pipelined(commands)
+        if version:
+            self._version = version.data
+        persisted_pan = self._network.get('extend_pan')  # before being updated by network state
+        network_state = self._update_network_state(network_state)
+        channels = self._channels_list(channel)
+        configured = network_state and all([network_state.get('extend_pan') != 0,
+                                            persisted_pan == network_state['extend_pan'],
+                                            self._network.get('channels') == channels,
+                                            self._network.get('type') == TYPE_COORDINATOR])
+        if configured:
+            LOGGER.debug('Network already configured, skip channel and type setup')
+        else:
+            LOGGER.debug('Configure network')
+            status = self._send_pipelined([(0x0021, self._channel_mask(channels), None),
+                                           (0x0023, struct.pack('!B', TYPE_COORDINATOR), None),
+                                           (0x0024, '', None)])
+            if status[0] == 0:
+                self._network['channels'] = channels
+            if status[1] == 0:
+                self._network['type'] = TYPE_COORDINATOR
+            network_state = self.get_network_state()
+            if not network_state:
+                LOGGER.error('Failed to get network state')
+            if not network_state or network_state.get('extend_pan') == 0:
+                LOGGER.debug('Network is down, start it')
+                self.start_network(True)
+                network_state = self.get_network_state()
+        commands = [(0x0015, '', 0x8015)]
+        if self._version and self._version['version'] >= '3.0f':
+            LOGGER.debug('Set Zigate Time (firmware >= 3.0f)')
+            commands.insert(0, (0x0016, self._time_data(), None))
+        self._send_pipelined(commands)
+        self.need_refresh(background=True)
+
+    def _send_pipelined(self, commands):
+        '''
+        send several commands without waiting status between them
+        then wait for all status
+        commands is a list of tuple (cmd, data, wait_response)
+        return list of status or response
+        '''
+        pending = [(self._send_command(cmd, data, wait_response), wait_response)
+                   for cmd, data, wait_response in commands]
+        results = []
+        for command, wait_response in pending:
+            status = self._wait_status(command)
+            if wait_response and status is not None:
+                status = self._wait_response(wait_response)
+            results.append(status)
+        return results
+
+    def _send_batch(self, cmd, datas, wait_response=None):
+        '''
+        send the same command several times without waiting status between them
+        then wait for all status and responses (matched by sequence number)
+        return list of status or response in the same order than datas
+        '''
+        commands = [self._send_command(cmd, data, sequence_response=wait_response) for data in datas]
+        results = [self._wait_status(command) for command in commands]
+        if None in results:
+            LOGGER.warning('Missing status after command 0x{:04x}'.format(cmd))
+        if wait_response:
+            results = [self._wait_sequence_response(command) if status == 0 else None
+                       for command, status in zip(commands, results)]
+        return results
+
+    def run_pipelined(self, calls):
+        '''
+        run several zigate functions, their commands are sent
+        without waiting status between them (responses are not waited)
+        calls is a list of tuple (function, args)
+        return list of status by call (list of status if the call sent several commands),
+        exception raised by the call if any (ValueError if it waits for a response)
+        '''
+        sent = []
+        self._local.pipeline = []
+        try:
+            for func, args in calls:
+                start = len(self._local.pipeline)
+                try:
+                    func(*args)
+                    sent.append(self._local.pipeline[start:])
+                except Exception as e:
+                    LOGGER.error('Error calling {} : {}'.format(func, e))
+                    sent.append(e)
+        finally:
+            self._local.pipeline = None
+        results = []
+        for commands in sent:
+            if isinstance(commands, Exception):
+                results.append(commands)
+                continue
+            statuses = [self._wait_status(command) for command in commands]
+            for command, status in zip(commands, statuses):
+                if status == 0:
+                    for func, args in command.on_success:
+                        func(*args)
+            results.append(statuses[0] if len(statuses) == 1 else statuses)
+        return results
+
+    def _on_success(self, status, func, *args):
+        '''
+        call func(*args) if status of last command is success,
+        in run_pipelined it's called when the status arrives
+        '''
+        pipeline = getattr(self._local, 'pipeline', None)
+        if pipeline is not None:
+            if pipeline:
+                pipeline[-1].on_success.append((func, args))
+        elif status == 0:
+            func(*args)
+
+    def need_refresh(self, background=False):
         '''
         scan device which need refresh
-        auto refresh if possible
+        auto refresh if possible (resuming unfinished interview)
         else dispatch signal
+        if background, run in a separate thread
         '''
-        for device in self.devices:
-            if device.need_refresh():
+        if background:
+            thread = threading.Thread(target=self.need_refresh,
+                                      name='ZiGate-Refresh')
+            thread.setDaemon(True)
+            thread.start()
+            return
+        for addr, device in self._devices.raw_items():
+            if isinstance(device, Device):
+                need = device.need_refresh()
+            else:  # raw record, only materialise it if needed
+                need = Device.json_need_refresh(device)
+            if need or self._interviews.is_pending(addr):
+                device = self._devices.get(addr)
+                if not device:
+                    continue
                 if device.receiver_on_when_idle():
                     LOGGER.debug('Auto refresh device {}'.format(device))
-                    device.refresh_device()
+                    self._interviews.start(device.addr)
                 else:
                     dispatch_signal(ZIGATE_DEVICE_NEED_REFRESH,
                                     self, **{'zigate': self,
@@ -327,6 +574,21 @@ class ZiGate(object):
                 chcksum ^= x
         return chcksum
 
+    def start_capture(self, path):
+        '''
+        record raw data read from and sent to ZiGate in a capture file
+        which could be replayed with ZiGateReplay
+        if called before autoStart, the startup sequence is recorded too
+        '''
+        self._capture_path = path
+        if self.connection:
+            self.connection.start_capture(path)
+
+    def stop_capture(self):
+        self._capture_path = None
+        if self.connection:
+            self.connection.stop_capture()
+
     def send_to_transport(self, data):
         if not self.connection.is_connected():
             raise Exception('Not connected to zigate')
@@ -335,9 +597,31 @@ class ZiGate(object):
     def send_data(self, cmd, data="", wait_response=None, wait_status=True):
         '''
         send data through ZiGate
+        in run_pipelined, the status is not waited and None is returned
+        '''
+        pipeline = getattr(self._local, 'pipeline', None)
+        if pipeline is not None and wait_response:
+            raise ValueError('Cannot wait response 0x{:04x} in pipeline'.format(wait_response))
+        command = self._send_command(cmd, data, wait_response)
+        if pipeline is not None and wait_status:
+            pipeline.append(command)
+            return
+        elif wait_status:
+            status = self._wait_status(command)
+            if wait_response and status is not None:
+                r = self._wait_response(wait_response)
+                return r
+            return status
+        return False
+
+    def _send_command(self, cmd, data="", wait_response=None, sequence_response=None):
+        '''
+        send command and return its PendingCommand
+        statuses come back in sending order, the command is queued
+        before being sent so concurrent senders get their own status
+        if sequence_response, the response with the sequence of the status is kept
         '''
         LOGGER.debug('REQUEST : 0x{:04x} {}'.format(cmd, data))
-        self._last_status[cmd] = None
         if wait_response:
             self._clear_response(wait_response)
         if isinstance(cmd, int):
@@ -364,15 +648,68 @@ class ZiGate(object):
         enc_msg.append(0x03)
         encoded_output = bytes(enc_msg)
         LOGGER.debug('Encoded Msg to send {}'.format(hexlify(encoded_output)))
+        return self._send_frame(PendingCommand(cmd, sequence_response), encoded_output)
 
-        self.send_to_transport(encoded_output)
-        if wait_status:
-            status = self._wait_status(cmd)
-            if wait_response and status is not None:
-                r = self._wait_response(wait_response)
-                return r
-            return status
-        return False
+    def send_raw(self, frame, owner):
+        '''
+        send an encoded frame (from a broker client)
+        its status is not decoded but given to owner(packet)
+        return False if the frame is malformed
+        '''
+        decoded = self.zigate_decode(frame[1:-1])
+        if len(decoded) < 2:
+            return False
+        cmd = struct.unpack('!H', decoded[:2])[0]
+        self._send_frame(PendingCommand(cmd, owner=owner), frame)
+        return True
+
+    def release_owner(self, owner):
+        '''
+        owner is gone, its commands statuses will be discarded
+        their place is kept so statuses of next commands are not shifted
+        '''
+        with self._status_lock:
+            for pending in self._pending_status.values():
+                for command in pending:
+                    if command.owner is owner:
+                        command.owner = discard_packet
+
+    def _send_frame(self, command, frame):
+        with self._send_lock:
+            with self._status_lock:
+                pending = self._pending_status.setdefault(command.cmd, deque())
+                while pending and pending[0].expired():  # status lost
+                    pending.popleft()
+                pending.append(command)
+            try:
+                self.send_to_transport(frame)
+            except Exception:
+                self._forget_command(command)
+                raise
+        return command
+
+    def _forget_command(self, command):
+        with self._status_lock:
+            pending = self._pending_status.get(command.cmd)
+            if pending and command in pending:
+                pending.remove(command)
+            if command.sequence is not None:
+                self._pending_response.pop((command.sequence_response, command.sequence), None)
+
+    def _status_received(self, packet_type, status, sequence):
+        '''
+        give status to the oldest command of this type still waiting for it
+        '''
+        with self._status_lock:
+            pending = self._pending_status.get(packet_type)
+            while pending:
+                command = pending.popleft()
+                if command.expired():  # status lost, its sender gave up
+                    continue
+                if command.sequence_response and status == 0:
+                    self._pending_response[(command.sequence_response, sequence)] = command
+                command.set_status(status, sequence)
+                return command
 
     def decode_data(self, packet):
         '''
@@ -405,7 +742,17 @@ class ZiGate(object):
         if msg_type != response.msg:
             LOGGER.warning('Unknown response 0x{:04x}'.format(msg_type))
         LOGGER.debug(response)
+        if msg_type == 0x8000:
+            command = self._status_received(response['packet_type'], response['status'], response['sequence'])
+            if command and command.owner:  # command sent by send_raw, not for us
+                command.owner(packet)
+                return
         self._last_response[msg_type] = response
+        if self._pending_response and 'sequence' in response:
+            with self._status_lock:
+                command = self._pending_response.pop((msg_type, response['sequence']), None)
+            if command:
+                command.set_response(response)
         dispatch_signal(ZIGATE_RESPONSE_RECEIVED, self, response=response)
 
     def interpret_response(self, response):
@@ -414,7 +761,6 @@ class ZiGate(object):
                 LOGGER.error('Command 0x{:04x} failed {} : {}'.format(response['packet_type'],
                                                                       response.status_text(),
                                                                       response['error']))
-            self._last_status[response['packet_type']] = response['status']
         elif response.msg == 0x8015:  # device list
             keys = set(self._devices.keys())
             known_addr = set([d['addr'] for d in response['devices']])
@@ -427,6 +773,13 @@ class ZiGate(object):
             for d in response['devices']:
                 if d['ieee'] == '0000000000000000':
                     continue
+                changed = self._devices.update_raw(d['addr'], d)
+                if changed is not None:
+                    # keep it lazy if nothing but rssi changed or nobody is listening
+                    if changed - {'rssi'} and has_receivers(self, ZIGATE_DEVICE_UPDATED):
+                        dispatch_signal(ZIGATE_DEVICE_UPDATED, self, **{'zigate': self,
+                                                                        'device': self._devices[d['addr']]})
+                    continue
                 device = Device(dict(d), self)
                 self._set_device(device)
         elif response.msg == 0x8042:  # node descriptor
@@ -434,6 +787,7 @@ class ZiGate(object):
             d = self.get_device_from_addr(addr)
             if d:
                 d.update_info(response.cleaned_data())
+                self._interviews.node_descriptor_received(addr)
         elif response.msg == 0x8043:  # simple descriptor
             addr = response['addr']
             endpoint = response['endpoint']
@@ -443,26 +797,14 @@ class ZiGate(object):
                 ep.update(response.cleaned_data())
                 ep['in_clusters'] = response['in_clusters']
                 ep['out_clusters'] = response['out_clusters']
-                typ = d.type
-                LOGGER.debug('Found type {}'.format(typ))
-                d._create_actions()
-                d._bind_report(endpoint)
-                # ask for various general information
-                for c in response['in_clusters']:
-                    cluster = CLUSTERS.get(c)
-                    if cluster:
-                        # self.attribute_discovery_request(addr,
-                        #                                 endpoint,
-                        #                                 cluster)
-                        # some devices don't answer if more than 8 attributes asked
-                        attrs = list(cluster.attributes_def.keys())
-                        for i in range(0, len(attrs), 8):
-                            self.read_attribute_request(addr, endpoint, c,
-                                                        attrs[i: i + 8])
+                d.touch()
+                if not self._interviews.simple_descriptor_received(addr, endpoint):
+                    self._interviews.setup_endpoint(addr, endpoint)
         elif response.msg == 0x8045:  # endpoint list
             addr = response['addr']
-            for endpoint in response['endpoints']:
-                self.simple_descriptor_request(addr, endpoint['endpoint'])
+            endpoints = [endpoint['endpoint'] for endpoint in response['endpoints']]
+            if not self._interviews.active_endpoints_received(addr, endpoints):
+                self._interviews.describe_endpoints(addr, endpoints)
         elif response.msg == 0x8048:  # leave
             device = self.get_device_from_ieee(response['ieee'])
             if response['rejoin_status'] == 1:
@@ -491,7 +833,10 @@ class ZiGate(object):
             changed = device.get_attribute(response['endpoint'],
                                            response['cluster'],
                                            attribute_id, True)
+            if response['cluster'] == 0x0000 and attribute_id == 0x0005:
+                self._interviews.model_received(device.addr)
             if added:
+                self._schedule_template_update(device.addr)
                 dispatch_signal(ZIGATE_ATTRIBUTE_ADDED, self, **{'zigate': self,
                                                                  'device': device,
                                                                  'attribute': changed})
@@ -502,6 +847,9 @@ class ZiGate(object):
         elif response.msg == 0x004D:  # device announce
             LOGGER.debug('Device Announce')
             device = Device(response.data, self)
+            known = self.get_device_from_ieee(device.ieee)
+            if known:  # joined again (maybe after a reset), bindings could be lost
+                known.clear_bind_report()
             self._set_device(device)
         elif response.msg == 0x8501:  # OTA image block request
             LOGGER.debug('Client is requesting ota image data')
@@ -512,6 +860,126 @@ class ZiGate(object):
 #         else:
 #             LOGGER.debug('Do nothing special for response {}'.format(response))
 
+    def _setup_endpoint(self, device, endpoint_id, template=False):
+        '''
+        create actions, bind and report
+        and ask for various general information
+        if template, only read attributes known for this model
+        '''
+        LOGGER.debug('Setup endpoint {} of {}'.format(endpoint_id, device))
+        bind_clusters = None
+        known_attributes = None
+        if template:
+            template = self._get_template(device) or {}
+            for ep in template.get('endpoints', []):
+                if ep['endpoint'] == endpoint_id:
+                    bind_clusters = [c for c in ep['in_clusters'] if c in BIND_REPORT]
+                    known_attributes = set([tuple(a) for a in ep.get('attributes', [])])
+        device._create_actions()
+        device._bind_report(endpoint_id, bind_clusters)
+        for c in device.endpoints[endpoint_id]['in_clusters']:
+            cluster = CLUSTERS.get(c)
+            if cluster:
+                # self.attribute_discovery_request(addr,
+                #                                 endpoint,
+                #                                 cluster)
+                # some devices don't answer if more than 8 attributes asked
+                attrs = list(cluster.attributes_def.keys())
+                if known_attributes is not None:
+                    attrs = [a for a in attrs if (c, a) in known_attributes]
+                    attrs = [a for a in attrs if not device.get_attribute(endpoint_id, c, a)]
+                for i in range(0, len(attrs), 8):
+                    self.read_attribute_request(device.addr, endpoint_id, c,
+                                                attrs[i: i + 8])
+
+    def _model_request(self, addr):
+        '''
+        read manufacturer and type of device
+        '''
+        endpoint_id = 1
+        device = self.get_device_from_addr(addr)
+        if device:
+            endpoints = [k for k, v in sorted(device.endpoints.items())
+                         if 0x0000 in v['in_clusters']]
+            if endpoints:
+                endpoint_id = endpoints[0]
+        self.read_attribute_request(addr, endpoint_id, 0x0000, [0x0004, 0x0005])
+
+    def _template_key(self, device):
+        typ = device.get_property_value('type')
+        if typ:
+            return '{}/{}'.format(device.get_property_value('manufacturer', ''), typ)
+
+    def _get_template(self, device):
+        return self._templates.get(self._template_key(device))
+
+    def _apply_template(self, addr):
+        '''
+        load endpoints from the template of device model
+        return template if found
+        '''
+        device = self.get_device_from_addr(addr)
+        if not device:
+            return
+        template = self._get_template(device)
+        if template:
+            LOGGER.debug('Apply template {} to {}'.format(self._template_key(device), device))
+            for ep in template['endpoints']:
+                endpoint = device.get_endpoint(ep['endpoint'])
+                for k in ('profile', 'device', 'in_clusters', 'out_clusters'):
+                    endpoint[k] = ep[k]
+            device.touch()
+        return template
+
+    def _schedule_template_update(self, addr):
+        '''
+        update template of device model later,
+        attributes added meanwhile are gathered in the same update
+        '''
+        with self._template_lock:
+            self._template_updates.add(addr)
+            if self._template_timer is None:
+                self._template_timer = threading.Timer(TEMPLATE_UPDATE_DELAY, self._update_templates)
+                self._template_timer.setDaemon(True)
+                self._template_timer.start()
+
+    def _update_templates(self):
+        with self._template_lock:
+            addrs = self._template_updates
+            self._template_updates = set()
+            self._template_timer = None
+        for addr in addrs:
+            self._update_template(addr)
+
+    def _update_template(self, addr):
+        '''
+        create or update the template of device model
+        '''
+        device = self.get_device_from_addr(addr)
+        if not device or self._interviews.is_pending(addr):
+            return
+        key = self._template_key(device)
+        if not key or not device.endpoints:
+            return
+        previous = {ep['endpoint']: ep for ep in self._templates.get(key, {}).get('endpoints', [])}
+        endpoints = []
+        for endpoint_id, endpoint in sorted(list(device.endpoints.items())):
+            if not endpoint.get('in_clusters'):
+                return  # endpoints discovery not finished
+            attributes = set([tuple(a) for a in previous.get(endpoint_id, {}).get('attributes', [])])
+            for cluster_id, cluster in list(endpoint['clusters'].items()):
+                attributes.update([(cluster_id, a) for a in list(cluster.attributes) if a in cluster.attributes_def])
+            endpoints.append({'endpoint': endpoint_id,
+                              'profile': endpoint['profile'],
+                              'device': endpoint['device'],
+                              'in_clusters': list(endpoint['in_clusters']),
+                              'out_clusters': list(endpoint['out_clusters']),
+                              'attributes': sorted(attributes)})
+        LOGGER.debug('Update template {}'.format(key))
+        self._templates[key] = {'manufacturer': device.get_property_value('manufacturer', ''),
+                                'type': device.get_property_value('type'),
+                                'endpoints': endpoints}
+
     def _get_device(self, addr):
         '''
         get device from addr
@@ -558,6 +1026,7 @@ class ZiGate(object):
         remove device from addr
         '''
         device = self._devices.pop(addr)
+        self._interviews.remove(addr)
         dispatch_signal(ZIGATE_DEVICE_REMOVED, **{'zigate': self,
                                                   'addr': addr,
                                                   'device': device})
@@ -579,6 +1048,7 @@ class ZiGate(object):
                 old_addr = d.addr
                 new_addr = device.addr
                 d.update(device)
+                d.clear_bind_report()  # paired again, bindings are lost
                 self._devices[new_addr] = d
                 del self._devices[old_addr]
                 dispatch_signal(ZIGATE_DEVICE_RENAMED, self,
@@ -586,6 +1056,9 @@ class ZiGate(object):
                                    'old_addr': old_addr,
                                    'new_addr': new_addr,
                                    })
+                if self._interviews.rename(old_addr, new_addr):
+                    self._interviews.start(new_addr)  # resume unfinished interview
+                    return
             else:
                 self._devices[device.addr] = device
                 dispatch_signal(ZIGATE_DEVICE_ADDED, self, **{'zigate': self,
@@ -615,22 +1088,30 @@ class ZiGate(object):
         LOGGER.debug('Stop waiting, got message 0x{:04x}'.format(msg_type))
         return self._last_response.get(msg_type)
 
-    def _wait_status(self, cmd):
+    def _wait_status(self, command):
         '''
-        wait for status of cmd
+        wait for status of command (see _send_command)
         '''
+        cmd = command.cmd
         LOGGER.debug('Waiting for status message for command 0x{:04x}'.format(cmd))
-        t1 = time()
-        while self._last_status.get(cmd) is None:
-            sleep(0.01)
-            t2 = time()
-            if t2 - t1 > 3:  # no response timeout
-                self._no_response_count += 1
-                LOGGER.warning('No response after command 0x{:04x} ({})'.format(cmd, self._no_response_count))
-                return
+        if not command.status_event.wait(max(0, command.time + STATUS_TIMEOUT - time())):
+            self._forget_command(command)
+            self._no_response_count += 1
+            LOGGER.warning('No response after command 0x{:04x} ({})'.format(cmd, self._no_response_count))
+            return
         self._no_response_count = 0
-        LOGGER.debug('STATUS code to command 0x{:04x}:{}'.format(cmd, self._last_status.get(cmd)))
-        return self._last_status.get(cmd)
+        LOGGER.debug('STATUS code to command 0x{:04x}:{}'.format(cmd, command.status))
+        return command.status
+
+    def _wait_sequence_response(self, command):
+        '''
+        wait for response with the sequence of command status
+        '''
+        if not command.response_event.wait(STATUS_TIMEOUT):
+            self._forget_command(command)
+            LOGGER.warning('No response 0x{:04x} after command 0x{:04x}'.format(command.sequence_response,
+                                                                                command.cmd))
+        return command.response
 
     def __addr(self, addr):
         ''' convert hex string addr to int '''
@@ -663,9 +1144,7 @@ class ZiGate(object):
 
     def get_device_from_ieee(self, ieee):
         if ieee:
-            for d in self._devices.values():
-                if d.ieee == ieee:
-                    return d
+            return self._devices.find_ieee(ieee)
 
     def get_devices_list(self, wait=False):
         '''
@@ -701,14 +1180,14 @@ class ZiGate(object):
         '''
         erase persistent data in zigate
         '''
-        self._devices = {}
+        self._devices.clear()
         return self.send_data(0x0012)
 
     def factory_reset(self):
         '''
         ZLO/ZLL "Factory New" Reset
         '''
-        self._devices = {}
+        self._devices.clear()
         return self.send_data(0x0013)
 
     def is_permitting_join(self):
@@ -725,11 +1204,13 @@ class ZiGate(object):
         Set internal zigate time
         dt should be datetime.datetime object
         '''
+        self.send_data(0x0016, self._time_data(dt))
+
+    def _time_data(self, dt=None):
         dt = dt or datetime.datetime.now()
         # timestamp from 2001-01-01 00:00:00
         timestamp = int((dt - datetime.datetime(2001, 1, 1)).total_seconds())
-        data = struct.pack('!L', timestamp)
-        self.send_data(0x0016, data)
+        return struct.pack('!L', timestamp)
 
     def getTime(self):
         '''
@@ -766,27 +1247,43 @@ class ZiGate(object):
         '''
         set channel
         '''
+        channels = self._channels_list(channels)
+        r = self.send_data(0x0021, self._channel_mask(channels))
+        self._on_success(r, self._network.__setitem__, 'channels', channels)
+        return r
+
+    def _channels_list(self, channels=None):
         channels = channels or [11, 14, 15, 19, 20, 24, 25]
         if not isinstance(channels, list):
             channels = [channels]
+        return sorted(set(channels))
+
+    def _channel_mask(self, channels):
         mask = functools.reduce(lambda acc, x: acc ^ 2 ** x, channels, 0)
-        mask = struct.pack('!I', mask)
-        return self.send_data(0x0021, mask)
+        return struct.pack('!I', mask)
 
     def set_type(self, typ=TYPE_COORDINATOR):
         '''
         set zigate mode type
         '''
         data = struct.pack('!B', typ)
-        self.send_data(0x0023, data)
+        r = self.send_data(0x0023, data)
+        self._on_success(r, self._network.__setitem__, 'type', typ)
+        return r
 
     def get_network_state(self):
         ''' get network state '''
         r = self.send_data(0x0009, wait_response=0x8009)
+        return self._update_network_state(r)
+
+    def _update_network_state(self, r):
         if r:
             data = r.cleaned_data()
             self._addr = data['addr']
             self._ieee = data['ieee']
+            if data.get('extend_pan'):
+                self._network['extend_pan'] = data['extend_pan']
+                self._network['channel'] = data['channel']
             return data
 
     def start_network(self, wait=False):
@@ -822,6 +1319,8 @@ class ZiGate(object):
         '''
         bind
         if dst_addr not specified, supposed zigate
+        cluster could be a list, requests are then pipelined
+        and a list of responses is returned
         '''
         if not dst_addr:
             dst_addr = self.ieee
@@ -838,9 +1337,14 @@ class ZiGate(object):
             dst_addr_fmt = 'Q'
         ieee = self.__addr(ieee)
         dst_addr = self.__addr(dst_addr)
+        wait_response = cmd + 0x8000
+        if isinstance(cluster, list):
+            datas = [struct.pack('!QBHB' + dst_addr_fmt + 'B', ieee, endpoint,
+                                 c, dst_addr_mode, dst_addr, dst_endpoint)
+                     for c in cluster]
+            return self._send_batch(cmd, datas, wait_response)
         data = struct.pack('!QBHB' + dst_addr_fmt + 'B', ieee, endpoint,
                            cluster, dst_addr_mode, dst_addr, dst_endpoint)
-        wait_response = cmd + 0x8000
         return self.send_data(cmd, data, wait_response)
 
     def bind(self, ieee, endpoint, cluster, dst_addr=None, dst_endpoint=1):
@@ -950,16 +1454,30 @@ class ZiGate(object):
         data = struct.pack('!HB', addr, index)
         return self.send_data(0x004e, data)
 
-    def refresh_device(self, addr):
+    def refresh_device(self, addr, force=False):
         '''
-        convenient function to refresh device info by calling
+        convenient function to refresh device info by
+        (re)starting device interview:
         node descriptor
-        power descriptor
         active endpoint request
+        simple descriptor request for each endpoint
+        create actions, bind, report and read attributes
+        if force, bind and report are configured again
+        even if they were already successful
+        '''
+        device = self.get_device_from_addr(addr)
+        if force and device:
+            device.clear_bind_report()
+        return self._interviews.start(addr, restart=True)
+
+    def bind_report(self, addr, endpoint=None, force=False):
+        '''
+        bind and configure reporting of actuators clusters (see BIND_REPORT)
+        already configured clusters are skipped unless force
         '''
-        self.node_descriptor_request(addr)
-#         self.power_descriptor_request(addr)
-        self.active_endpoint_request(addr)
+        device = self.get_device_from_addr(addr)
+        if device:
+            device._bind_report(endpoint, force=force)
 
     def discover_device(self, addr):
         '''
@@ -973,7 +1491,13 @@ class ZiGate(object):
         # step 5 attribute discovery request then step 7
         # step 6 load config template
         # step 7 create actions, bind and report if needed
-        self.active_endpoint_request(addr)
+        return self._interviews.start(addr, STEP_ACTIVE_ENDPOINT)
+
+    def get_interview(self, addr):
+        '''
+        return unfinished interview of device addr
+        '''
+        return self._interviews.get(addr)
 
     def _generate_addr(self):
         addr = None
@@ -1005,12 +1529,14 @@ class ZiGate(object):
                            src_endpoint, endpoint, group)
         r = self.send_data(cmd, data)
         group_addr = self.__haddr(group)
-        if r == 0:
-            if group_addr not in self._groups:
-                self._groups[group_addr] = set()
-            self._groups[group_addr].add((self.__haddr(addr), endpoint))
+        self._on_success(r, self._group_added, group_addr, self.__haddr(addr), endpoint)
         return group_addr
 
+    def _group_added(self, group_addr, addr, endpoint):
+        if group_addr not in self._groups:
+            self._groups[group_addr] = set()
+        self._groups[group_addr].add((addr, endpoint))
+
     def add_group(self, addr, endpoint, group=None):
         '''
         Add group
@@ -1070,11 +1596,7 @@ class ZiGate(object):
         data = struct.pack('!BHBBH', addr_mode, addr,
                            src_endpoint, endpoint, group)
         r = self.send_data(0x0063, data)
-        if r == 0:
-            if group:
-                del self._groups[self.__haddr(group)]
-            else:
-                self._groups = {}
+        self._on_success(r, self._groups.pop, self.__haddr(group), None)
         return r
 
     def identify_device(self, addr, time_sec=10):
@@ -1257,202 +1779,138 @@ class ZiGate(object):
                            manufacturer_code, length, *attributes_data)
         self.send_data(0x0110, data)
 
-    def reporting_request(self, addr, endpoint, cluster, attribute, attribute_type,
-                          direction=0, manufacturer_code=0):
+    def reporting_request(self, addr, endpoint, cluster, attribute, attribute_type=None,
+                          direction=0, manufacturer_code=0,
+                          min_interval=0, max_interval=0, change=0):
         '''
         Configure reporting request
-        for now support only one attribute
-        '''
+        attribute could be a unique attribute id (of type attribute_type)
+        or a list of tuple (attribute_id, attribute_type)
+        or (attribute_id, attribute_type, min_interval, max_interval, change)
+        all attributes are configured in a single request
+        '''
+        data = self._reporting_data(addr, endpoint, cluster, attribute, attribute_type,
+                                    direction, manufacturer_code,
+                                    min_interval, max_interval, change)
+        return self.send_data(0x0120, data, 0x8120)
+
+    def _reporting_data(self, addr, endpoint, cluster, attribute, attribute_type=None,
+                        direction=0, manufacturer_code=0,
+                        min_interval=0, max_interval=0, change=0):
         addr = self.__addr(addr)
-#         if not isinstance(attributes, list):
-#             attributes = [attributes]
-#         length = len(attributes)
-        length = 1
+        if not isinstance(attribute, list):
+            attribute = [(attribute, attribute_type)]
+        length = len(attribute)
         attribute_direction = 0
-#         attribute_type = 0
-        attribute_id = attribute
-        min_interval = 0
-        max_interval = 0
         timeout = 0
-        change = 0
+        attributes_data = []
+        for record in attribute:
+            record = tuple(record) + (min_interval, max_interval, change)[len(record) - 2:]
+            attribute_id, attribute_type, r_min_interval, r_max_interval, r_change = record
+            attributes_data += [attribute_direction, attribute_type, attribute_id,
+                                r_min_interval, r_max_interval, timeout, r_change]
         manufacturer_specific = manufacturer_code != 0
-        data = struct.pack('!BHBBHBBHBBBHHHHB', 2, addr, 1, endpoint, cluster,
+        return struct.pack('!BHBBHBBHB' + 'BBHHHHB' * length, 2, addr, 1, endpoint, cluster,
                            direction, manufacturer_specific,
-                           manufacturer_code, length, attribute_direction,
-                           attribute_type, attribute_id, min_interval,
-                           max_interval, timeout, change)
-        self.send_data(0x0120, data, 0x8120)
+                           manufacturer_code, length, *attributes_data)
 
-    def ota_load_image(self, path_to_file):
-        # Check that ota process is not active
-        if self._ota['active'] is True:
-            LOGGER.error('Cannot load image while OTA process is active.')
-            self.get_ota_status()
-            return
+    def configure_reporting(self, addr, endpoint, config):
+        '''
+        Configure reporting of several clusters
+        config is a dict {cluster_id: attributes} (see reporting_request)
+        one request by cluster, requests are pipelined
+        return dict {cluster_id: response}
+        '''
+        clusters = sorted(config.keys())
+        datas = [self._reporting_data(addr, endpoint, c, config[c]) for c in clusters]
+        return dict(zip(clusters, self._send_batch(0x0120, datas, 0x8120)))
 
+    def ota_load_image(self, path_to_file):
+        '''
+        load ota image and send its header to ZiGate
+        several images could be loaded, they are served to devices
+        requesting them concurrently
+        '''
         # Try reading file from user provided path
         try:
-            with open(path_to_file, 'rb') as f:
-                ota_file_content = f.read()
-        except OSError as err:
+            image = OTAImage.from_file(path_to_file)
+        except (OSError, ValueError) as err:
             LOGGER.error('{path}: {error}'.format(path=path_to_file, error=err))
             return False
+        return self._ota_send_header(image)
 
-        # Ensure that file has 69 bytes so it can contain header
-        if len(ota_file_content) < 69:
-            LOGGER.error('OTA file is too short')
-            return False
-
-        # Read header data
+    def ota_load_directory(self, path):
+        '''
+        index all ota images of directory, payloads are memory-mapped
+        block requests are answered with the image requested by the device,
+        use ota_image_notify with manufacturer_code and image_type to select
+        the image header answered by ZiGate to query next image requests
+        return loaded images count
+        '''
         try:
-            header_data = list(struct.unpack('<LHHHHHLH32BLBQHH', ota_file_content[:69]))
-        except struct.error:
-            LOGGER.exception('Header is not correct')
-            return False
-
-        # Fix header str
-        # First replace null characters from header str to spaces
-        for i in range(8, 40):
-            if header_data[i] == 0x00:
-                header_data[i] = 0x20
-        # Reconstruct header data
-        header_data_compact = header_data[0:8] + [header_data[8:40]] + header_data[40:]
-        # Convert header data to dict
-        header_headers = [
-            'file_id', 'header_version', 'header_length', 'header_fctl', 'manufacturer_code', 'image_type',
-            'image_version', 'stack_version', 'header_str', 'size', 'security_cred_version', 'upgrade_file_dest',
-            'min_hw_version', 'max_hw_version'
-        ]
-        header = dict(zip(header_headers, header_data_compact))
-
-        # Check that size from header corresponds to file size
-        if header['size'] != len(ota_file_content):
-            LOGGER.error('Header size({header}) and file size({file}) does not match'.format(
-                header=header['size'], file=len(ota_file_content)
-            ))
-            return False
+            images = self._ota.load_directory(path)
+        except OSError as err:
+            LOGGER.error('{path}: {error}'.format(path=path, error=err))
+            return 0
+        return len(images)
 
+    def _ota_send_header(self, image):
         destination_address_mode = 0x02
         destination_address = 0x0000
-        data = struct.pack('!BHlHHHHHLH32BLBQHH', destination_address_mode, destination_address, *header_data)
+        data = struct.pack('!BHlHHHHHLH32BLBQHH', destination_address_mode, destination_address, *image.header_data)
         response = self.send_data(0x0500, data)
 
-        # If response is success place header and file content to variable
+        # If response is success add image to ota server
         if response == 0:
+            if not self._ota.add_image(image):
+                return False
             LOGGER.info('OTA header loaded to server successfully.')
-            self._ota_reset_local_variables()
-            self._ota['image']['header'] = header
-            self._ota['image']['data'] = ota_file_content
+            return True
         else:
             LOGGER.warning('Something wrong with ota file header.')
+            return False
 
     def _ota_send_image_data(self, request):
-        errors = False
-        # Ensure that image is loaded using ota_load_image
-        if self._ota['image']['header'] is None:
-            LOGGER.error('No header found. Load image using ota_load_image(\'path_to_ota_image\')')
-            errors = True
-        if self._ota['image']['data'] is None:
-            LOGGER.error('No data found. Load image using ota_load_image(\'path_to_ota_ota\')')
-            errors = True
-        if errors:
-            return
-
-        # Compare received image data to loaded image
-        errors = False
-        if request['image_version'] != self._ota['image']['header']['image_version']:
-            LOGGER.error('Image versions do not match. Make sure you have correct image loaded.')
-            errors = True
-        if request['image_type'] != self._ota['image']['header']['image_type']:
-            LOGGER.error('Image types do not match. Make sure you have correct image loaded.')
-            errors = True
-        if request['manufacturer_code'] != self._ota['image']['header']['manufacturer_code']:
-            LOGGER.error('Manufacturer codes do not match. Make sure you have correct image loaded.')
-            errors = True
-        if errors:
-            return
-
-        # Mark ota process started
-        if self._ota['starttime'] is False and self._ota['active'] is False:
-            self._ota['starttime'] = datetime.datetime.now()
-            self._ota['active'] = True
-            self._ota['transfered'] = 0
-            self._ota['addr'] = request['addr']
-
-        source_endpoint = 0x01
-        ota_status = 0x00  # Success. Using value 0x01 would make client to request data again later
-
-        # Get requested bytes from ota file
-        self._ota['transfered'] = request['file_offset']
-        end_position = request['file_offset'] + request['max_data_size']
-        ota_data_to_send = self._ota['image']['data'][request['file_offset']:end_position]
-        data_size = len(ota_data_to_send)
-        ota_data_to_send = struct.unpack('<{}B'.format(data_size), ota_data_to_send)
-
-        # Giving user feedback of ota process
-        self.get_ota_status(debug=True)
-
-        data = struct.pack('!BHBBBBLLHHB{}B'.format(data_size), request['address_mode'], self.__addr(request['addr']),
-                           source_endpoint, request['endpoint'], request['sequence'], ota_status,
-                           request['file_offset'], self._ota['image']['header']['image_version'],
-                           self._ota['image']['header']['image_type'],
-                           self._ota['image']['header']['manufacturer_code'],
-                           data_size, *ota_data_to_send)
-        self.send_data(0x0502, data, wait_status=False)
+        self._ota.block_request(request)
 
     def _ota_handle_upgrade_end_request(self, request):
-        if self._ota['active'] is True:
-            # Handle error statuses
-            if request['status'] == 0x00:
-                LOGGER.info('OTA image upload finnished successfully in {seconds}s.'.format(
-                    seconds=(datetime.datetime.now() - self._ota['starttime']).seconds))
-            elif request['status'] == 0x95:
-                LOGGER.warning('OTA aborted by client')
-            elif request['status'] == 0x96:
-                LOGGER.warning('OTA image upload successfully, but image verification failed.')
-            elif request['status'] == 0x99:
-                LOGGER.warning('OTA image uploaded successfully, but client needs more images for update.')
-            elif request['status'] != 0x00:
-                LOGGER.warning('Some unexpected OTA status {}'.format(request['status']))
-            # Reset local ota variables
-            self._ota_reset_local_variables()
-
-    def _ota_reset_local_variables(self):
-        self._ota = {
-            'image': {
-                'header': None,
-                'data': None,
-            },
-            'active': False,
-            'starttime': False,
-            'transfered': 0,
-            'addr': None
-        }
+        self._ota.end_request(request)
 
     def get_ota_status(self, debug=False):
-        if self._ota['active']:
-            image_size = len(self._ota['image']['data'])
-            time_passed = (datetime.datetime.now() - self._ota['starttime']).seconds
-            try:
-                time_remaining = int((image_size / self._ota['transfered']) * time_passed) - time_passed
-            except ZeroDivisionError:
-                time_remaining = -1
-            message = 'OTA upgrade address {addr}: {sent:>{width}}/{total:>{width}} {percentage:.3%}'.format(
-                addr=self._ota['addr'], sent=self._ota['transfered'], total=image_size,
-                percentage=self._ota['transfered'] / image_size, width=len(str(image_size)))
-            message += ' time elapsed: {passed}s Time remaining estimate: {remaining}s'.format(
-                passed=time_passed, remaining=time_remaining
-            )
-        else:
-            message = "OTA process is not active"
-        if debug:
-            LOGGER.debug(message)
-        else:
-            LOGGER.info(message)
+        '''
+        log status of ota sessions and return them
+        '''
+        sessions = list(self._ota.sessions.values())
+        messages = [session.status_text() for session in sessions]
+        if not messages:
+            messages = ['OTA process is not active']
+        for message in messages:
+            if debug:
+                LOGGER.debug(message)
+            else:
+                LOGGER.info(message)
+        return [session.status() for session in sessions]
+
+    def get_ota_metrics(self):
+        '''
+        return ota pacing and sessions metrics
+        (blocks per second, retries, gaps, bytes transferred)
+        '''
+        return self._ota.get_metrics()
+
+    def ota_set_block_rate(self, max_block_rate):
+        '''
+        set max blocks per second sent to all devices being upgraded
+        0 disables pacing
+        '''
+        self._ota.max_block_rate = max_block_rate
 
-    def ota_image_notify(self, addr, destination_endpoint=0x01, payload_type=0):
+    def ota_image_notify(self, addr, destination_endpoint=0x01, payload_type=0,
+                         manufacturer_code=None, image_type=None):
         """
         Send image available notification to client. This will start ota process
+        if manufacturer_code and image_type are specified, the newest matching image
+        is selected and its header loaded to ZiGate
 
         :param addr:
         :param destination_endpoint:
@@ -1460,13 +1918,20 @@ class ZiGate(object):
         :type payload_type: int
         :return:
         """
+        if manufacturer_code is not None and image_type is not None:
+            image = self._ota.find_image(manufacturer_code, image_type)
+            if image is None:
+                LOGGER.warning('No ota image {:04x}/{:04x} loaded.'.format(manufacturer_code, image_type))
+                return False
+            if image is not self._ota.current and not self._ota_send_header(image):
+                return False
         # Get required data from ota header
-        if self._ota['image']['header'] is None:
+        if self._ota.current is None:
             LOGGER.warning('Cannot read ota header. No ota file loaded.')
             return False
-        image_version = self._ota['image']['header']['image_version']
-        image_type = self._ota['image']['header']['image_type']
-        manufacturer_code = self._ota['image']['header']['manufacturer_code']
+        image_version = self._ota.current.header['image_version']
+        image_type = self._ota.current.header['image_type']
+        manufacturer_code = self._ota.current.header['manufacturer_code']
 
         source_endpoint = 0x01
         destination_address_mode = 0x02  # uint16
@@ -1747,6 +2212,31 @@ class ZiGateWiFi(ZiGate):
         requests.get('http://{}/reboot'.format(self._host))
 
 
+class ZiGateReplay(ZiGate):
+    '''
+    replay a capture file (see start_capture) instead of a real ZiGate
+    at original pacing (divided by speed) if realtime, else as fast as possible
+    there is no auto start since commands are not answered by a capture
+    and no auto save, the state file at path is only read
+    (call save_state explicitly to keep the replayed state)
+    '''
+    def __init__(self, capture, realtime=True, speed=1.0, path='~/.zigate.json',
+                 channel=None):
+        self._capture = capture
+        self._realtime = realtime
+        self._speed = speed
+        ZiGate.__init__(self, port=None, path=path,
+                        auto_start=False,
+                        auto_save=False,
+                        channel=channel
+                        )
+        self.setup_connection()
+
+    def setup_connection(self):
+        if not self.connection:
+            self.connection = ReplayTransport(self, self._capture, self._realtime, self._speed)
+
+
 class DeviceEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Device):
@@ -1760,6 +2250,116 @@ class DeviceEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+class LazyDeviceDict(dict):
+    '''
+    devices dict indexed by addr
+    devices could be stored as raw json records (from persistent file)
+    they are materialised into Device on first access
+    '''
+    def __init__(self, zigate_instance=None):
+        dict.__init__(self)
+        self._zigate = zigate_instance
+        self._raw_ieee = {}  # ieee index of raw records
+        self._lock = threading.RLock()  # materialisation lock
+
+    def add_raw(self, data):
+        '''
+        add raw json device record without decoding it
+        '''
+        info = data.get('info', {})
+        addr = info['addr']
+        dict.__setitem__(self, addr, data)
+        if info.get('ieee'):
+            self._raw_ieee[info['ieee']] = addr
+        return addr
+
+    def update_raw(self, addr, info):
+        '''
+        update info of a raw record if not yet materialised
+        return changed info keys, None if addr is not a raw record of the same device
+        '''
+        record = dict.get(self, addr)
+        if record is None or isinstance(record, Device):
+            return None
+        record_info = record.setdefault('info', {})
+        if record_info.get('ieee') != info.get('ieee'):
+            return None
+        changed = set(k for k, v in info.items() if record_info.get(k) != v)
+        record_info.update(info)
+        return changed
+
+    def is_loaded(self, addr):
+        return isinstance(dict.get(self, addr), Device)
+
+    def _materialise(self, addr):
+        device = dict.__getitem__(self, addr)
+        if isinstance(device, Device):
+            return device
+        with self._lock:  # several threads could access the same raw record
+            device = dict.__getitem__(self, addr)
+            if not isinstance(device, Device):
+                LOGGER.debug('Materialise device {}'.format(addr))
+                device = Device.from_json(device, self._zigate)
+                device._create_actions()
+                dict.__setitem__(self, addr, device)
+                self._raw_ieee.pop(device.info.get('ieee'), None)
+        return device
+
+    def __getitem__(self, addr):
+        return self._materialise(addr)
+
+    def __delitem__(self, addr):
+        device = dict.__getitem__(self, addr)
+        if not isinstance(device, Device):
+            self._raw_ieee.pop(device.get('info', {}).get('ieee'), None)
+        dict.__delitem__(self, addr)
+
+    def get(self, addr, default=None):
+        if addr in self:
+            return self._materialise(addr)
+        return default
+
+    def pop(self, addr, *default):
+        if addr not in self and default:
+            return default[0]
+        device = self._materialise(addr)
+        dict.__delitem__(self, addr)
+        return device
+
+    def values(self):
+        return [self._materialise(addr) for addr in list(self.keys())]
+
+    def items(self):
+        return [(addr, self._materialise(addr)) for addr in list(self.keys())]
+
+    def clear(self):
+        dict.clear(self)
+        self._raw_ieee.clear()
+
+    def records(self):
+        '''
+        return devices and raw records without materialising them
+        '''
+        return list(dict.values(self))
+
+    def raw_items(self):
+        '''
+        return (addr, device or raw record) without materialising them
+        '''
+        return list(dict.items(self))
+
+    def find_ieee(self, ieee):
+        '''
+        return device matching ieee
+        '''
+        addr = self._raw_ieee.get(ieee)
+        if addr is not None and addr in self:
+            return self._materialise(addr)
+        for device in dict.values(self):
+            if isinstance(device, Device) and device.ieee == ieee:
+                return device
+
+
 class Device(object):
     def __init__(self, info=None, zigate_instance=None):
         self._zigate = zigate_instance
@@ -1768,6 +2368,8 @@ class Device(object):
         self.endpoints = {}
         self._expire_timer = {}
         self.missing = False
+        self.version = 0  # incremented on each change
+        self._json_cache = {}  # encoded json by properties flag
 
     def available_actions(self, endpoint_id=None):
         '''
@@ -1819,9 +2421,13 @@ class Device(object):
                     functools.update_wrapper(wfunc, func)
                     setattr(self, func_name, wfunc)
 
-    def _bind_report(self, enpoint_id=None):
+    def _bind_report(self, enpoint_id=None, clusters=None, force=False):
         '''
         automatically bind and report data for light
+        clusters could restrict the list of clusters to bind
+        successfully bound clusters are stored in endpoint['bound']
+        and successful reporting configuration in endpoint['reporting']
+        so they are not configured again, unless force is True
         '''
         if not BIND_REPORT_LIGHT:
             return
@@ -1830,25 +2436,40 @@ class Device(object):
         else:
             endpoints_list = self.endpoints.items()
         for endpoint_id, endpoint in endpoints_list:
-            if endpoint['device'] in ACTUATORS:  # light
-                if 0x0006 in endpoint['in_clusters']:
-                    LOGGER.debug('bind and report for cluster 0x0006')
-                    self._zigate.bind_addr(self.addr, endpoint_id, 0x0006)
-                    self._zigate.reporting_request(self.addr, endpoint_id,
-                                                   0x0006, 0x0000, 0x10)  # TODO: auto select data type
-                if 0x0008 in endpoint['in_clusters']:
-                    LOGGER.debug('bind and report for cluster 0x0008')
-                    self._zigate.bind_addr(self.addr, endpoint_id, 0x0008)
-                    self._zigate.reporting_request(self.addr, endpoint_id,
-                                                   0x0008, 0x0000, 0x20)
-                # TODO : auto select data type
-                # TODO : check if the following is needed
-                if 0x0300 in endpoint['in_clusters']:
-                    LOGGER.debug('bind and report for cluster 0x0300')
-                    self._zigate.bind_addr(self.addr, endpoint_id, 0x0300)
-                    for i in range(9):  # all color informations
-                        self._zigate.reporting_request(self.addr, endpoint_id,
-                                                       0x0300, i, 0x20)
+            if endpoint['device'] not in ACTUATORS:  # light
+                continue
+            config = {cluster_id: attributes for cluster_id, attributes in BIND_REPORT.items()
+                      if cluster_id in endpoint['in_clusters'] and (clusters is None or cluster_id in clusters)}
+            if force:
+                endpoint['bound'] = []
+                endpoint['reporting'] = {}
+            bound = endpoint.setdefault('bound', [])
+            reporting = endpoint.setdefault('reporting', {})
+            to_bind = sorted([cluster_id for cluster_id in config if cluster_id not in bound])
+            to_report = {cluster_id: attributes for cluster_id, attributes in config.items()
+                         if reporting.get(cluster_id) != [list(a) for a in attributes]}
+            if to_bind:
+                LOGGER.debug('bind clusters {}'.format(to_bind))
+                responses = self._zigate.bind_addr(self.addr, endpoint_id, to_bind) or []
+                bound += [cluster_id for cluster_id, r in zip(to_bind, responses)
+                          if r and r.get('status', None) == 0]
+            if to_report:
+                LOGGER.debug('configure reporting for clusters {}'.format(sorted(to_report.keys())))
+                responses = self._zigate.configure_reporting(self.addr, endpoint_id, to_report)
+                for cluster_id, r in responses.items():
+                    if r and r.get('status', None) == 0:
+                        reporting[cluster_id] = [list(a) for a in to_report[cluster_id]]
+            self.touch()
+
+    def clear_bind_report(self):
+        '''
+        forget bind and reporting configuration
+        so they are configured again on next setup
+        '''
+        for endpoint in self.endpoints.values():
+            endpoint['bound'] = []
+            endpoint['reporting'] = {}
+        self.touch()
 
     @staticmethod
     def from_json(data, zigate_instance=None):
@@ -1870,6 +2491,8 @@ class Device(object):
                 endpoint['device'] = ep.get('device', 0)
                 endpoint['in_clusters'] = ep.get('in_clusters', [])
                 endpoint['out_clusters'] = ep.get('out_clusters', [])
+                endpoint['bound'] = ep.get('bound', [])
+                endpoint['reporting'] = {r['cluster']: r['attributes'] for r in ep.get('reporting', [])}
                 for cl in ep['clusters']:
                     cluster = Cluster.from_json(cl, endpoint)
                     endpoint['clusters'][cluster.cluster_id] = cluster
@@ -1888,13 +2511,34 @@ class Device(object):
                             'profile': v['profile'],
                             'device': v['device'],
                             'in_clusters': v['in_clusters'],
-                            'out_clusters': v['out_clusters']
+                            'out_clusters': v['out_clusters'],
+                            'bound': v.get('bound', []),
+                            'reporting': [{'cluster': cluster_id, 'attributes': attributes}
+                                          for cluster_id, attributes in v.get('reporting', {}).items()]
                             } for k, v in self.endpoints.items()],
              }
         if properties:
             r['properties'] = list(self.properties)
         return r
 
+    def touch(self):
+        '''
+        mark device as changed, invalidate json cache
+        '''
+        self.version += 1
+
+    def to_json_bytes(self, properties=False):
+        '''
+        return device encoded in json, cached until device changes
+        '''
+        version = self.version
+        cache = self._json_cache.get(properties)
+        if cache and cache[0] == version:
+            return cache[1]
+        data = json.dumps(self.to_json(properties), cls=DeviceEncoder).encode()
+        self._json_cache[properties] = (version, data)
+        return data
+
     def __str__(self):
         name = self.get_property_value('type', '')
         manufacturer = self.get_property_value('manufacturer', 'Device')
@@ -1920,7 +2564,9 @@ class Device(object):
 
     @rssi.setter
     def rssi(self, value):
-        self.info['rssi'] = value
+        if self.info.get('rssi') != value:
+            self.info['rssi'] = value
+            self.touch()
 
     @property
     def last_seen(self):
@@ -1972,8 +2618,8 @@ class Device(object):
             typ = self.get_value('type')
         return typ
 
-    def refresh_device(self):
-        self._zigate.refresh_device(self.addr)
+    def refresh_device(self, force=False):
+        self._zigate.refresh_device(self.addr, force)
 
     def identify_device(self, time_sec=10):
         '''
@@ -1990,11 +2636,13 @@ class Device(object):
 
     def __setitem__(self, key, value):
         self.info[key] = value
+        self.touch()
 
     def __getitem__(self, key):
         return self.info[key]
 
     def __delitem__(self, key):
+        self.touch()
         return self.info.__delitem__(key)
 
     def get(self, key, default):
@@ -2025,12 +2673,14 @@ class Device(object):
         self._lock.acquire()
         self.info.update(device.info)
         self.endpoints.update(device.endpoints)
+        self.touch()
 #         self.info['last_seen'] = strftime('%Y-%m-%d %H:%M:%S')
         self._lock.release()
 
     def update_info(self, info):
         self._lock.acquire()
         self.info.update(info)
+        self.touch()
         self._lock.release()
 
     def get_endpoint(self, endpoint_id):
@@ -2042,6 +2692,7 @@ class Device(object):
                                            'in_clusters': [],
                                            'out_clusters': [],
                                            }
+            self.touch()
         self._lock.release()
         return self.endpoints[endpoint_id]
 
@@ -2051,6 +2702,7 @@ class Device(object):
         if cluster_id not in endpoint['clusters']:
             cluster = get_cluster(cluster_id, endpoint)
             endpoint['clusters'][cluster_id] = cluster
+            self.touch()
         self._lock.release()
         return endpoint['clusters'][cluster_id]
 
@@ -2064,6 +2716,7 @@ class Device(object):
         cluster = self.get_cluster(endpoint_id, cluster_id)
         self._lock.acquire()
         r = cluster.update(data)
+        self.touch()
         if r:
             added, attribute = r
             if 'expire' in attribute:
@@ -2106,6 +2759,7 @@ class Device(object):
             new_value = type(value)()
         attribute['value'] = new_value
         attribute['data'] = new_value
+        self.touch()
         attribute = self.get_attribute(endpoint_id,
                                        cluster_id,
                                        attribute_id,
@@ -2242,6 +2896,22 @@ class Device(object):
                 need = True
         return need
 
+    @staticmethod
+    def json_need_refresh(data):
+        '''
+        same as need_refresh on a raw json record (see to_json)
+        '''
+        if not data.get('info', {}).get('ieee') or not data.get('endpoints'):
+            return True
+        for endpoint in data['endpoints']:
+            for cluster in endpoint.get('clusters', []):
+                if cluster['cluster'] != 0x0000:
+                    continue
+                for attribute in cluster['attributes']:
+                    if attribute.get('name') == 'type' and attribute.get('value'):
+                        return False
+        return True
+
     def _avoid_duplicate(self):
         '''
         Rename attribute if needed to avoid duplicate
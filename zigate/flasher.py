@@ -14,7 +14,10 @@ import functools
 import itertools
 import logging
 import struct
+import zlib
+from collections import deque
 from operator import xor
+from time import sleep, time
 
 import serial
 from serial.tools.list_ports import comports
@@ -26,6 +29,9 @@ ZIGATE_CHIP_ID = 0x10408686
 ZIGATE_BINARY_VERSION = bytes.fromhex('07030008')
 ZIGATE_FLASH_START = 0x00000000
 ZIGATE_FLASH_END = 0x00040000
+ZIGATE_BLOCK_SIZE = 128
+ZIGATE_SECTOR_SIZE = 0x8000
+ZIGATE_BAUDRATES = (1000000, 500000, 250000, 115200)  # tried in order by auto baudrate
 
 
 class Command:
@@ -135,6 +141,11 @@ def req_flash_read(addr, length):
     return (addr, length)
 
 
+@Command(0x0d, '!B')
+def req_sector_erase(sector):
+    return sector
+
+
 @Command(0x1f, '<LH')
 def req_ram_read(addr, length):
     return (addr, length)
@@ -200,14 +211,69 @@ class GetChipIDResponse(Response):
 
 
 def change_baudrate(ser, baudrate):
+    if not try_change_baudrate(ser, baudrate):
+        logger.exception('Change baudrate failed')
+        raise SystemExit(1)
+
+
+def try_change_baudrate(ser, baudrate):
     ser.write(req_change_baudrate(baudrate))
 
     res = read_response(ser)
     if not res or not res.ok:
-        logger.exception('Change baudrate failed')
-        raise SystemExit(1)
+        return False
 
     ser.baudrate = baudrate
+    return True
+
+
+def probe_link(ser):
+    '''
+    return True if the bootloader answers a chip id request at current baudrate
+    '''
+    ser.write(req_chip_id())
+    try:
+        res = read_response(ser)
+    except struct.error:  # garbled response
+        return False
+    return bool(res) and res.ok and isinstance(res, GetChipIDResponse)
+
+
+def force_baudrate(ser, baudrate):
+    '''
+    change baudrate without waiting for the response,
+    which is lost if the link doesn't work at current baudrate
+    '''
+    ser.write(req_change_baudrate(baudrate))
+    sleep(0.1)
+    ser.baudrate = baudrate
+    ser.reset_input_buffer()
+
+
+def negotiate_baudrate(ser, baudrates=ZIGATE_BAUDRATES):
+    '''
+    switch to the highest baudrate accepted by the bootloader
+    and checked by a chip id request, fallback to next baudrate
+    and finally to 38400 if the link doesn't work
+    '''
+    link_ok = True
+    for baudrate in baudrates:
+        if link_ok:
+            if not try_change_baudrate(ser, baudrate):
+                continue
+        else:
+            force_baudrate(ser, baudrate)
+        if probe_link(ser):
+            print('Using baudrate %d' % baudrate)
+            return baudrate
+        print('No answer at baudrate %d' % baudrate)
+        link_ok = False
+    force_baudrate(ser, 38400)
+    if probe_link(ser):
+        print('Using baudrate 38400')
+        return 38400
+    print('Change baudrate failed')
+    raise SystemExit(1)
 
 
 def check_chip_id(ser):
@@ -273,34 +339,161 @@ def write_flash_to_file(ser, filename):
             cur += read_bytes
 
 
-def write_file_to_flash(ser, filename):
-    print('writing new flash from %s' % filename)
+def read_image(filename):
+    '''
+    return firmware content of image or dump file
+    '''
     with open(filename, 'rb') as fd:
-        ser.write(req_flash_erase())
+        bin_ver = fd.read(4)
+        if bin_ver != ZIGATE_BINARY_VERSION:
+            print('Not a valid image for Zigate')
+            raise SystemExit(1)
+        return fd.read(ZIGATE_FLASH_END)
+
+
+def read_flash(ser, addr, length):
+    data = b''
+    end = addr + length
+    while addr < end:
+        read_bytes = min(ZIGATE_BLOCK_SIZE, end - addr)
+        ser.write(req_flash_read(addr, read_bytes))
         res = read_response(ser)
         if not res or not res.ok:
-            print('Erasing flash failed')
+            print('reading failed at 0x%08x' % addr)
             raise SystemExit(1)
+        data += res.data
+        addr += read_bytes
+    return data
 
-        # flash_start = cur = ZIGATE_FLASH_START
-        cur = ZIGATE_FLASH_START
-        flash_end = ZIGATE_FLASH_END
 
-        bin_ver = fd.read(4)
-        if bin_ver != ZIGATE_BINARY_VERSION:
-            print('Not a valid image for Zigate')
-            raise SystemExit(1)
-        read_bytes = 128
-        while cur < flash_end:
-            data = fd.read(read_bytes)
-            if not data:
-                break
-            ser.write(req_flash_write(cur, data))
+def erase_sector(ser, sector):
+    '''
+    return False if sector erase failed or is not supported by bootloader
+    '''
+    ser.write(req_sector_erase(sector))
+    res = read_response(ser)
+    return bool(res) and res.ok
+
+
+def write_blocks(ser, image, start=0, end=None, window=1, skip_empty=True):
+    '''
+    write image[start:end] to flash at same address
+    window is the number of write requests sent before waiting for responses
+    blocks full of 0xFF are not written if skip_empty
+    return written and skipped blocks count
+    '''
+    end = min(len(image), end or len(image))
+    empty = b'\xff' * ZIGATE_BLOCK_SIZE
+    pending = deque()  # (addr, data) waiting for response
+    written = skipped = 0
+    cur = start
+    while cur < end or pending:
+        if cur < end:
+            data = image[cur:min(cur + ZIGATE_BLOCK_SIZE, end)]
+            if skip_empty and data == empty[:len(data)]:
+                skipped += 1
+            else:
+                ser.write(req_flash_write(ZIGATE_FLASH_START + cur, data))
+                pending.append((cur, data))
+            cur += len(data)
+        while pending and (len(pending) >= window or cur >= end):
+            addr, block = pending.popleft()
             res = read_response(ser)
-            if not res.ok:
-                print('writing failed at 0x%08x, status: 0x%x, data: %s' % (cur, res.status, data.hex()))
+            if not res or not res.ok:
+                status = res.status if res else -1
+                print('writing failed at 0x%08x, status: 0x%x, data: %s' % (addr, status, block.hex()))
+                print('resume with --offset 0x%08x' % addr)
                 raise SystemExit(1)
-            cur += read_bytes
+            written += 1
+    return written, skipped
+
+
+def write_file_to_flash(ser, filename, window=1, offset=0, skip_empty=True):
+    '''
+    write firmware file to flash
+    window is the number of write requests sent before waiting for responses
+    offset resumes an interrupted write, flash is not erased in this case
+    blocks full of 0xFF are not written since flash is erased
+    '''
+    print('writing new flash from %s' % filename)
+    image = read_image(filename)
+
+    offset -= offset % ZIGATE_BLOCK_SIZE
+    if offset:
+        print('resuming at 0x%08x' % offset)
+    else:
+        ser.write(req_flash_erase())
+        res = read_response(ser)
+        if not res or not res.ok:
+            print('Erasing flash failed')
+            raise SystemExit(1)
+
+    t1 = time()
+    written, skipped = write_blocks(ser, image, offset, window=window, skip_empty=skip_empty)
+    print('%d blocks written, %d empty blocks skipped in %.1fs' % (written, skipped, time() - t1))
+
+
+def verify_flash(ser, image, sectors=None):
+    '''
+    read back flash and compare sectors checksum with image
+    return sectors which differ
+    '''
+    if sectors is None:
+        sectors = range(0, len(image), ZIGATE_SECTOR_SIZE)
+    bad = []
+    for addr in sectors:
+        expected = image[addr:addr + ZIGATE_SECTOR_SIZE]
+        data = read_flash(ser, ZIGATE_FLASH_START + addr, len(expected))
+        if zlib.crc32(data) != zlib.crc32(expected):
+            print('verify failed for sector at 0x%08x' % addr)
+            bad.append(addr)
+    return bad
+
+
+def write_diff_to_flash(ser, filename, reference=None, window=1):
+    '''
+    rewrite only sectors which differ from reference dump
+    (see write_flash_to_file) or live flash if reference is None,
+    written sectors are verified by read-back
+    fallback to full write if bootloader cannot erase a sector
+    sectors after the end of image are erased if old firmware was longer
+    '''
+    print('writing changes from %s' % filename)
+    image = read_image(filename)
+    if reference:
+        old = read_image(reference)
+        old_end = len(old)
+    else:  # firmware length from its header, see write_flash_to_file
+        (old_end,) = struct.unpack('>L', read_flash(ser, ZIGATE_FLASH_START + 0x20, 4))
+        old_end = min(old_end, ZIGATE_FLASH_END)
+    if old_end > len(image):  # erased flash is full of 0xFF
+        image += b'\xff' * (old_end - len(image))
+    t1 = time()
+    sectors = []
+    for addr in range(0, len(image), ZIGATE_SECTOR_SIZE):
+        new = image[addr:addr + ZIGATE_SECTOR_SIZE]
+        if reference:
+            current = old[addr:addr + len(new)]
+        else:
+            current = read_flash(ser, ZIGATE_FLASH_START + addr, len(new))
+        if new != current:
+            sectors.append(addr)
+    print('%d/%d sectors changed' % (len(sectors), -(-len(image) // ZIGATE_SECTOR_SIZE)))
+    written = skipped = 0
+    for addr in sectors:
+        if not erase_sector(ser, (ZIGATE_FLASH_START + addr) // ZIGATE_SECTOR_SIZE):
+            print('Sector erase not supported, writing whole flash')
+            write_file_to_flash(ser, filename, window)
+            sectors = None
+            break
+        w, s = write_blocks(ser, image, addr, addr + ZIGATE_SECTOR_SIZE, window)
+        written += w
+        skipped += s
+    else:
+        print('%d blocks written, %d empty blocks skipped in %.1fs' % (written, skipped, time() - t1))
+    if verify_flash(ser, image, sectors):
+        raise SystemExit(1)
+    print('verify ok')
 
 
 def main():
@@ -310,6 +503,16 @@ def main():
                         help='Serial port, e.g. /dev/ttyUSB0', required=True)
     parser.add_argument('-w', '--write', help='Firmware bin to flash onto the chip')
     parser.add_argument('-s', '--save', help='File to save the currently loaded firmware to')
+    parser.add_argument('-b', '--baudrate', default='115200',
+                        help='Baudrate used to flash or "auto" for the highest working one (default: 115200)')
+    parser.add_argument('--window', type=int, default=1,
+                        help='Write requests sent before waiting for responses (default: 1)')
+    parser.add_argument('--offset', type=functools.partial(int, base=0), default=0,
+                        help='Resume an interrupted write at offset, flash is not erased')
+    parser.add_argument('--no_skip', action='store_true', help='Also write blocks full of 0xFF')
+    parser.add_argument('--diff', nargs='?', const='',
+                        help='Only rewrite sectors which differ from dump file (or live flash if omitted)')
+    parser.add_argument('--verify', action='store_true', help='Read back flash after write')
     args = parser.parse_args()
     try:
         ser = serial.Serial(args.serialport, 38400, timeout=5)
@@ -319,7 +522,10 @@ def main():
 
     atexit.register(change_baudrate, ser, 38400)
 
-    change_baudrate(ser, 115200)
+    if args.baudrate == 'auto':
+        negotiate_baudrate(ser)
+    else:
+        change_baudrate(ser, int(args.baudrate))
     check_chip_id(ser)
     flash_type = get_flash_type(ser)
     mac_address = get_mac(ser)
@@ -330,8 +536,14 @@ def main():
     if args.save:
         write_flash_to_file(ser, args.save)
 
-    if args.write:
-        write_file_to_flash(ser, args.write)
+    if args.write and args.diff is not None:
+        write_diff_to_flash(ser, args.write, args.diff, max(args.window, 1))
+    elif args.write:
+        write_file_to_flash(ser, args.write, max(args.window, 1), args.offset, not args.no_skip)
+        if args.verify:
+            if verify_flash(ser, read_image(args.write)):
+                raise SystemExit(1)
+            print('verify ok')
 
 
 if __name__ == "__main__":
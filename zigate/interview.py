@@ -0,0 +1,396 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+
+import threading
+import logging
+import traceback
+import queue
+from collections import OrderedDict
+
+LOGGER = logging.getLogger('zigate')
+
+INTERVIEW_CONCURRENCY = 4  # max devices interviewed at the same time
+INTERVIEW_TIMEOUT = 10  # seconds to wait for a step response
+INTERVIEW_RETRY = 3  # retry count of a step before pausing the interview
+
+# interview steps
+STEP_NODE_DESCRIPTOR = 'node_descriptor'
+STEP_MODEL = 'model'  # read manufacturer and type to look for a template
+STEP_ACTIVE_ENDPOINT = 'active_endpoint'
+STEP_SIMPLE_DESCRIPTOR = 'simple_descriptor'
+STEP_SETUP = 'setup'  # create actions, bind, report and read attributes
+STEP_DONE = 'done'
+STEPS = [STEP_NODE_DESCRIPTOR,
+         STEP_MODEL,
+         STEP_ACTIVE_ENDPOINT,
+         STEP_SIMPLE_DESCRIPTOR,
+         STEP_SETUP,
+         STEP_DONE]
+
+
+class Interview(object):
+    '''
+    interview progress of a device
+    '''
+    def __init__(self, addr, step=STEP_NODE_DESCRIPTOR, endpoints=None, retry=0,
+                 template=False):
+        self.addr = addr
+        self.step = step
+        self.endpoints = endpoints or []  # endpoints waiting for simple descriptor
+        self.retry = retry
+        self.template = template  # endpoints loaded from model template
+        self.running = False
+        self.paused = False
+        self._timer = None
+
+    def __str__(self):
+        return 'Interview {} step {} (retry {})'.format(self.addr, self.step, self.retry)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def next_step(self):
+        return STEPS[STEPS.index(self.step) + 1]
+
+    def to_json(self):
+        return {'addr': self.addr,
+                'step': self.step,
+                'endpoints': self.endpoints,
+                'retry': self.retry,
+                'template': self.template}
+
+    @staticmethod
+    def from_json(data):
+        return Interview(data['addr'], data.get('step', STEP_NODE_DESCRIPTOR),
+                         data.get('endpoints'), data.get('retry', 0),
+                         data.get('template', False))
+
+
+class InterviewManager(object):
+    '''
+    Run devices interviews step by step
+    at most `concurrency` devices are interviewed at the same time,
+    a step is retried on timeout and unfinished interviews are persisted
+    so they could be resumed after restart
+    '''
+    def __init__(self, zigate, concurrency=INTERVIEW_CONCURRENCY):
+        self._zigate = zigate
+        self.concurrency = concurrency
+        self.timeout = INTERVIEW_TIMEOUT
+        self.retry = INTERVIEW_RETRY
+        self._lock = threading.RLock()
+        self._interviews = OrderedDict()
+        self._actions = queue.Queue()
+        self._thread = None  # worker started on first queued action
+
+    def _worker(self):
+        '''
+        requests are sent from this thread so the event loop
+        is never blocked waiting for a status
+        '''
+        while True:
+            action = self._actions.get()
+            if action is None:  # stopped
+                break
+            func, args = action
+            try:
+                func(*args)
+            except Exception:
+                LOGGER.error('Exception during interview')
+                LOGGER.error(traceback.format_exc())
+
+    def _queue(self, func, *args):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker,
+                                                name='ZiGate-Interview')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._actions.put((func, args))
+
+    def setup_endpoint(self, addr, endpoint):
+        '''
+        setup an endpoint described outside of an interview
+        '''
+        self._queue(self._setup_endpoint, addr, endpoint)
+
+    def _setup_endpoint(self, addr, endpoint):
+        device = self._zigate.get_device_from_addr(addr)
+        if device and endpoint in device.endpoints:
+            self._zigate._setup_endpoint(device, endpoint)
+
+    def describe_endpoints(self, addr, endpoints):
+        '''
+        request simple descriptors of endpoints listed outside of an interview
+        '''
+        for endpoint in endpoints:
+            self._queue(self._zigate.simple_descriptor_request, addr, endpoint)
+
+    @property
+    def running(self):
+        return [i for i in self._interviews.values() if i.running]
+
+    def get(self, addr):
+        return self._interviews.get(addr)
+
+    def is_pending(self, addr):
+        '''
+        return True if an unfinished interview exists for addr
+        '''
+        return addr in self._interviews
+
+    def start(self, addr, step=None, restart=False):
+        '''
+        queue interview of device addr
+        resume from last known step unless restart or step is specified
+        '''
+        with self._lock:
+            interview = self._interviews.get(addr)
+            if interview and (restart or step):
+                self._cancel_timer(interview)
+                interview = None
+            if interview is None:
+                interview = Interview(addr, step or STEP_NODE_DESCRIPTOR)
+                self._interviews[addr] = interview
+            elif interview.running:
+                return interview
+            interview.paused = False
+            interview.retry = 0
+            LOGGER.debug('Queue {}'.format(interview))
+            self._next()
+        return interview
+
+    def _next(self):
+        '''
+        start waiting interviews while concurrency allows it
+        '''
+        with self._lock:
+            running = len(self.running)
+            for interview in self._interviews.values():
+                if running >= self.concurrency:
+                    break
+                if interview.running or interview.paused:
+                    continue
+                interview.running = True
+                running += 1
+                self._queue(self._run_step, interview.addr)
+
+    def _run_step(self, addr):
+        with self._lock:
+            interview = self._interviews.get(addr)
+            if not interview or not interview.running:
+                return
+            step = interview.step
+            endpoints = list(interview.endpoints)
+            self._start_timer(interview)
+        LOGGER.debug('Run {}'.format(interview))
+        if step == STEP_NODE_DESCRIPTOR:
+            self._zigate.node_descriptor_request(addr)
+        elif step == STEP_MODEL:
+            self._zigate._model_request(addr)
+        elif step == STEP_ACTIVE_ENDPOINT:
+            self._zigate.active_endpoint_request(addr)
+        elif step == STEP_SIMPLE_DESCRIPTOR:
+            for endpoint in endpoints:
+                self._zigate.simple_descriptor_request(addr, endpoint)
+        elif step == STEP_SETUP:
+            device = self._zigate.get_device_from_addr(addr)
+            if device:
+                for endpoint_id in list(device.endpoints.keys()):
+                    self._zigate._setup_endpoint(device, endpoint_id, interview.template)
+            with self._lock:
+                self._advance(interview)
+        else:
+            with self._lock:
+                self._finish(interview)
+
+    def _start_timer(self, interview):
+        self._cancel_timer(interview)
+        interview._timer = threading.Timer(self.timeout,
+                                           self._queue,
+                                           (self._timeout, interview.addr, interview.step))
+        interview._timer.setDaemon(True)
+        interview._timer.start()
+
+    def _cancel_timer(self, interview):
+        if interview._timer:
+            interview._timer.cancel()
+            interview._timer = None
+
+    def _timeout(self, addr, step):
+        with self._lock:
+            interview = self._interviews.get(addr)
+            if not interview or not interview.running or interview.step != step:
+                return
+            if step == STEP_MODEL:
+                LOGGER.debug('Unknown model, continue with full discovery {}'.format(interview))
+                self._advance(interview)
+                return
+            interview.retry += 1
+            if interview.retry > self.retry:
+                LOGGER.warning('{} failed, pause it'.format(interview))
+                self._cancel_timer(interview)
+                interview.running = False
+                interview.paused = True
+                self._next()
+                return
+            LOGGER.debug('Timeout, retry {}'.format(interview))
+        self._run_step(addr)
+
+    def _advance(self, interview, step=None):
+        self._cancel_timer(interview)
+        interview.retry = 0
+        interview.step = step or interview.next_step()
+        if interview.step == STEP_DONE:
+            self._finish(interview)
+        else:
+            self._queue(self._run_step, interview.addr)
+
+    def _finish(self, interview):
+        LOGGER.debug('Interview {} done'.format(interview.addr))
+        self._cancel_timer(interview)
+        interview.running = False
+        if self._interviews.get(interview.addr) is interview:
+            del self._interviews[interview.addr]
+            self._queue(self._zigate._update_template, interview.addr)
+        self._next()
+
+    def _current(self, addr, step):
+        interview = self._interviews.get(addr)
+        if interview and interview.running and interview.step == step:
+            return interview
+
+    def node_descriptor_received(self, addr):
+        '''
+        return True if the response belongs to an interview
+        '''
+        with self._lock:
+            interview = self._current(addr, STEP_NODE_DESCRIPTOR)
+            if interview:
+                self._advance(interview)
+                return True
+        return False
+
+    def model_received(self, addr):
+        '''
+        return True if the response belongs to an interview
+        '''
+        with self._lock:
+            interview = self._current(addr, STEP_MODEL)
+            if interview:
+                self._cancel_timer(interview)
+                self._queue(self._check_template, interview)
+                return True
+        return False
+
+    def _check_template(self, interview):
+        '''
+        skip endpoints discovery if a template exists for this model
+        '''
+        template = self._zigate._apply_template(interview.addr)
+        with self._lock:
+            if not interview.running or interview.step != STEP_MODEL:
+                return
+            if template:
+                LOGGER.debug('Template found for {}'.format(interview.addr))
+                interview.template = True
+                self._advance(interview, STEP_SETUP)
+            else:
+                self._advance(interview)
+
+    def active_endpoints_received(self, addr, endpoints):
+        '''
+        return True if the response belongs to an interview
+        '''
+        with self._lock:
+            interview = self._current(addr, STEP_ACTIVE_ENDPOINT)
+            if interview:
+                interview.endpoints = list(endpoints)
+                self._advance(interview)
+                if not interview.endpoints and interview.step == STEP_SIMPLE_DESCRIPTOR:
+                    self._advance(interview)
+                return True
+        return False
+
+    def simple_descriptor_received(self, addr, endpoint):
+        '''
+        return True if the response belongs to an interview
+        '''
+        with self._lock:
+            interview = self._current(addr, STEP_SIMPLE_DESCRIPTOR)
+            if interview:
+                if endpoint in interview.endpoints:
+                    interview.endpoints.remove(endpoint)
+                if not interview.endpoints:
+                    self._advance(interview)
+                return True
+        return False
+
+    def remove(self, addr):
+        with self._lock:
+            interview = self._interviews.pop(addr, None)
+            if interview:
+                self._cancel_timer(interview)
+                interview.running = False
+                self._next()
+
+    def rename(self, old_addr, new_addr):
+        '''
+        move interview of a device which joined again with another addr,
+        a running step is sent again to the new addr
+        return the interview or None if there's no interview for old_addr
+        '''
+        with self._lock:
+            interview = self._interviews.pop(old_addr, None)
+            if not interview:
+                return
+            self._cancel_timer(interview)
+            previous = self._interviews.pop(new_addr, None)
+            if previous:
+                self._cancel_timer(previous)
+            interview.addr = new_addr
+            self._interviews[new_addr] = interview
+            if interview.running:
+                self._queue(self._run_step, new_addr)
+            else:
+                self._next()
+            return interview
+
+    def stop(self):
+        '''
+        cancel timers and stop the worker thread,
+        pending actions are dropped, interviews are resumed on next start
+        '''
+        with self._lock:
+            for interview in self._interviews.values():
+                self._cancel_timer(interview)
+                interview.running = False
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            while not self._actions.empty():
+                try:
+                    self._actions.get_nowait()
+                except queue.Empty:
+                    break
+            self._actions.put(None)
+        if thread is not threading.current_thread():
+            thread.join(5)
+
+    def to_json(self):
+        with self._lock:
+            return [interview.to_json() for interview in self._interviews.values()]
+
+    def load(self, data):
+        '''
+        load persisted interviews, they will be resumed on next start
+        '''
+        with self._lock:
+            for d in data:
+                interview = Interview.from_json(d)
+                interview.paused = True  # wait for start to resume it
+                self._interviews[interview.addr] = interview
@@ -7,17 +7,61 @@
 
 from pydispatch import dispatcher
 import logging
+import threading
+import itertools
+import queue
+from time import time, sleep
+from collections import OrderedDict
 from .const import (ZIGATE_ATTRIBUTE_ADDED, ZIGATE_ATTRIBUTE_UPDATED,
                     ZIGATE_DEVICE_ADDED, ZIGATE_DEVICE_REMOVED, ZIGATE_DEVICE_UPDATED)
-from zigate.core import DeviceEncoder
+from zigate.core import DeviceEncoder, Device, ACTUATORS
 import paho.mqtt.client as mqtt
 import json
 
+MQTT_DELTA = False  # publish only changed info and attributes on device_changed
+MQTT_SNAPSHOT_INTERVAL = 60  # seconds between full device snapshots in delta mode
+MQTT_COALESCE = 0  # seconds to merge attributes updates of a device, 0 to publish immediately
+MQTT_RATE_LIMIT = 0  # max publish per second, 0 for no limit
+MQTT_WORKERS = 4  # threads executing zigate/command
+MQTT_COMMAND_QUEUE = 100  # max commands waiting by worker
+
+# publish priority when rate limited, lowest first
+PRIORITY_ACTUATOR = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_SNAPSHOT = 2
+
 
 class MQTT_Broker(object):
-    def __init__(self, zigate, mqtt_host='localhost:1883', username=None, password=None):
+    def __init__(self, zigate, mqtt_host='localhost:1883', username=None, password=None,
+                 delta=MQTT_DELTA, snapshot_interval=MQTT_SNAPSHOT_INTERVAL,
+                 coalesce=MQTT_COALESCE, rate_limit=MQTT_RATE_LIMIT, workers=MQTT_WORKERS):
         self._mqtt_host = mqtt_host
         self.zigate = zigate
+        self.delta = delta
+        self.snapshot_interval = snapshot_interval
+        self._published = {}  # last published info and attributes by addr
+        self._snapshots = set()  # addr of devices changed since last snapshot
+        self._lock = threading.Lock()
+        self._snapshot_timer = None
+        self.coalesce = coalesce
+        self._coalesced = {}  # attributes waiting to be published by addr
+        self._deadlines = OrderedDict()  # publish time of coalesced attributes by addr, oldest first
+        self._flush = threading.Condition(self._lock)
+        self._flusher = None  # thread started on first coalesced attribute
+        self.rate_limit = rate_limit
+        self._outbox = queue.PriorityQueue()
+        self._outbox_count = itertools.count()
+        if rate_limit:
+            t = threading.Thread(target=self._sender, name='ZiGate-MQTT-Sender')
+            t.setDaemon(True)
+            t.start()
+        self._commands = []  # one queue by worker
+        for i in range(max(1, workers)):
+            q = queue.Queue(MQTT_COMMAND_QUEUE)
+            t = threading.Thread(target=self._worker, args=(q,), name='ZiGate-MQTT-Worker{}'.format(i))
+            t.setDaemon(True)
+            t.start()
+            self._commands.append(q)
         self.client = mqtt.Client()
         if username is not None:
             self.client.username_pw_set(username, password)
@@ -33,6 +77,8 @@ class MQTT_Broker(object):
         host, port = self._mqtt_host.split(':')
         port = int(port)
         self.client.connect(host, port)
+        if self.delta and not self._snapshot_timer:
+            self.publish_snapshots()
 
     def start(self):
         self.connect()
@@ -40,53 +86,295 @@ class MQTT_Broker(object):
         self.zigate.start_auto_save()
         self.client.loop_forever()
 
-    def _publish(self, topic, payload=None):
-        if payload:
+    def _publish(self, topic, payload=None, retain=True, priority=PRIORITY_DEFAULT):
+        if isinstance(payload, Device):
+            payload = payload.to_json_bytes()  # shared cache
+        elif payload:
             payload = json.dumps(payload, cls=DeviceEncoder)
-        logging.info('Publish {}'.format(topic))
-        self.client.publish(topic, payload, retain=True)
+        if self.rate_limit:
+            self._outbox.put((priority, next(self._outbox_count), topic, payload, retain))
+            return
+        logging.debug('Publish {}'.format(topic))
+        self.client.publish(topic, payload, retain=retain)
+
+    def _sender(self):
+        '''
+        publish queued messages, at most rate_limit by second
+        actuators first
+        '''
+        next_time = time()
+        while True:
+            delay = next_time - time()
+            if delay > 0:  # wait before picking the message so priority is up to date
+                sleep(delay)
+            priority, count, topic, payload, retain = self._outbox.get()
+            logging.debug('Publish {}'.format(topic))
+            self.client.publish(topic, payload, retain=retain)
+            next_time = max(next_time, time()) + 1.0 / self.rate_limit
 
     def device_changed(self, device):
         logging.debug('device_changed {}'.format(device))
-        self._publish('zigate/device_changed/{}'.format(device.addr), device)
+        if not self.delta:
+            self._publish('zigate/device_changed/{}'.format(device.addr), device)
+            return
+        delta = self._device_delta(device)
+        if delta:
+            self._publish('zigate/device_changed/{}'.format(device.addr), delta, False)
+
+    def _device_delta(self, device):
+        '''
+        return info and attributes changed since last publish
+        '''
+        attributes = device.get_attributes(True)
+        with self._lock:
+            last = self._published.setdefault(device.addr, {'info': {}, 'attributes': {}})
+            info = {k: v for k, v in device.info.items() if last['info'].get(k) != v}
+            changed = [attribute for attribute in attributes
+                       if last['attributes'].get((attribute['endpoint'],
+                                                  attribute['cluster'],
+                                                  attribute['attribute'])) != attribute]
+            if not info and not changed:
+                return
+            last['info'].update(info)
+            for attribute in changed:
+                last['attributes'][(attribute['endpoint'],
+                                    attribute['cluster'],
+                                    attribute['attribute'])] = attribute
+            self._snapshots.add(device.addr)
+        delta = {'addr': device.addr}
+        if info:
+            delta['info'] = info
+        if changed:
+            delta['attributes'] = changed
+        return delta
+
+    def publish_snapshots(self, full=False):
+        '''
+        publish full retained device on zigate/device_snapshot/[addr]
+        for devices changed since last snapshot, or for all devices if full
+        '''
+        with self._lock:
+            addrs = self._snapshots
+            self._snapshots = set()
+        if full:
+            devices = self.zigate.devices
+        else:
+            devices = [self.zigate.get_device_from_addr(addr) for addr in addrs]
+        for device in devices:
+            if device:
+                self._publish('zigate/device_snapshot/{}'.format(device.addr), device, priority=PRIORITY_SNAPSHOT)
+        if full:
+            return
+        self._snapshot_timer = threading.Timer(self.snapshot_interval, self.publish_snapshots)
+        self._snapshot_timer.setDaemon(True)
+        self._snapshot_timer.start()
 
     def device_removed(self, addr):
         logging.debug('device_removed {}'.format(addr))
+        with self._lock:
+            self._published.pop(addr, None)
+            self._snapshots.discard(addr)
+            self._coalesced.pop(addr, None)
+            self._deadlines.pop(addr, None)
         self._publish('zigate/device_removed', addr)
 
-    def attribute_changed(self, attribute):
+    def attribute_changed(self, attribute, device=None):
         logging.debug('attribute_changed {}'.format(attribute))
+        priority = PRIORITY_DEFAULT
+        if self._is_actuator(attribute, device):
+            priority = PRIORITY_ACTUATOR
+        if not self.coalesce:
+            self._publish_attribute(attribute, priority)
+            return
+        addr = attribute['addr']
+        with self._lock:
+            pending = self._coalesced.setdefault(addr, OrderedDict())
+            pending.pop((attribute['endpoint'], attribute['cluster'], attribute['attribute']), None)
+            pending[(attribute['endpoint'], attribute['cluster'], attribute['attribute'])] = (attribute, priority)
+            if addr not in self._deadlines:
+                self._deadlines[addr] = time() + self.coalesce
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flusher_loop, name='ZiGate-MQTT-Flusher')
+                    self._flusher.setDaemon(True)
+                    self._flusher.start()
+                self._flush.notify()
+
+    def _flusher_loop(self):
+        '''
+        publish coalesced attributes when their window is over,
+        one thread for all devices instead of a timer by device
+        '''
+        while True:
+            with self._lock:
+                while not self._deadlines:
+                    self._flush.wait()
+                addr, deadline = next(iter(self._deadlines.items()))
+                delay = deadline - time()
+                if delay > 0:
+                    self._flush.wait(delay)
+                    continue
+                del self._deadlines[addr]
+                pending = self._coalesced.pop(addr, None)
+            self._publish_attributes(addr, pending)
+
+    def _publish_attribute(self, attribute, priority=PRIORITY_DEFAULT):
         self._publish('zigate/attribute_changed/{0[addr]}/'
                       '{0[endpoint]:02x}/{0[cluster]:04x}/'
-                      '{0[attribute]:04x}'.format(attribute), attribute)
+                      '{0[attribute]:04x}'.format(attribute), attribute, priority=priority)
+
+    def _publish_attributes(self, addr, pending):
+        '''
+        publish attributes updated during coalesce window
+        in one message on zigate/attributes_changed/[addr]
+        and the last value of each one on its retained topic
+        '''
+        if not pending:
+            return
+        priority = min([p for attribute, p in pending.values()])
+        self._publish('zigate/attributes_changed/{}'.format(addr),
+                      [attribute for attribute, p in pending.values()],
+                      False, priority)
+        for attribute, p in pending.values():
+            self._publish_attribute(attribute, p)
+
+    def _is_actuator(self, attribute, device=None):
+        device = device or self.zigate.get_device_from_addr(attribute['addr'])
+        if not device:
+            return False
+        endpoint = device.endpoints.get(attribute['endpoint'])
+        return bool(endpoint) and endpoint.get('device') in ACTUATORS
 
     def on_connect(self, client, userdata, flags, rc):
         logging.info("MQTT connected with result code {}".format(rc))
         client.subscribe("zigate/command/#")
+        if self.delta:  # retained snapshots may be missing or outdated after (re)connection
+            self.publish_snapshots(True)
 
     def on_message(self, client, userdata, msg):
         payload = {}
         if msg.payload:
             payload = json.loads(msg.payload.decode())
+        if msg.topic == 'zigate/command/batch' and isinstance(payload, list):
+            payload = {'commands': payload}
+        if not isinstance(payload, dict):
+            logging.error('Invalid command {}'.format(payload))
+            return
         if msg.topic == 'zigate/command':
-            func_name = payload.get('function')
-            args = payload.get('args', [])
-            if hasattr(self.zigate, func_name):
-                func = getattr(self.zigate, func_name)
-                if callable(func):
-                    try:
-                        result = func(*args)
-                    except Exception:
-                        result = None
-                        logging.error('Error calling function {}'.format(func_name))
-                else:
-                    result = func
-                if result:
-                    self._publish('zigate/command/result', {'function': func_name,
-                                                            'result': result
-                                                            })
+            self._queue_command(payload)
+        elif msg.topic == 'zigate/command/batch':
+            payload['function'] = 'batch'
+            self._queue_command(payload)
+
+    def _queue_command(self, payload):
+        '''
+        commands are executed by workers so the mqtt loop is never blocked
+        commands for the same device (first arg) are run by the same worker, in order
+        '''
+        args = payload.get('args', [])
+        key = args[0] if isinstance(args, list) and args and isinstance(args[0], str) else payload.get('function')
+        if not isinstance(key, str):
+            key = None
+        q = self._commands[hash(key) % len(self._commands)]
+        try:
+            q.put_nowait(payload)
+        except queue.Full:
+            logging.error('Too many commands waiting, ignore {}'.format(payload.get('function')))
+            self._publish_result(payload, None, 'Too many commands waiting')
+
+    def _worker(self, q):
+        while True:
+            payload = q.get()
+            try:
+                self._execute(payload)
+            except Exception:
+                logging.exception('Error executing command {}'.format(payload))
+
+    def _execute(self, payload):
+        if 'commands' in payload:
+            self._execute_batch(payload)
+            return
+        func_name = payload.get('function')
+        args = payload.get('args', [])
+        if not isinstance(func_name, str) or not func_name:
+            logging.error('Missing function in command {}'.format(payload))
+            self._publish_result(payload, None, 'Missing function')
+        elif not isinstance(args, list):
+            logging.error('Invalid args in command {}'.format(payload))
+            self._publish_result(payload, None, 'Invalid args')
+        elif hasattr(self.zigate, func_name):
+            func = getattr(self.zigate, func_name)
+            error = None
+            if callable(func):
+                try:
+                    result = func(*args)
+                except Exception as e:
+                    result = None
+                    error = str(e)
+                    logging.error('Error calling function {}'.format(func_name))
             else:
-                logging.error('ZiGate has no function named {}'.format(func_name))
+                result = func
+            self._publish_result(payload, result, error)
+        else:
+            logging.error('ZiGate has no function named {}'.format(func_name))
+            self._publish_result(payload, None, 'ZiGate has no function named {}'.format(func_name))
+
+    def _execute_batch(self, payload):
+        '''
+        run batch commands pipelined, publish one result for all commands
+        '''
+        commands = payload['commands']
+        if not isinstance(commands, list):
+            logging.error('Invalid batch commands {}'.format(commands))
+            self._publish_result(payload, None, 'Invalid batch commands')
+            return
+        results = [None] * len(commands)
+        calls = []
+        indexes = []
+        for i, command in enumerate(commands):
+            if not isinstance(command, dict):
+                results[i] = {'function': None, 'result': None, 'error': 'Invalid command'}
+                continue
+            func_name = command.get('function')
+            func = getattr(self.zigate, func_name, None) if isinstance(func_name, str) and func_name else None
+            if not isinstance(command.get('args', []), list):
+                results[i] = {'function': func_name, 'result': None, 'error': 'Invalid args'}
+            elif func is None:
+                results[i] = {'function': func_name, 'result': None,
+                              'error': 'ZiGate has no function named {}'.format(func_name)}
+            elif not callable(func):
+                results[i] = {'function': func_name, 'result': func}
+            else:
+                calls.append((func, command.get('args', [])))
+                indexes.append(i)
+        for i, result in zip(indexes, self.zigate.run_pipelined(calls)):
+            func_name = commands[i].get('function')
+            if isinstance(result, Exception):
+                results[i] = {'function': func_name, 'result': None, 'error': str(result)}
+            else:
+                results[i] = {'function': func_name, 'result': result}
+        r = {'function': 'batch', 'result': results}
+        if payload.get('id') is not None:
+            r['id'] = payload['id']
+        self._publish('zigate/command/result', r, False)
+
+    def _publish_result(self, payload, result, error=None):
+        '''
+        publish result on zigate/command/result
+        if request has an id, it's added to the result, which is always published
+        '''
+        correlation_id = payload.get('id')
+        if correlation_id is None:
+            if result:
+                self._publish('zigate/command/result', {'function': payload.get('function'),
+                                                        'result': result
+                                                        })
+            return
+        r = {'id': correlation_id,
+             'function': payload.get('function'),
+             'result': result}
+        if error:
+            r['error'] = error
+        self._publish('zigate/command/result', r, False)
 
 
 if __name__ == '__main__':
@@ -101,6 +389,14 @@ if __name__ == '__main__':
     parser.add_argument('--mqtt_host', help='MQTT host:port', default='localhost:1883')
     parser.add_argument('--mqtt_username', help='MQTT username', default=None)
     parser.add_argument('--mqtt_password', help='MQTT password', default=None)
+    parser.add_argument('--delta', help='Publish only changes on device_changed', action='store_true')
+    parser.add_argument('--snapshot_interval', help='Seconds between full device snapshots in delta mode',
+                        type=int, default=MQTT_SNAPSHOT_INTERVAL)
+    parser.add_argument('--coalesce', help='Seconds to merge attributes updates of a device',
+                        type=float, default=MQTT_COALESCE)
+    parser.add_argument('--rate_limit', help='Max publish per second', type=float, default=MQTT_RATE_LIMIT)
+    parser.add_argument('--workers', help='Threads executing commands', type=int, default=MQTT_WORKERS)
+    parser.add_argument('--raw_port', help='Also relay raw frames on this TCP port', type=int, default=None)
     args = parser.parse_args()
 
     if ':' in args.device:  # supposed IP:PORT
@@ -108,5 +404,9 @@ if __name__ == '__main__':
         z = ZiGateWiFi(host, port, auto_start=False, path=args.path)
     else:
         z = ZiGate(args.device, auto_start=False, path=args.path)
-    broker = MQTT_Broker(z, args.mqtt_host, args.mqtt_username, args.mqtt_password)
+    if args.raw_port:
+        from zigate.broker import Broker
+        Broker(z, args.raw_port, tap=True).start()
+    broker = MQTT_Broker(z, args.mqtt_host, args.mqtt_username, args.mqtt_password,
+                         args.delta, args.snapshot_interval, args.coalesce, args.rate_limit, args.workers)
     broker.start()
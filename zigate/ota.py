@@ -0,0 +1,453 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+
+import threading
+import logging
+import struct
+import mmap
+import os
+import datetime
+from time import time
+from pydispatch import dispatcher
+from .const import ZIGATE_OTA_PROGRESS
+
+LOGGER = logging.getLogger('zigate')
+
+OTA_CONCURRENCY = 4  # max devices upgraded at the same time
+OTA_SESSION_TIMEOUT = 60  # seconds without block request before a session is considered lost
+OTA_STATUS_SUCCESS = 0x00
+OTA_STATUS_WAIT = 0x01  # client will request data again later
+OTA_PROGRESS_INTERVAL = 5  # min seconds between two progress events of a session
+OTA_MAX_BLOCK_RATE = 0  # max blocks per second for all sessions, 0 to disable pacing
+OTA_MIN_BLOCK_RATE = 2  # block rate never goes below
+OTA_RATE_DECREASE = 0.75  # block rate factor applied on retry
+
+HEADER_FORMAT = '<LHHHHHLH32BLBQHH'
+HEADER_SIZE = 69
+HEADER_FIELDS = ['file_id', 'header_version', 'header_length', 'header_fctl', 'manufacturer_code', 'image_type',
+                 'image_version', 'stack_version', 'header_str', 'size', 'security_cred_version',
+                 'upgrade_file_dest', 'min_hw_version', 'max_hw_version']
+# 0x0502 block response header, followed by block data
+BLOCK_HEADER = struct.Struct('!BHBBBBLLHHB')
+
+
+def parse_header(data):
+    '''
+    parse ota file header
+    return header dict and raw header values list
+    raise ValueError if header is not correct
+    '''
+    # Ensure that file has 69 bytes so it can contain header
+    if len(data) < HEADER_SIZE:
+        raise ValueError('OTA file is too short')
+    try:
+        header_data = list(struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE]))
+    except struct.error:
+        raise ValueError('Header is not correct')
+    # Fix header str
+    # First replace null characters from header str to spaces
+    for i in range(8, 40):
+        if header_data[i] == 0x00:
+            header_data[i] = 0x20
+    # Reconstruct header data
+    header_data_compact = header_data[0:8] + [header_data[8:40]] + header_data[40:]
+    header = dict(zip(HEADER_FIELDS, header_data_compact))
+    return header, header_data
+
+
+class OTAImage(object):
+    '''
+    loaded ota image, shared by all sessions
+    data is memory-mapped when loaded from file
+    '''
+    def __init__(self, header, header_data, data, path=None):
+        self.header = header
+        self.header_data = header_data
+        self.data = data
+        self.path = path
+        self.view = memoryview(data)
+
+    def __str__(self):
+        return 'OTA image {:04x}/{:04x}/{:08x}'.format(*self.key)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def key(self):
+        return (self.header['manufacturer_code'],
+                self.header['image_type'],
+                self.header['image_version'])
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    @staticmethod
+    def from_file(path):
+        '''
+        load image from file, only the header is read, payload is memory-mapped
+        raise ValueError if file is not a correct ota image
+        '''
+        with open(path, 'rb') as f:
+            header, header_data = parse_header(f.read(HEADER_SIZE))
+            file_size = os.fstat(f.fileno()).st_size
+            # Check that size from header corresponds to file size
+            if header['size'] != file_size:
+                raise ValueError('Header size({header}) and file size({file}) does not match'.format(
+                    header=header['size'], file=file_size))
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return OTAImage(header, header_data, data, path)
+
+
+def scan_directory(path):
+    '''
+    load all valid ota images found in directory
+    invalid files are ignored
+    '''
+    images = []
+    for filename in sorted(os.listdir(path)):
+        filepath = os.path.join(path, filename)
+        if not os.path.isfile(filepath):
+            continue
+        try:
+            images.append(OTAImage.from_file(filepath))
+        except (OSError, ValueError) as e:
+            LOGGER.debug('Ignore {}: {}'.format(filepath, e))
+    return images
+
+
+class OTASession(object):
+    '''
+    upgrade of a device with an image
+    '''
+    def __init__(self, addr, image):
+        self.addr = addr
+        self.image = image
+        self.starttime = datetime.datetime.now()
+        self.transfered = 0
+        self.last_request = time()
+        self.last_progress = 0
+        self.start = time()
+        self.blocks = 0  # blocks sent
+        self.bytes = 0  # bytes sent
+        self.retries = 0  # blocks requested again
+        self.gaps = 0  # blocks skipped by client
+        self.waits = 0  # requests answered with wait status
+        self.next_offset = None
+        self.block_request_delay = 0  # last delay requested by client (ms)
+        self.max_data_size = 0  # last block size requested by client
+
+    def __str__(self):
+        return 'OTA session {} {}'.format(self.addr, self.image)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def record(self, request, size):
+        '''
+        record sent block
+        return True if block was already sent (retry)
+        '''
+        offset = request['file_offset']
+        self.block_request_delay = request['block_request_delay']
+        self.max_data_size = request['max_data_size']
+        retry = self.next_offset is not None and offset < self.next_offset
+        if retry:
+            self.retries += 1
+        elif self.next_offset is not None and offset > self.next_offset:
+            self.gaps += 1
+        self.blocks += 1
+        self.bytes += size
+        self.next_offset = offset + size
+        return retry
+
+    def metrics(self):
+        elapsed = max(time() - self.start, 0.001)
+        return {'blocks': self.blocks,
+                'bytes': self.bytes,
+                'retries': self.retries,
+                'gaps': self.gaps,
+                'waits': self.waits,
+                'blocks_per_second': self.blocks / elapsed,
+                'bytes_per_second': self.bytes / elapsed,
+                'block_request_delay': self.block_request_delay,
+                'max_data_size': self.max_data_size}
+
+    def status(self):
+        image_size = self.image.size
+        time_passed = (datetime.datetime.now() - self.starttime).seconds
+        metrics = self.metrics()
+        if metrics['bytes_per_second'] > 0:
+            time_remaining = int((image_size - self.transfered) / metrics['bytes_per_second'])
+        else:
+            time_remaining = -1
+        status = {'addr': self.addr,
+                  'image': self.image.key,
+                  'transfered': self.transfered,
+                  'size': image_size,
+                  'percentage': self.transfered / image_size,
+                  'time_passed': time_passed,
+                  'time_remaining': time_remaining}
+        status.update(metrics)
+        return status
+
+    def status_text(self):
+        status = self.status()
+        message = 'OTA upgrade address {addr}: {sent:>{width}}/{total:>{width}} {percentage:.3%}'.format(
+            addr=self.addr, sent=self.transfered, total=status['size'],
+            percentage=status['percentage'], width=len(str(status['size'])))
+        message += ' time elapsed: {passed}s Time remaining estimate: {remaining}s'.format(
+            passed=status['time_passed'], remaining=status['time_remaining']
+        )
+        message += ' ({rate:.1f} blocks/s, {retries} retries)'.format(
+            rate=status['blocks_per_second'], retries=status['retries'])
+        return message
+
+
+class OTAServer(object):
+    '''
+    Serve ota images to devices
+    images are shared, each device being upgraded has its own session,
+    at most `concurrency` devices are upgraded at the same time,
+    others are asked to request data later
+
+    blocks are paced for all sessions with a token bucket of block_rate
+    blocks per second, requests above the rate are answered with wait status.
+    block_rate is adaptive: it is decreased on retries (lost blocks)
+    and slowly increased up to max_block_rate otherwise, max_block_rate=0
+    (default) disables pacing
+    '''
+    def __init__(self, zigate, concurrency=OTA_CONCURRENCY):
+        self._zigate = zigate
+        self.concurrency = concurrency
+        self.session_timeout = OTA_SESSION_TIMEOUT
+        self.images = {}  # images by (manufacturer_code, image_type, image_version)
+        self.sessions = {}  # sessions by (addr, image key)
+        self.current = None  # last loaded image
+        self.progress_interval = OTA_PROGRESS_INTERVAL
+        self._tokens = OTA_MAX_BLOCK_RATE
+        self._tokens_time = time()
+        self.max_block_rate = OTA_MAX_BLOCK_RATE
+        self._lock = threading.RLock()
+
+    @property
+    def max_block_rate(self):
+        return self._max_block_rate
+
+    @max_block_rate.setter
+    def max_block_rate(self, max_block_rate):
+        '''
+        pacing restarts from max_block_rate
+        '''
+        self._max_block_rate = max_block_rate
+        self.block_rate = max_block_rate
+        self._tokens = min(self._tokens, max_block_rate)
+
+    @property
+    def active(self):
+        return len(self.sessions) > 0
+
+    def add_image(self, image, current=True):
+        '''
+        add image to server, return False if image is being uploaded
+        current means its header is loaded in ZiGate
+        '''
+        with self._lock:
+            previous = self.images.get(image.key)
+            if previous is not image:
+                if any(key[1] == image.key for key in self.sessions):
+                    LOGGER.error('Cannot load image while OTA process is active for {}.'.format(image))
+                    return False
+                if previous:
+                    previous.close()
+            self.images[image.key] = image
+            if current:
+                self.current = image
+        return True
+
+    def close(self):
+        '''
+        close all images, sessions are dropped
+        '''
+        with self._lock:
+            for image in self.images.values():
+                image.close()
+            self.images = {}
+            self.sessions = {}
+            self.current = None
+
+    def load_directory(self, path):
+        '''
+        index all images of directory
+        return loaded images
+        '''
+        images = [image for image in scan_directory(path) if self.add_image(image, False)]
+        LOGGER.info('{} OTA images loaded from {}'.format(len(images), path))
+        return images
+
+    def get_image(self, manufacturer_code, image_type, image_version):
+        return self.images.get((manufacturer_code, image_type, image_version))
+
+    def find_image(self, manufacturer_code, image_type, image_version=None):
+        '''
+        return the newest image for manufacturer and image type
+        or the given version
+        '''
+        if image_version is not None:
+            return self.get_image(manufacturer_code, image_type, image_version)
+        images = [image for key, image in self.images.items() if key[:2] == (manufacturer_code, image_type)]
+        if images:
+            return max(images, key=lambda image: image.header['image_version'])
+
+    def _expire_sessions(self):
+        now = time()
+        for key, session in list(self.sessions.items()):
+            if now - session.last_request > self.session_timeout:
+                LOGGER.warning('{} lost, remove it'.format(session))
+                del self.sessions[key]
+
+    def block_request(self, request):
+        '''
+        answer block request
+        '''
+        image = self.get_image(request['manufacturer_code'], request['image_type'], request['image_version'])
+        if image is None:
+            LOGGER.error('No image {:04x}/{:04x}/{:08x} loaded for {}. '
+                         'Load image using ota_load_image(\'path_to_ota_image\') '
+                         'or ota_load_directory(\'path_to_ota_images\')'.format(
+                             request['manufacturer_code'], request['image_type'],
+                             request['image_version'], request['addr']))
+            return
+        key = (request['addr'], image.key)
+        with self._lock:
+            session = self.sessions.get(key)
+            if session is None:
+                self._expire_sessions()
+                if len(self.sessions) >= self.concurrency:
+                    LOGGER.debug('Too many OTA sessions, {} will request later'.format(request['addr']))
+                    self._send_block(request, image, OTA_STATUS_WAIT, 0)
+                    return
+                session = OTASession(request['addr'], image)
+                self.sessions[key] = session
+                LOGGER.info('Start {}'.format(session))
+            now = time()
+            session.last_request = now
+            if not self._take_token(now):
+                session.waits += 1
+                self._send_block(request, image, OTA_STATUS_WAIT, 0)
+                return session
+            session.transfered = request['file_offset']
+            progress = now - session.last_progress >= self.progress_interval
+            if progress:
+                session.last_progress = now
+        size = self._send_block(request, image, OTA_STATUS_SUCCESS, request['max_data_size'])
+        with self._lock:
+            self._adapt_rate(session.record(request, size))
+        if progress or request['file_offset'] + size >= image.size:
+            self._progress(session)
+        return session
+
+    def _take_token(self, now):
+        '''
+        return False if block rate is reached
+        '''
+        if not self.max_block_rate:
+            return True
+        self._tokens = min(self.block_rate, self._tokens + (now - self._tokens_time) * self.block_rate)
+        self._tokens_time = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _adapt_rate(self, retry):
+        if not self.max_block_rate:
+            return
+        if retry:
+            self.block_rate = max(OTA_MIN_BLOCK_RATE, self.block_rate * OTA_RATE_DECREASE)
+        else:  # about one more block per second each second
+            self.block_rate = min(self.max_block_rate, self.block_rate + 1 / self.block_rate)
+
+    def _send_block(self, request, image, status, size):
+        '''
+        send block response, block data is sliced from the image without copy
+        return block size
+        '''
+        source_endpoint = 0x01
+        addr = request['addr']
+        if isinstance(addr, str):
+            addr = int(addr, 16)
+        offset = request['file_offset']
+        block = image.view[offset:offset + size]
+        header = BLOCK_HEADER.pack(request['address_mode'], addr,
+                                   source_endpoint, request['endpoint'], request['sequence'], status,
+                                   offset, image.header['image_version'],
+                                   image.header['image_type'],
+                                   image.header['manufacturer_code'],
+                                   len(block))
+        self._zigate.send_data(0x0502, b''.join((header, block)), wait_status=False)
+        return len(block)
+
+    def _progress(self, session):
+        LOGGER.debug(session.status_text())
+        try:
+            dispatcher.send(ZIGATE_OTA_PROGRESS, self._zigate, session=session, status=session.status())
+        except Exception:
+            LOGGER.exception('Exception dispatching signal {}'.format(ZIGATE_OTA_PROGRESS))
+
+    def end_request(self, request):
+        '''
+        client ended upgrade, remove its session
+        '''
+        with self._lock:
+            key = (request['manufacture_code'], request['image_type'], request['file_version'])
+            session = self.sessions.pop((request['addr'], key), None)
+            if session is None:  # search by addr
+                for key in list(self.sessions.keys()):
+                    if key[0] == request['addr']:
+                        session = self.sessions.pop(key)
+                        break
+        if session is None:
+            return
+        # Handle error statuses
+        if request['status'] == 0x00:
+            LOGGER.info('OTA image upload {} finnished successfully in {seconds}s.'.format(
+                session.addr, seconds=(datetime.datetime.now() - session.starttime).seconds))
+        elif request['status'] == 0x95:
+            LOGGER.warning('OTA aborted by client {}'.format(session.addr))
+        elif request['status'] == 0x96:
+            LOGGER.warning('OTA image upload successfully, but image verification failed.')
+        elif request['status'] == 0x99:
+            LOGGER.warning('OTA image uploaded successfully, but client needs more images for update.')
+        else:
+            LOGGER.warning('Some unexpected OTA status {}'.format(request['status']))
+        return session
+
+    def get_status(self):
+        '''
+        return status of all sessions
+        '''
+        with self._lock:
+            return [session.status() for session in self.sessions.values()]
+
+    def get_metrics(self):
+        '''
+        return pacing and sessions metrics
+        '''
+        with self._lock:
+            sessions = [session.status() for session in self.sessions.values()]
+        return {'block_rate': self.block_rate,
+                'max_block_rate': self.max_block_rate,
+                'sessions': sessions,
+                'blocks_per_second': sum([s['blocks_per_second'] for s in sessions]),
+                'bytes_per_second': sum([s['bytes_per_second'] for s in sessions])}
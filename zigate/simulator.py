@@ -0,0 +1,365 @@
+#
+# Copyright (c) 2018 Sébastien RAMAGE
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+#
+
+import threading
+import logging
+import os
+import select
+import socket
+import struct
+from time import (sleep, time)
+from . import flasher
+
+LOGGER = logging.getLogger('zigate')
+
+SIMULATOR_MAC = bytes.fromhex('00158d0001020304')
+SIMULATOR_MAC_ADDR = 0x01001570  # ram address of mac read by flasher
+SIMULATOR_VERSION = 0x031d  # firmware version 3.1d
+SIMULATOR_IEEE = 0x00158d0000000001
+SIMULATOR_EXTEND_PAN = 0x1234567890abcdef
+SIMULATOR_DEVICE_ADDR = 0x1000  # first virtual device address
+SIMULATOR_DEVICE_IEEE = 0x00158d0000100000  # first virtual device ieee
+
+
+def zigate_frame(msg_type, value=b'', rssi=0xff):
+    '''
+    return escaped ZiGate frame
+    '''
+    length = len(value) + 1
+    data = struct.pack('!HH', msg_type, length)
+    checksum = 0
+    for b in data + value + bytes([rssi]):
+        checksum ^= b
+    data = data + bytes([checksum]) + value + bytes([rssi])
+    encoded = bytearray([0x01])
+    for b in data:
+        if b < 0x10:
+            encoded.extend([0x02, 0x10 ^ b])
+        else:
+            encoded.append(b)
+    encoded.append(0x03)
+    return bytes(encoded)
+
+
+class PtySimulator(threading.Thread):
+    '''
+    base of simulated devices, data is exchanged over a pseudo-terminal
+    so clients use the real serial.Serial on `port`
+    if tcp_port is not None, it also accepts a tcp client (0 for a free port),
+    data is then exchanged with the last connected client
+    '''
+    def __init__(self, name, tcp_port=None, host='127.0.0.1'):
+        import tty  # not available on Windows, like os.openpty
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._server = None
+        self._client = None
+        self.tcp_port = None
+        if tcp_port is not None:
+            self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._server.bind((host, tcp_port))
+            self._server.listen(1)
+            self.tcp_port = self._server.getsockname()[1]
+        self._write_lock = threading.Lock()
+        self._running = True
+
+    def write(self, data):
+        with self._write_lock:
+            if self._client:
+                try:
+                    self._client.sendall(data)
+                except OSError:
+                    pass
+            else:
+                data = memoryview(data)
+                while data:  # pty buffer could be full, write the remaining bytes
+                    data = data[os.write(self._master, data):]
+
+    def received(self, data):
+        '''
+        data received from the client, ignored by default
+        '''
+        pass
+
+    def close(self):
+        self._running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(2)
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        for sock in (self._client, self._server):
+            if sock:
+                sock.close()
+
+    def _accept(self):
+        client, addr = self._server.accept()
+        LOGGER.debug('Simulator client connected from {}'.format(addr))
+        if self._client:
+            self._client.close()
+        self._client = client
+
+    def _read_client(self):
+        data = self._client.recv(4096)
+        if data:
+            self.received(data)
+        else:
+            self._client.close()
+            self._client = None
+
+    def run(self):
+        while self._running:
+            inputs = [self._master]
+            if self._server:
+                inputs.append(self._server)
+            if self._client:
+                inputs.append(self._client)
+            try:
+                ready, _, _ = select.select(inputs, [], [], 0.1)
+                if self._master in ready:
+                    self.received(os.read(self._master, 4096))
+                if self._server in ready:
+                    self._accept()
+                if self._client in ready:
+                    self._read_client()
+            except (OSError, ValueError):
+                if not self._running:
+                    break
+            except Exception:
+                LOGGER.exception('Simulator error')
+            self.idle()
+
+    def idle(self):
+        '''
+        called by simulator loop at least every 0.1s
+        '''
+        pass
+
+
+class BootloaderSimulator(PtySimulator):
+    '''
+    simulated JN516x bootloader answering zigate.flasher requests
+    latency is added before each response (seconds),
+    if simulate_baudrate transfer time is also simulated for current baudrate,
+    responses are lost above max_baudrate to simulate an unreliable link,
+    writing at address fail_at fails
+    '''
+    def __init__(self, firmware=b'', latency=0, simulate_baudrate=False, sector_erase=True,
+                 max_baudrate=None, fail_at=None):
+        PtySimulator.__init__(self, 'ZiGate-Bootloader-Simulator')
+        self.flash = bytearray(b'\xff' * flasher.ZIGATE_FLASH_END)
+        self.flash[:len(firmware)] = firmware
+        self.latency = latency
+        self.simulate_baudrate = simulate_baudrate
+        self.sector_erase = sector_erase
+        self.max_baudrate = max_baudrate
+        self.fail_at = fail_at
+        self.baudrate = 38400
+        self.requests = {}  # requests count by type
+        self.writes = []  # addresses of successful flash writes
+        self._buffer = b''
+
+    def received(self, data):
+        self._buffer += data
+        while self._buffer and len(self._buffer) > self._buffer[0]:
+            length = self._buffer[0]
+            msg, self._buffer = self._buffer[:length + 1], self._buffer[length + 1:]
+            if length < 2 or flasher.prepare(msg[1], msg[2:-1]) != msg:
+                LOGGER.error('Bootloader simulator: invalid message {}'.format(msg.hex()))
+                continue
+            self.requests[msg[1]] = self.requests.get(msg[1], 0) + 1
+            status, value, baudrate = self.handle(msg[1], msg[2:-1])
+            response = flasher.prepare(msg[1] + 1, bytes([status]) + value)
+            self._delay(len(msg) + len(response))
+            if not self.max_baudrate or self.baudrate <= self.max_baudrate:
+                self.write(response)
+            if baudrate:
+                self.baudrate = baudrate
+
+    def _delay(self, size):
+        delay = self.latency
+        if self.simulate_baudrate:
+            delay += size * 10 / self.baudrate
+        if delay:
+            sleep(delay)
+
+    def handle(self, type_, data):
+        '''
+        return status, value and new baudrate
+        '''
+        if type_ == 0x07:  # flash erase
+            self.flash[:] = b'\xff' * len(self.flash)
+        elif type_ == 0x09:  # flash write
+            addr, = struct.unpack('<L', data[:4])
+            if addr + len(data) - 4 > len(self.flash) or addr == self.fail_at:
+                return 1, b'', None
+            self.flash[addr:addr + len(data) - 4] = data[4:]
+            self.writes.append(addr)
+        elif type_ == 0x0b:  # flash read
+            addr, length = struct.unpack('<LH', data)
+            if addr + length > len(self.flash):
+                return 1, b'', None
+            return 0, bytes(self.flash[addr:addr + length]), None
+        elif type_ == 0x0d:  # sector erase
+            start = data[0] * flasher.ZIGATE_SECTOR_SIZE
+            if not self.sector_erase or start >= len(self.flash):
+                return 0xff, b'', None
+            self.flash[start:start + flasher.ZIGATE_SECTOR_SIZE] = b'\xff' * flasher.ZIGATE_SECTOR_SIZE
+        elif type_ == 0x1f:  # ram read
+            addr, length = struct.unpack('<LH', data)
+            if addr == SIMULATOR_MAC_ADDR:
+                return 0, SIMULATOR_MAC[:length], None
+            return 0, b'\xff' * length, None
+        elif type_ == 0x25:  # flash id
+            return 0, b'\xcc\xee', None
+        elif type_ == 0x27:  # change baudrate
+            if not data[0]:
+                return 1, b'', None
+            return 0, b'', round(1000000 / data[0])
+        elif type_ == 0x2c:  # select flash type
+            pass
+        elif type_ == 0x32:  # chip id
+            return 0, struct.pack('!L', flasher.ZIGATE_CHIP_ID), None
+        else:
+            return 0xff, b'', None
+        return 0, b'', None
+
+
+class ZiGateSimulator(PtySimulator):
+    '''
+    simulated ZiGate firmware, reachable over a pty (ZiGate) or tcp (ZiGateWiFi)
+    answers commands used by autoStart and emits 0x8102 temperature reports
+    for `devices` virtual devices at `rate` reports per second (see start_reports)
+    '''
+    def __init__(self, devices=0, rate=0, tcp_port=None, host='127.0.0.1'):
+        PtySimulator.__init__(self, 'ZiGate-Simulator', tcp_port, host)
+        self.devices = [(SIMULATOR_DEVICE_ADDR + i, SIMULATOR_DEVICE_IEEE + i) for i in range(devices)]
+        self.rate = rate
+        self.commands = {}  # commands count by type
+        self.reports = 0  # reports sent
+        self._sequence = 0
+        self._buffer = b''
+        self._reporting = False
+
+    def received(self, data):
+        self._buffer += data
+        endpos = self._buffer.find(b'\x03')
+        while endpos != -1:
+            startpos = self._buffer.rfind(b'\x01', 0, endpos)
+            frame = self._buffer[startpos + 1:endpos] if startpos != -1 else b''
+            self._buffer = self._buffer[endpos + 1:]
+            endpos = self._buffer.find(b'\x03')
+            decoded = bytearray()
+            flip = False
+            for b in frame:
+                if flip:
+                    flip = False
+                    decoded.append(b ^ 0x10)
+                elif b == 0x02:
+                    flip = True
+                else:
+                    decoded.append(b)
+            if len(decoded) < 5:
+                LOGGER.error('ZiGate simulator: malformed frame {}'.format(frame.hex()))
+                continue
+            msg_type, length = struct.unpack('!HH', decoded[:4])
+            self.commands[msg_type] = self.commands.get(msg_type, 0) + 1
+            self.handle(msg_type, bytes(decoded[5:5 + length]))
+
+    def handle(self, msg_type, data):
+        self._sequence = (self._sequence + 1) % 256
+        responses = [(0x8000, struct.pack('!BBH', 0, self._sequence, msg_type))]
+        if msg_type == 0x0010:  # version
+            responses.append((0x8010, struct.pack('!HH', 0x0001, SIMULATOR_VERSION)))
+        elif msg_type == 0x0009:  # network state
+            responses.append((0x8009, struct.pack('!HQHQB', 0x0000, SIMULATOR_IEEE, 0x1234,
+                                                  SIMULATOR_EXTEND_PAN, 11)))
+        elif msg_type == 0x0024:  # start network, network formed
+            responses.append((0x8024, struct.pack('!BHQB', 1, 0x0000, SIMULATOR_IEEE, 11)))
+        elif msg_type == 0x0015:  # devices list
+            value = b''.join([struct.pack('!BHQBB', i, addr, ieee, 1, 255)
+                              for i, (addr, ieee) in enumerate(self.devices)])
+            responses.append((0x8015, value))
+        self.write(b''.join([zigate_frame(t, v) for t, v in responses]))
+
+    def report(self, addr, value):
+        '''
+        return 0x8102 temperature report frame
+        '''
+        self._sequence = (self._sequence + 1) % 256
+        data = struct.pack('!BHBHHBBHh', self._sequence, addr, 1, 0x0402, 0x0000, 0, 0x29, 2, value)
+        return zigate_frame(0x8102, data)
+
+    def start_reports(self, rate=None, count=None):
+        '''
+        emit reports at rate per second in a separate thread, round robin on devices
+        stop after count reports if specified
+        '''
+        if rate is not None:
+            self.rate = rate
+        self._reporting = True
+        thread = threading.Thread(target=self._reporter, args=(count,), name='ZiGate-Simulator-Reports')
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def stop_reports(self):
+        self._reporting = False
+
+    def _reporter(self, count=None):
+        start = time()
+        sent = 0
+        while self._reporting and self._running and self.devices and (count is None or sent < count):
+            due = int((time() - start) * self.rate) - sent if self.rate else 1
+            if count is not None:
+                due = min(due, count - sent)
+            if due <= 0:
+                sleep(0.001)
+                continue
+            frames = []
+            for i in range(sent, sent + due):
+                addr, ieee = self.devices[i % len(self.devices)]
+                frames.append(self.report(addr, i % 0x8000))
+            self.write(b''.join(frames))
+            sent += due
+            self.reports += due
+        self._reporting = False
+
+    def close(self):
+        self._reporting = False
+        PtySimulator.close(self)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['zigate', 'bootloader'], nargs='?', default='bootloader')
+    parser.add_argument('--tcp_port', type=int, help='Also listen on tcp port')
+    parser.add_argument('--devices', type=int, default=10, help='Virtual devices count')
+    parser.add_argument('--rate', type=float, default=0, help='Reports per second')
+    parser.add_argument('--debug', action='store_true', default=False)
+    args = parser.parse_args()
+    logging.basicConfig()
+    if args.debug:
+        logging.root.setLevel(logging.DEBUG)
+    if args.mode == 'zigate':
+        simulator = ZiGateSimulator(args.devices, args.rate, args.tcp_port, '0.0.0.0')
+        if args.rate:
+            simulator.start_reports()
+    else:
+        simulator = BootloaderSimulator()
+    simulator.start()
+    print('{} simulator on {}'.format(args.mode, simulator.port))
+    if simulator.tcp_port:
+        print('{} simulator on tcp port {}'.format(args.mode, simulator.tcp_port))
+    simulator.join()
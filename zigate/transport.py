@@ -13,12 +13,18 @@ import serial.tools.list_ports
 import queue
 import socket
 import select
+import struct
 from pydispatch import dispatcher
 import sys
 from .const import ZIGATE_FAILED_TO_CONNECT
 
 LOGGER = logging.getLogger('zigate')
 
+CAPTURE_MAGIC = b'ZGCAP\x01'  # capture file header
+CAPTURE_RECORD = struct.Struct('<QBH')  # microseconds since capture start, direction, length
+CAPTURE_IN = 0  # data read from ZiGate
+CAPTURE_OUT = 1  # data sent to ZiGate
+
 
 class ZIGATE_NOT_FOUND(Exception):
     pass
@@ -28,17 +34,74 @@ class ZIGATE_CANNOT_CONNECT(Exception):
     pass
 
 
+class PacketCapture(object):
+    '''
+    record raw data exchanged with ZiGate with monotonic timestamp and direction
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'wb')
+        self._fp.write(CAPTURE_MAGIC)
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def write(self, direction, data):
+        timestamp = int((time.monotonic() - self._start) * 1000000)
+        with self._lock:
+            if self._fp.closed:
+                return
+            for i in range(0, len(data), 0xffff):
+                chunk = data[i:i + 0xffff]
+                self._fp.write(CAPTURE_RECORD.pack(timestamp, direction, len(chunk)))
+                self._fp.write(chunk)
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+def read_capture(path):
+    '''
+    iterate over capture records (seconds since capture start, direction, data)
+    '''
+    with open(path, 'rb') as fp:
+        if fp.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError('{} is not a ZiGate capture'.format(path))
+        while True:
+            header = fp.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                break
+            timestamp, direction, length = CAPTURE_RECORD.unpack(header)
+            yield timestamp / 1000000, direction, fp.read(length)
+
+
 class BaseTransport(object):
     def __init__(self):
         self._buffer = b''
         self.queue = queue.Queue()
         self.received = queue.Queue()
+        self.capture = None
+
+    def start_capture(self, path):
+        '''
+        record raw data read and sent to capture file
+        '''
+        self.stop_capture()
+        self.capture = PacketCapture(path)
+
+    def stop_capture(self):
+        if self.capture:
+            self.capture.close()
+            self.capture = None
 
     def read_data(self, data):
         '''
         Read ZiGate output and split messages
         '''
         LOGGER.debug('Raw packet received, {}'.format(data))
+        capture = self.capture
+        if capture:
+            capture.write(CAPTURE_IN, data)
         self._buffer += data
 #         print(self._buffer)
         endpos = self._buffer.find(b'\x03')
@@ -103,6 +166,9 @@ class ThreadSerialConnection(BaseTransport):
             time.sleep(0.05)
 
     def send(self, data):
+        capture = self.capture
+        if capture:
+            capture.write(CAPTURE_OUT, data)
         self.queue.put(data)
 
     def _find_port(self, port):
@@ -135,6 +201,7 @@ class ThreadSerialConnection(BaseTransport):
         while self.thread.is_alive():
             time.sleep(0.1)
         self.serial.close()
+        self.stop_capture()
 
 
 class ThreadSocketConnection(ThreadSerialConnection):
@@ -190,6 +257,58 @@ class ThreadSocketConnection(ThreadSerialConnection):
         return True
 
 
+class ReplayTransport(BaseTransport):
+    '''
+    feed data read in a capture file (see start_capture) back to ZiGate,
+    at original pacing (divided by speed) if realtime, else as fast as possible
+    sent data is ignored
+    '''
+    def __init__(self, device, path, realtime=True, speed=1.0):
+        BaseTransport.__init__(self)
+        self.device = device
+        self.path = path
+        self.realtime = realtime
+        self.speed = speed
+        self.sent = 0
+        self.done = threading.Event()
+        self._running = True
+        self.thread = threading.Thread(target=self.replay,
+                                       name='ZiGate-Replay')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def replay(self):
+        start = time.monotonic()
+        try:
+            for timestamp, direction, data in read_capture(self.path):
+                if not self._running:
+                    break
+                if direction != CAPTURE_IN:
+                    continue
+                if self.realtime:
+                    delay = start + timestamp / self.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.read_data(data)
+        except Exception:
+            LOGGER.exception('Replay failed')
+        self.done.set()
+
+    def send(self, data):
+        capture = self.capture
+        if capture:
+            capture.write(CAPTURE_OUT, data)
+        self.sent += 1
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        self._running = False
+        self.thread.join(2)
+        self.stop_capture()
+
+
 def discover_host():
     from zeroconf import ServiceBrowser, Zeroconf
     host = None